@@ -0,0 +1,5 @@
+"""
+Motion analysis of ROI contours (installed as rmhTools.roiTools)
+
+Requires numpy; scipy only for the surface output (see README.md).
+"""
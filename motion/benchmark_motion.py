@@ -0,0 +1,171 @@
+"""
+Benchmarks of the motion analysis on synthetic cases (see syntheticCase)
+
+Times each stage of the production path separately, so regressions and
+speed-ups can be measured without a live RayStation:
+    extraction      reading the ROI geometries into packed arrays (ExtractionCache)
+    nearest slice   slice matching only: the nearest packed contour of every sampled
+                    z (SliceIndex) and the closest base exam slice of each
+                    (ReferenceSlices.match)
+    extremes        R/L/A/P extreme points of every sampled slice
+                    (contourEngine.extremePointRecords)
+    pair lines      the csv rows of every ROI/exam pair: extreme points, matching
+                    to the base exam slices and formatting (computePairLines)
+    output          streaming the rows to disk (motionOutput.StreamingCsvWriter)
+    full run        motionEngine.MotionAnalysis.run, end to end (fresh cache)
+The pairs of the nearest slice, extremes, pair lines and output stages are
+those of the full run (MotionAnalysis.prepareExam). Each stage is repeated and
+the fastest time is reported.
+
+to run type:
+    from rmhTools.roiTools import benchmark_motion
+    benchmark_motion.main()
+or, for another case size:
+    benchmark_motion.runBenchmark(num_exams=30, num_slices=100, points_per_contour=500)
+or from the command line:
+    python -m rmhTools.roiTools.benchmark_motion
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from . import contourEngine
+from . import motionEngine
+from . import motionOutput
+from . import syntheticCase
+
+# --------------- #
+
+
+# Default case sizes benchmarked by main(): (exams, slices, points per contour, contours per slice)
+BENCHMARK_CASES = [ (4, 60, 100, 1),
+                    (10, 80, 200, 2),
+                    (30, 100, 500, 1) ]
+
+SLICE_INTERVAL = 0.25  # cm
+REPEATS = 3
+
+
+# --------------- #
+
+def _bestTime(function, repeats):
+    """Fastest of repeats calls of function (seconds) and its last result"""
+    best = None
+    for i in range(repeats):
+        start = time.time()
+        result = function()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return (best, result)
+
+
+def _quietly(function):
+    """Call function with its printed output discarded"""
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        return function()
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+# --------------- #
+
+
+
+def runBenchmark(num_exams=4, num_slices=60, points_per_contour=100, contours_per_slice=1,
+                 rois=('ROI_A', 'ROI_B'), slice_interval=SLICE_INTERVAL, repeats=REPEATS, seed=0):
+    """
+    Time every stage on one synthetic case; returns {stage: seconds}
+    """
+    case = syntheticCase.makeCase(num_exams=num_exams, rois=rois, num_slices=num_slices,
+                                  points_per_contour=points_per_contour,
+                                  contours_per_slice=contours_per_slice, seed=seed)
+
+    def newAnalysis():
+        return motionEngine.MotionAnalysis( case, list(rois), motionEngine.PlanningNameBase(), slice_interval )
+
+    # ROI/exam pairs in the order of a run
+    analysis = newAnalysis()
+    exams = analysis.base_strategy.selectExams(case)
+    pairs = [ (roi, exam) for roi in rois for exam in exams ]
+
+    timings = {}
+
+    # Extraction (a new cache each time)
+    def extract():
+        cache = newAnalysis().cache
+        return [ cache.getPackedContours(exam.Name, roi) for (roi, exam) in pairs ]
+    (timings['extraction'], result) = _bestTime(extract, repeats)
+
+    # Everything read from the case for each pair, as in a serial run
+    tasks = [ analysis.prepareExam(roi, exam) for (roi, exam) in pairs ]
+    tasks = [ task for task in tasks if isinstance(task, motionEngine.PairTask) ]
+
+    # Nearest slice lookups, apart from the extreme points
+    def nearest():
+        return [ (contourEngine.findNearestContours(task.packed, task.slice_selection),
+                  task.base.slices.match( [ z - task.ref[2] for z in task.slice_selection ], clamp=task.clamp ))
+                 for task in tasks ]
+    (timings['nearest slice'], result) = _bestTime(nearest, repeats)
+
+    # Extreme points
+    def extremes():
+        return [ contourEngine.extremePointRecords(task.packed, task.slice_selection, task.ref[0], task.ref[1],
+                                                   task.ref[2], task.directions, len(task.shape_columns) > 0)
+                 for task in tasks ]
+    (timings['extremes'], result) = _bestTime(extremes, repeats)
+
+    # Rows of every pair
+    def pairLines():
+        return [ motionEngine.computePairLines(task) for task in tasks ]
+    (timings['pair lines'], all_lines) = _bestTime(pairLines, repeats)
+
+    # Output writing
+    directory = tempfile.mkdtemp()
+    try:
+        def output():
+            writer = motionOutput.StreamingCsvWriter( [ (os.path.join(directory, 'benchmark.csv'), analysis.header()) ] )
+            for (task, (lines, supinf_line, ext_coords)) in zip(tasks, all_lines):
+                writer.writePair(task.roi_name, task.exam_name, [lines])
+            writer.finish()
+        (timings['output'], result) = _bestTime(output, repeats)
+
+        # Full run with a new (empty) cache each time
+        def fullRun():
+            newAnalysis().run( os.path.join(directory, 'motionPoints_benchmark.csv') )
+        (timings['full run'], result) = _bestTime(fullRun, repeats)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return timings
+
+# --------------- #
+
+
+
+def main(cases=BENCHMARK_CASES, repeats=REPEATS):
+    """
+    Benchmark every case size and print a table of the stage times (ms)
+    """
+    stages = [ 'extraction', 'nearest slice', 'extremes', 'pair lines', 'output', 'full run' ]
+    print( "{:>6} {:>7} {:>7} {:>9}  ".format('exams', 'slices', 'points', 'contours') +
+           " ".join([ "{:>14}".format(stage) for stage in stages ]) )
+
+    all_timings = []
+    for (num_exams, num_slices, points_per_contour, contours_per_slice) in cases:
+        # the full run prints its progress; keep the table readable
+        timings = _quietly( lambda: runBenchmark(num_exams, num_slices, points_per_contour,
+                                                 contours_per_slice, repeats=repeats) )
+        all_timings.append( timings )
+        print( "{:>6} {:>7} {:>7} {:>9}  ".format(num_exams, num_slices, points_per_contour, contours_per_slice) +
+               " ".join([ "{:>14.1f}".format(1000.0 * timings[stage]) for stage in stages ]) )
+    return all_timings
+
+
+if __name__ == '__main__':
+    main()
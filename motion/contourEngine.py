@@ -0,0 +1,983 @@
+"""
+Packed-array contour engine for the motionByPoints scripts
+
+The PrimaryShape.Contours of an ROI geometry are read ONCE into flat numpy
+arrays (all points, per-contour offsets and per-contour z) and the R/L/A/P
+extreme points of every requested slice are then found with array reductions,
+rather than walking every contour point in python for every slice.
+
+Results are identical to findExtremePoints_2: the closest contoured slice is
+used for each requested z, all contours within SAME_SLICE_TOLERANCE of it are
+grouped together and ties are resolved in favour of the first point found.
+Nearest-slice lookups use a SliceIndex (sorted contour z, built once per
+geometry) so each lookup is a bisection rather than a scan of every contour.
+ReferenceSlices matches every slice of an exam to the closest planning (base)
+slice in the same way.
+
+Per-slice results are held as SliceRecords: one contiguous float column per
+key for all slices of an ROI/exam, rather than a dictionary per slice, so
+the differences to the matched base slices are found with one subtraction.
+
+Optionally the extremes along K oblique in-plane directions are found too
+(directionVectors): all points of the slices are projected onto the K
+direction vectors in one matrix product and the largest projection of every
+slice is taken with one reduction, so K directions cost little more than one.
+
+Instead of sampling the nearest contoured slice at every requested z, a
+SliceProfile holds the values of every distinct contoured slice once and
+interpolates them linearly onto any z grid (e.g. one grid shared by all exams).
+
+Triangle-mesh ROIs (e.g. made by MBS: PrimaryShape.Vertices and Triangles,
+no Contours) are cut by axial planes every slice interval (sliceMesh). All
+triangle/plane intersections are found in one batched operation and joined
+into closed polygons, which are packed exactly like contours, so the rest of
+the analysis does not need to know which kind of ROI it has.
+
+Packed points can be moved into another frame with one batched 4x4
+transform (transformPacked), e.g. by the rigid registration of an exam to
+its base exam.
+
+Surface displacement between two exams (surfaceDisplacement) uses a KD-tree
+(scipy) over the points of one exam, so the nearest point to every point of
+the other is found in N log N rather than by comparing every pair of points.
+
+Shape descriptors of every slice (area, perimeter, centroid and bounding box;
+SHAPE_KEYS) can be found from the same packed points: shoelace sums are
+reduced per contour and then combined over all contours of a slice.
+
+to use:
+    from rmhTools.roiTools import contourEngine
+    packed = contourEngine.packContours(roiGeom)
+    ext_list = contourEngine.findExtremePointsForSlices(packed, slice_selection, refX, refY, refZ)
+
+    directions = contourEngine.directionVectors(8)
+    ext_list = contourEngine.findExtremePointsForSlices(packed, slice_selection, refX, refY, refZ, directions)
+
+    records = contourEngine.extremePointRecords(packed, slice_selection, refX, refY, refZ)
+    deltas = records.difference(base_records, closest_indices, ['R.x', 'L.x'])
+"""
+
+import bisect
+import hashlib
+
+import numpy as np
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+# --------------- #
+
+
+# Contours closer than this in z are treated as lying on the same slice
+SAME_SLICE_TOLERANCE = 0.001  # cm; catch rounding errors in RayStation
+
+# Order of the keys returned for every slice (same as findExtremePoints_2)
+EXTREME_KEYS = [ 'R.x', 'R.y', 'R.z', 'L.x', 'L.y', 'L.z',
+                 'A.x', 'A.y', 'A.z', 'P.x', 'P.y', 'P.z' ]
+
+# Summary of the distances from the base surface points to the nearest exam point:
+# mean / percentiles / max of the 3D distance and mean of the signed x,y,z components
+SURFACE_KEYS = [ 'mean', 'p50', 'p90', 'p95', 'max', 'dx', 'dy', 'dz' ]
+
+# Shape descriptors of a slice (centroid wrt reference coords)
+SHAPE_KEYS = [ 'area', 'perimeter', 'C.x', 'C.y', 'width', 'height' ]
+
+
+# --------------- #
+
+class SliceIndex(object):
+    """
+    Sorted index of the contour z positions of one ROI geometry
+    Built once; nearest-slice lookups are then a bisection and the
+    z extent of the ROI is available directly.
+    """
+
+    def __init__(self, contour_z):
+        self.contour_z = np.asarray(contour_z, dtype=np.float64)
+        # stable sort so that equal z values keep their contour order
+        self.order = np.argsort(self.contour_z, kind='mergesort')
+        self.sorted_z = self.contour_z[self.order]
+        self._sorted_list = self.sorted_z.tolist()
+
+    @classmethod
+    def fromGeometry(cls, roiGeom):
+        """Index built from the first point of each contour of an ROI geometry"""
+        return cls( [con[0].z for con in roiGeom.PrimaryShape.Contours] )
+
+    def __len__(self):
+        return len(self.sorted_z)
+
+    def limits(self):
+        """Return (min, max) contour z"""
+        if len(self.sorted_z) == 0:
+            return (9E99, -9E99)
+        return (self._sorted_list[0], self._sorted_list[-1])
+
+    def nearestContour(self, zPos):
+        """
+        Index of the contour closest to zPos
+        As the original linear scan, the first contour (in contour order)
+        wins when several are equally close
+        """
+        ss = self._sorted_list
+        if len(ss) == 0:
+            print("ERROR: no contours in SliceIndex")
+            return -1
+
+        i = bisect.bisect_left(ss, zPos)
+        if i == 0:
+            return int(self.order[0])
+        if i == len(ss):
+            return int(self.order[bisect.bisect_left(ss, ss[-1])])
+
+        left = bisect.bisect_left(ss, ss[i-1])   # first contour of the lower slice
+        diff_left = abs(ss[left] - zPos)
+        diff_right = abs(ss[i] - zPos)
+        if diff_left < diff_right:
+            return int(self.order[left])
+        if diff_right < diff_left:
+            return int(self.order[i])
+        return int(min(self.order[left], self.order[i]))
+
+    def nearestContours(self, z_list):
+        """
+        Vectorised nearestContour for a whole list of z positions
+        """
+        z_req = np.asarray(z_list, dtype=np.float64)
+        num = len(self.sorted_z)
+        if num == 0:
+            print("ERROR: no contours in SliceIndex")
+            return np.full(len(z_req), -1, dtype=np.intp)
+
+        right = np.clip(np.searchsorted(self.sorted_z, z_req, side='left'), 0, num-1)
+        left = np.clip(right - 1, 0, num-1)
+        left = np.searchsorted(self.sorted_z, self.sorted_z[left], side='left')
+        right = np.searchsorted(self.sorted_z, self.sorted_z[right], side='left')
+
+        diff_left = np.abs(self.sorted_z[left] - z_req)
+        diff_right = np.abs(self.sorted_z[right] - z_req)
+        take_left = (diff_left < diff_right) | \
+                    ( (diff_left == diff_right) & (self.order[left] < self.order[right]) )
+
+        return np.where(take_left, self.order[left], self.order[right])
+
+    def sameSliceContours(self, c):
+        """
+        Indices (in contour order) of all contours within SAME_SLICE_TOLERANCE
+        of contour c
+        """
+        cz = self.contour_z[c]
+        lo = bisect.bisect_left(self._sorted_list, cz - 2*SAME_SLICE_TOLERANCE)
+        hi = bisect.bisect_right(self._sorted_list, cz + 2*SAME_SLICE_TOLERANCE)
+        members = [ int(m) for m in self.order[lo:hi]
+                    if abs(self.contour_z[m] - cz) < SAME_SLICE_TOLERANCE ]
+        return sorted(members)
+
+    def distinctSlices(self):
+        """
+        Sorted z of every distinct contoured slice (contours closer than
+        SAME_SLICE_TOLERANCE count as one slice, at the lowest of their z)
+        """
+        if len(self.sorted_z) == 0:
+            return self.sorted_z
+        new_slice = np.concatenate( ([True], np.diff(self.sorted_z) >= SAME_SLICE_TOLERANCE) )
+        return self.sorted_z[new_slice]
+
+# --------------- #
+
+class SliceRecords(object):
+    """
+    Per-slice values of one ROI/exam: values[k] is the contiguous (S,) float
+    column of keys[k] for all S slices. Indexing gives one slice as a dictionary.
+    """
+
+    def __init__(self, keys, values):
+        self.keys = list(keys)
+        self.columns = dict( (key, k) for (k, key) in enumerate(self.keys) )
+        self.values = np.ascontiguousarray(values, dtype=np.float64).reshape(len(self.keys), -1)
+
+    @classmethod
+    def fromArrays(cls, arrays, keys):
+        """Records of keys from a dictionary of (S,) arrays"""
+        if len(keys) == 0:
+            return cls(keys, np.zeros((0, 0)))
+        return cls(keys, np.vstack([ np.asarray(arrays[key], dtype=np.float64) for key in keys ]))
+
+    @classmethod
+    def fromDicts(cls, slices):
+        """Records of the numeric entries of a list of per-slice dictionaries"""
+        keys = [ key for key in slices[0] if isinstance(slices[0][key], (int, float)) ] if len(slices) else ['z']
+        return cls(keys, [ [ sl[key] for sl in slices ] for key in keys ])
+
+    def __len__(self):
+        return self.values.shape[1]
+
+    def __getitem__(self, i):
+        return dict( zip(self.keys, self.values[:, i].tolist()) )
+
+    def column(self, key):
+        return self.values[self.columns[key]]
+
+    def take(self, indices):
+        """Records of the slices at indices"""
+        return SliceRecords(self.keys, self.values[:, np.asarray(indices, dtype=np.intp)])
+
+    def difference(self, other, indices, keys):
+        """
+        (len(keys), S) values of keys of every slice minus those of slice indices[s]
+        of the other records (e.g. the matched base slices), in one subtraction
+        """
+        rows = [ self.columns[key] for key in keys ]
+        other_rows = [ other.columns[key] for key in keys ]
+        return self.values[rows] - other.values[other_rows][:, np.asarray(indices, dtype=np.intp)]
+
+# --------------- #
+
+class ReferenceSlices(object):
+    """
+    Reference slices (e.g. PLANNING_CT or BASE_SCAN) held sorted by z so that
+    all slices of an exam are matched to their closest reference slice in one
+    batched pass. Slices are SliceRecords (or a list of dictionaries) with (at
+    least) a 'z' key.
+    """
+
+    def __init__(self, slices):
+        if not isinstance(slices, SliceRecords):
+            slices = SliceRecords.fromDicts(slices)
+        self.records = slices
+        self.index = SliceIndex( slices.column('z') )
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, i):
+        return self.records[i]
+
+    def limits(self):
+        """Return (min, max) reference z"""
+        return self.index.limits()
+
+    def match(self, z_values, clamp=True, tolerance=SAME_SLICE_TOLERANCE):
+        """
+        Index of the closest reference slice for each z value (the first
+        listed on a tie, as the original linear scan).
+        With clamp=True z values beyond the reference extent are matched to the
+        extreme reference slice; with clamp=False they are given -1 (no match).
+        """
+        if len(self.records) == 0:
+            return [-1] * len(z_values)
+
+        matches = self.index.nearestContours(z_values)
+        if not clamp:
+            z_req = np.asarray(z_values, dtype=np.float64)
+            (min_z, max_z) = self.limits()
+            outside = (z_req < min_z - tolerance) | (z_req > max_z + tolerance)
+            matches = np.where(outside, -1, matches)
+
+        return matches.tolist()
+
+# --------------- #
+
+class PackedContours(object):
+    """
+    All contours of one ROI geometry held as contiguous arrays
+        points  : (N,3) x,y,z of every contour point, contour after contour
+        offsets : (C+1,) contour c is points[offsets[c]:offsets[c+1]]
+        z       : (C,) z position of each contour (that of its first point, unless given)
+    """
+
+    def __init__(self, points, offsets, z=None):
+        self.points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        self.offsets = np.asarray(offsets, dtype=np.intp)
+        if z is None:
+            self.z = self.points[self.offsets[:-1], 2]
+        else:
+            self.z = np.asarray(z, dtype=np.float64)
+        self.sliceIndex = SliceIndex(self.z)
+
+    def numContours(self):
+        return len(self.offsets) - 1
+
+# --------------- #
+
+
+
+def packContourList(contour_list):
+    """
+    Read a list of RayStation contours (lists of points with .x .y .z)
+    into a PackedContours object
+    """
+    coords = []
+    offsets = [0]
+    for con in contour_list:
+        for pt in con:
+            coords.append( (pt.x, pt.y, pt.z) )
+        offsets.append( len(coords) )
+
+    return PackedContours(coords, offsets)
+
+# --------------- #
+
+
+
+def packContours(roiGeom):
+    """
+    Pack all contours of an ROI geometry; the geometry is only read once
+    """
+    return packContourList(roiGeom.PrimaryShape.Contours)
+
+
+def packSelected(contour_list, index, z_list):
+    """
+    Pack only the contours of the slices nearest the z positions in z_list
+    (all contours of each such slice, in contour order), given the SliceIndex
+    of contour_list. Their extreme points at z_list are those of all contours.
+    """
+    selected = set()
+    for c in np.unique(index.nearestContours(z_list)).tolist():
+        selected.update( index.sameSliceContours(c) )
+    return packContourList( [ contour_list[c] for c in sorted(selected) ] )
+
+# --------------- #
+
+
+
+def transformMatrix(transform):
+    """
+    4x4 numpy matrix of a RayStation transform: 16 values in row order, or a
+    dictionary with keys M11 ... M44
+    """
+    if hasattr(transform, 'keys'):
+        transform = [ transform['M%d%d' % (row, col)] for row in range(1, 5) for col in range(1, 5) ]
+    return np.array( list(transform), dtype=np.float64 ).reshape(4, 4)
+
+
+def transformPacked(packed, matrix):
+    """
+    PackedContours with every point moved by the 4x4 (rigid) matrix in one
+    batched product. Each slice keeps one z position, that of the mean point
+    of the ROI on that slice's plane, so the contours of a slice stay together
+    even if the transform tilts the planes slightly.
+    """
+    matrix = np.asarray(matrix, dtype=np.float64)
+    points = np.dot(packed.points, matrix[:3,:3].T) + matrix[:3,3]
+
+    centre = packed.points.mean(axis=0) if len(packed.points) else np.zeros(3)
+    slice_centres = np.column_stack( (np.full(len(packed.z), centre[0]), np.full(len(packed.z), centre[1]), packed.z) )
+    z = np.dot(slice_centres, matrix[2,:3]) + matrix[2,3]
+    return PackedContours(points, packed.offsets, z)
+
+# --------------- #
+
+
+
+def surfaceDisplacement(base_points, exam_points, tree=None):
+    """
+    For every base point, the displacement to the nearest exam point, summarised
+    as SURFACE_KEYS -> float. Points are (N,3) arrays in the same frame; pass a
+    cKDTree of exam_points to reuse it for several base exams.
+    """
+    if tree is None:
+        if cKDTree is None:
+            raise ImportError("scipy is needed for the surface displacement")
+        tree = cKDTree(exam_points)
+    (distance, nearest) = tree.query(base_points)
+    vectors = np.asarray(exam_points)[nearest] - base_points
+
+    (p50, p90, p95) = np.percentile(distance, [50, 90, 95])
+    mean_vector = vectors.mean(axis=0)
+    return { 'mean': float(distance.mean()), 'p50': float(p50), 'p90': float(p90), 'p95': float(p95),
+             'max': float(distance.max()),
+             'dx': float(mean_vector[0]), 'dy': float(mean_vector[1]), 'dz': float(mean_vector[2]) }
+
+# --------------- #
+
+
+
+def isMesh(roiGeom):
+    """
+    True if the geometry is a triangle mesh (Vertices and Triangles) rather than contours
+    """
+    shape = roiGeom.PrimaryShape
+    return not hasattr(shape, "Contours") and hasattr(shape, "Vertices") and hasattr(shape, "Triangles")
+
+# --------------- #
+
+
+
+def meshArrays(roiGeom):
+    """
+    Read a mesh geometry once: (V,3) vertex coordinates and (T,3) vertex
+    indices of every triangle (Triangles may be flat or in triples)
+    """
+    shape = roiGeom.PrimaryShape
+    vertices = np.array( [ (v.x, v.y, v.z) for v in shape.Vertices ], dtype=np.float64 ).reshape(-1, 3)
+    triangles = np.array( list(shape.Triangles), dtype=np.intp ).reshape(-1, 3)
+    return (vertices, triangles)
+
+# --------------- #
+
+
+
+def _joinSegments(start_node, end_node):
+    """
+    Join segments (start_node[i] -> end_node[i]) that share nodes into chains;
+    returns a list of node lists (closed loops are not repeated at the end)
+    """
+    num_segments = len(start_node)
+    ends = np.concatenate( (start_node, end_node) )
+    order = np.argsort(ends, kind='mergesort')
+    first = np.searchsorted(ends[order], np.arange(ends.max() + 1 if num_segments else 0))
+    last = np.searchsorted(ends[order], np.arange(ends.max() + 1 if num_segments else 0), side='right')
+    segment_of = (order % num_segments).tolist() if num_segments else []
+    first = first.tolist();  last = last.tolist()
+    start_node = start_node.tolist();  end_node = end_node.tolist()
+
+    used = [False] * num_segments
+    chains = []
+    for seed in range(num_segments):
+        if used[seed]:
+            continue
+        used[seed] = True
+        chain = [ start_node[seed], end_node[seed] ]
+        node = end_node[seed]
+        while True:
+            following = [ seg for seg in segment_of[first[node]:last[node]] if not used[seg] ]
+            if len(following) == 0:
+                break
+            seg = following[0]
+            used[seg] = True
+            node = end_node[seg] if start_node[seg] == node else start_node[seg]
+            if node == chain[0]:
+                break   # loop closed
+            chain.append( node )
+        chains.append( chain )
+    return chains
+
+# --------------- #
+
+
+
+def sliceMesh(vertices, triangles, planes):
+    """
+    Cut a triangle mesh with the axial planes z = planes and return the
+    polygons found on each plane as PackedContours (in plane order).
+    A vertex lying on a plane counts as above it, so every plane crossing a
+    triangle cuts exactly two of its edges.
+    """
+    planes = np.sort( np.asarray(planes, dtype=np.float64) )
+    num_vertices = len(vertices)
+
+    # Every (triangle, plane) pair with zmin < plane <= zmax
+    tri_z = vertices[triangles, 2]
+    low = np.searchsorted(planes, tri_z.min(axis=1), side='right')
+    high = np.searchsorted(planes, tri_z.max(axis=1), side='right')
+    counts = np.maximum(high - low, 0)
+    tri = np.repeat(np.arange(len(triangles)), counts)
+    plane = low[tri] + np.arange(len(tri)) - np.repeat(np.cumsum(counts) - counts, counts)
+    plane_z = planes[plane]
+
+    # The two edges of each triangle that cross its plane
+    edge_a = triangles[tri][:, [0, 1, 2]]
+    edge_b = triangles[tri][:, [1, 2, 0]]
+    crosses = (vertices[edge_a, 2] < plane_z[:,None]) != (vertices[edge_b, 2] < plane_z[:,None])
+    first_edge = np.argmax(crosses, axis=1)
+    second_edge = 2 - np.argmax(crosses[:, ::-1], axis=1)
+
+    rows = np.arange(len(tri))
+    nodes = []
+    points = []
+    for edge in [first_edge, second_edge]:
+        a = edge_a[rows, edge]
+        b = edge_b[rows, edge]
+        va = vertices[a]
+        vb = vertices[b]
+        t = (plane_z - va[:,2]) / (vb[:,2] - va[:,2])
+        points.append( va[:,:2] + t[:,None] * (vb[:,:2] - va[:,:2]) )
+        # the same mesh edge on the same plane is the same polygon node
+        nodes.append( (plane * num_vertices + np.minimum(a, b)) * num_vertices + np.maximum(a, b) )
+
+    node_keys, node_id = np.unique( np.concatenate(nodes), return_inverse=True )
+    node_id = node_id.reshape(-1)
+    node_points = np.empty( (len(node_keys), 3) )
+    node_points[node_id, :2] = np.concatenate(points)
+    node_points[node_id, 2] = np.concatenate( (plane_z, plane_z) )
+
+    # node keys sort by plane first, so the polygons come out in plane order
+    chains = _joinSegments( node_id[:len(tri)], node_id[len(tri):] )
+    chains.sort( key=lambda chain: (node_points[chain[0], 2], min(chain)) )
+
+    offsets = np.cumsum( [0] + [ len(chain) for chain in chains ] )
+    coords = node_points[ np.concatenate(chains) ] if chains else np.zeros( (0, 3) )
+    return PackedContours(coords, offsets)
+
+# --------------- #
+
+
+
+def packGeometry(roiGeom, interval):
+    """
+    Pack a contour geometry (packContours) or a mesh geometry cut every interval
+    (at the multiples of interval strictly within its z extent)
+    """
+    if not isMesh(roiGeom):
+        return packContours(roiGeom)
+    (vertices, triangles) = meshArrays(roiGeom)
+    if len(triangles) == 0:
+        return PackedContours(np.zeros( (0, 3) ), [0])
+    (z_min, z_max) = (vertices[:,2].min(), vertices[:,2].max())
+    planes = profileGrid(z_min, z_max, interval)
+    planes = planes[ (planes > z_min) & (planes < z_max) ]   # planes touching only the tip of the mesh give no polygon
+    return sliceMesh(vertices, triangles, planes)
+
+# --------------- #
+
+
+
+def contourFingerprint(roiGeom):
+    """
+    Cheap fingerprint of the contours of an ROI geometry: the number of points
+    and the first point of every contour. Used within a run to notice edited
+    contours without reading every point again; it misses edits that keep
+    these, so what is kept between runs uses packedFingerprint.
+    For a mesh: the number of vertices and triangles and the first and last vertex.
+    """
+    if isMesh(roiGeom):
+        vertices = roiGeom.PrimaryShape.Vertices
+        if len(vertices) == 0:
+            return ()
+        first = vertices[0];  last = vertices[len(vertices)-1]
+        return ( len(vertices), len(roiGeom.PrimaryShape.Triangles),
+                 first.x, first.y, first.z, last.x, last.y, last.z )
+    return tuple( (len(con), con[0].x, con[0].y, con[0].z) for con in roiGeom.PrimaryShape.Contours )
+
+
+def packedFingerprint(packed):
+    """
+    Fingerprint of every point of packed contours (SHA-1 of their arrays),
+    so any edit of the contours changes it
+    """
+    digest = hashlib.sha1()
+    digest.update( np.ascontiguousarray(packed.points, dtype=np.float64).tobytes() )
+    digest.update( np.ascontiguousarray(packed.offsets, dtype=np.int64).tobytes() )
+    return digest.hexdigest()
+
+# --------------- #
+
+
+
+def sliceSelection(z_min, z_max, interval):
+    """
+    List of z-coordinates from z_min, every interval, up to (just beyond) z_max
+    """
+    slice_selection = [ ]
+    s = z_min - interval
+    while s < z_max:
+        s = s + interval
+        slice_selection.append( s )
+    return slice_selection
+
+# --------------- #
+
+
+
+def sliceSpacing(index):
+    """
+    Typical (median) z distance between the distinct contoured slices of a
+    SliceIndex in cm, rounded to 0.1 mm (so float noise in the DICOM z values
+    does not leak into the interval); None if there are fewer than two slices
+    """
+    slice_z = index.distinctSlices()
+    if len(slice_z) < 2:
+        return None
+    return round( float(np.median(np.diff(slice_z))), 2 )
+
+# --------------- #
+
+
+
+def collapseDuplicateSlices(index, z_list):
+    """
+    z_list without the positions whose nearest contoured slice (in a SliceIndex)
+    is the same as that of an earlier position (so each slice is only processed once)
+    """
+    slice_z = index.distinctSlices()
+    if len(slice_z) == 0:
+        return list(z_list)
+    anchors = index.nearestContours(z_list)
+    slice_of = np.searchsorted(slice_z, index.contour_z[anchors] + SAME_SLICE_TOLERANCE / 2.0, side='right') - 1
+    first = np.unique(slice_of, return_index=True)[1]
+    return [ z_list[i] for i in sorted(first.tolist()) ]
+
+
+def previewIndices(num_slices, every):
+    """
+    Indices of a coarse subset of num_slices sampled slices: every nth one,
+    plus the last, so both ends of the ROI are kept
+    """
+    indices = list(range(0, num_slices, every))
+    if num_slices > 0 and indices[-1] != num_slices - 1:
+        indices.append( num_slices - 1 )
+    return indices
+
+# --------------- #
+
+
+
+def findNearestContours(packed, z_list):
+    """
+    Return index of the contour closest in z to each requested z position
+    (the first such contour when several are equally close)
+    """
+    return packed.sliceIndex.nearestContours(z_list)
+
+# --------------- #
+
+
+
+def groupSlices(packed, anchors):
+    """
+    Gather the points of every slice group
+    A group is all contours within SAME_SLICE_TOLERANCE of an anchor contour,
+    one group per distinct anchor. Returns:
+        group_of_slice : (S,) group used for each entry of anchors
+        point_index    : indices into packed.points of every grouped point
+        point_group    : group label of each entry of point_index
+    """
+    unique_anchors, group_of_slice = np.unique(anchors, return_inverse=True)
+
+    point_index = []
+    point_group = []
+    for (g, anchor) in enumerate(unique_anchors):
+        for c in packed.sliceIndex.sameSliceContours(anchor):
+            idx = np.arange(packed.offsets[c], packed.offsets[c+1])
+            point_index.append( idx )
+            point_group.append( np.full(len(idx), g, dtype=np.intp) )
+
+    if len(point_index) == 0:
+        return group_of_slice, np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp)
+    return group_of_slice, np.concatenate(point_index), np.concatenate(point_group)
+
+# --------------- #
+
+
+
+def _firstExtremeIndex(values, group_starts, largest):
+    """
+    Position (in values) of the first minimum, or maximum, of each group
+    Values must be ordered by group, group g starting at group_starts[g]
+    """
+    reduce = np.maximum.reduceat if largest else np.minimum.reduceat
+    extreme = reduce(values, group_starts)
+    sizes = np.diff( np.append(group_starts, len(values)) )
+    hits = np.flatnonzero( values == np.repeat(extreme, sizes) )
+    return hits[ np.searchsorted(hits, group_starts) ]
+
+# --------------- #
+
+
+
+def groupExtremeIndices(points, group_starts):
+    """
+    Index into points of the R (min x), L (max x), A (min y) and P (max y)
+    point of each group. Points must be ordered by group, as groupSlices
+    returns them, group g starting at group_starts[g]; every group must have
+    at least one point.
+    """
+    return { 'R': _firstExtremeIndex(points[:,0], group_starts, False),
+             'L': _firstExtremeIndex(points[:,0], group_starts, True),
+             'A': _firstExtremeIndex(points[:,1], group_starts, False),
+             'P': _firstExtremeIndex(points[:,1], group_starts, True) }
+
+# --------------- #
+
+
+
+def directionVectors(num_directions):
+    """
+    num_directions in-plane unit vectors, equally spaced in angle, as a
+    (K,2) array. Angles are measured from +x (patient left) towards +y
+    (posterior), so 0 = L, 90 = P, 180 = R and 270 = A.
+    """
+    angles = 2.0 * np.pi * np.arange(num_directions) / num_directions
+    vectors = np.column_stack( (np.cos(angles), np.sin(angles)) )
+    vectors[ np.abs(vectors) < 1E-12 ] = 0.0   # exact axes at multiples of 90 degrees
+    return vectors
+
+
+def directionLabels(directions):
+    """
+    Column name of each direction vector: 'D' followed by its angle in degrees
+    """
+    angles = np.degrees( np.arctan2(directions[:,1], directions[:,0]) ) % 360.0
+    return [ 'D{:g}'.format(round(angle, 6)) for angle in angles ]
+
+# --------------- #
+
+
+
+def groupDirectionalExtremes(points, group_starts, directions):
+    """
+    Largest projection of the points of each group onto each direction,
+    as a (G,K) array. Points must be ordered by group, group g starting at
+    group_starts[g]; every group must have at least one point.
+    """
+    projections = np.dot( points[:,:2], directions.T )
+    return np.maximum.reduceat(projections, group_starts, axis=0)
+
+# --------------- #
+
+
+
+def contourShapeArrays(packed):
+    """
+    Shoelace reductions over every contour of packed (closed polygons), as (C,) arrays:
+        area2     : twice the signed area
+        cx6, cy6  : sums giving the centroid, C = (cx6, cy6) / (3 * area2)
+        perimeter : length of the closed contour
+        sx, sy, n : sums of the point coordinates and number of points
+    """
+    x = packed.points[:,0]
+    y = packed.points[:,1]
+    starts = packed.offsets[:-1]
+
+    # next point of every point, wrapping round at the end of each contour
+    following = np.arange(1, len(x) + 1)
+    following[ packed.offsets[1:] - 1 ] = starts
+    x_next = x[following]
+    y_next = y[following]
+
+    cross = x * y_next - x_next * y
+    return { 'area2': np.add.reduceat(cross, starts),
+             'cx6': np.add.reduceat((x + x_next) * cross, starts),
+             'cy6': np.add.reduceat((y + y_next) * cross, starts),
+             'perimeter': np.add.reduceat(np.hypot(x_next - x, y_next - y), starts),
+             'sx': np.add.reduceat(x, starts),
+             'sy': np.add.reduceat(y, starts),
+             'n': np.diff(packed.offsets).astype(np.float64) }
+
+# --------------- #
+
+
+
+def sliceShapeArrays(packed, anchors, refX, refY):
+    """
+    Area, perimeter and centroid (C.x, C.y -> (S,) arrays) of the slice group
+    of each anchor contour. All contours of a slice are treated as separate
+    islands: their areas and perimeters are added and the centroid is the area
+    weighted mean of theirs (the mean of the points if the slice has no area).
+    """
+    unique_anchors, group_of_slice = np.unique(anchors, return_inverse=True)
+    num_groups = len(unique_anchors)
+
+    contour_ids = []
+    contour_group = []
+    for (g, anchor) in enumerate(unique_anchors):
+        members = packed.sliceIndex.sameSliceContours(anchor)
+        contour_ids.extend( members )
+        contour_group.extend( [g] * len(members) )
+    if len(contour_ids) == 0:
+        return dict( (key, np.zeros(0)) for key in ['area', 'perimeter', 'C.x', 'C.y'] )
+    contour_ids = np.asarray(contour_ids, dtype=np.intp)
+    contour_group = np.asarray(contour_group, dtype=np.intp)
+
+    shapes = contourShapeArrays(packed)
+    def groupSum(values):
+        return np.bincount(contour_group, weights=values[contour_ids], minlength=num_groups)
+
+    area2 = shapes['area2']
+    weight = np.abs(area2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cx = np.where(area2 != 0, shapes['cx6'] / (3.0 * area2), 0.0)
+        cy = np.where(area2 != 0, shapes['cy6'] / (3.0 * area2), 0.0)
+
+    area = groupSum(weight) / 2.0
+    has_area = area > 0
+    safe_area = np.where(has_area, area, 1.0)
+    num_points = groupSum(shapes['n'])
+    centroid_x = np.where(has_area, groupSum(weight * cx) / 2.0 / safe_area, groupSum(shapes['sx']) / num_points)
+    centroid_y = np.where(has_area, groupSum(weight * cy) / 2.0 / safe_area, groupSum(shapes['sy']) / num_points)
+
+    arrays = { 'area': area, 'perimeter': groupSum(shapes['perimeter']),
+               'C.x': centroid_x - refX, 'C.y': centroid_y - refY }
+    return dict( (key, values[group_of_slice]) for (key, values) in arrays.items() )
+
+# --------------- #
+
+
+
+def _relativeExtremes(points, ext_index, refX, refY, refZ):
+    """
+    Coordinates of the indexed extreme points wrt reference coords,
+    as dictionary of EXTREME_KEYS -> arrays
+    """
+    ref = np.array([refX, refY, refZ], dtype=np.float64)
+    arrays = {}
+    for direction in ['R', 'L', 'A', 'P']:
+        ext_pts = points[ ext_index[direction] ] - ref
+        arrays[direction+'.x'] = ext_pts[:,0]
+        arrays[direction+'.y'] = ext_pts[:,1]
+        arrays[direction+'.z'] = ext_pts[:,2]
+
+    return arrays
+
+# --------------- #
+
+
+
+def extremePointArrays(packed, z_list, refX, refY, refZ, directions=None, shape=False):
+    """
+    Extreme R/L/A/P coordinates for every requested slice, wrt reference coords
+    Returns dictionary of EXTREME_KEYS -> (S,) arrays
+    If directions (see directionVectors) are given, the extreme distance
+    along each of them (wrt the reference) is added under directionLabels
+    If shape is True the SHAPE_KEYS descriptors of every slice are added
+    """
+    anchors = findNearestContours(packed, z_list)
+    group_of_slice, point_index, point_group = groupSlices(packed, anchors)
+
+    slice_points = packed.points[point_index]
+    num_groups = int(group_of_slice.max()) + 1 if len(group_of_slice) else 0
+    group_starts = np.searchsorted(point_group, np.arange(num_groups))
+    if num_groups > 0:
+        ext_index = groupExtremeIndices(slice_points, group_starts)
+        for direction in ext_index:
+            ext_index[direction] = ext_index[direction][group_of_slice]
+    else:
+        ext_index = dict( (direction, np.zeros(0, dtype=np.intp)) for direction in ['R', 'L', 'A', 'P'] )
+
+    arrays = _relativeExtremes(slice_points, ext_index, refX, refY, refZ)
+
+    if directions is not None and num_groups > 0:
+        ref_projection = np.dot( directions, [refX, refY] )
+        extremes = groupDirectionalExtremes(slice_points, group_starts, directions) - ref_projection
+        for (k, label) in enumerate(directionLabels(directions)):
+            arrays[label] = extremes[group_of_slice, k]
+    elif directions is not None:
+        for label in directionLabels(directions):
+            arrays[label] = np.zeros(0)
+
+    if shape:
+        arrays.update( sliceShapeArrays(packed, anchors, refX, refY) )
+        # bounding box of the slice, from its extreme points
+        arrays['width'] = slice_points[ext_index['L'], 0] - slice_points[ext_index['R'], 0]
+        arrays['height'] = slice_points[ext_index['P'], 1] - slice_points[ext_index['A'], 1]
+
+    return arrays
+
+# --------------- #
+
+
+
+class SliceProfile(object):
+    """
+    Values of every distinct contoured slice of an ROI along z
+        z      : (M,) increasing slice positions (wrt the reference z)
+        arrays : dictionary of key -> (M,) values (as extremePointArrays)
+    """
+
+    def __init__(self, z, arrays):
+        self.z = np.asarray(z, dtype=np.float64)
+        self.arrays = arrays
+
+    def __len__(self):
+        return len(self.z)
+
+    def limits(self):
+        """(lowest, highest) z of the profile"""
+        return (self.z[0], self.z[-1])
+
+    def interpolate(self, z_grid, keys):
+        """
+        Values of keys linearly interpolated at every z of z_grid
+        (values beyond the ends of the profile are those of the end slices)
+        """
+        return dict( (key, np.interp(z_grid, self.z, self.arrays[key])) for key in keys )
+
+# --------------- #
+
+
+
+def sliceProfile(packed, refX, refY, refZ, directions=None, shape=False):
+    """
+    SliceProfile of every distinct contoured slice of packed, wrt reference coords;
+    each slice is handled once, however many grid positions it is used for
+    """
+    slice_z = packed.sliceIndex.distinctSlices()
+    arrays = extremePointArrays(packed, slice_z, refX, refY, refZ, directions, shape)
+    return SliceProfile(slice_z - refZ, arrays)
+
+# --------------- #
+
+
+
+def profileGrid(z_low, z_high, interval):
+    """
+    Common z grid: every multiple of interval from z_low to z_high (inclusive)
+    """
+    first = np.ceil(z_low / interval - 1E-9)
+    last = np.floor(z_high / interval + 1E-9)
+    return np.arange(first, last + 1) * interval
+
+# --------------- #
+
+
+
+def arraysToDicts(arrays, keys=EXTREME_KEYS):
+    """
+    Convert dictionary of per-slice arrays into a list of per-slice dictionaries
+    of python floats (so that str() formatting is unchanged)
+    """
+    columns = [ arrays[key].tolist() for key in keys ]
+    return [ dict(zip(keys, row)) for row in zip(*columns) ]
+
+# --------------- #
+
+
+
+def findExtremePointsForSlices(packed, z_list, refX, refY, refZ, directions=None, shape=False):
+    """
+    List of extreme point dictionaries (as findExtremePoints_2) for every
+    requested z position, including the directional extremes if directions
+    are given and the shape descriptors if shape is True
+    """
+    keys = list(EXTREME_KEYS)
+    if directions is not None:
+        keys += directionLabels(directions)
+    if shape:
+        keys += SHAPE_KEYS
+    return arraysToDicts( extremePointArrays(packed, z_list, refX, refY, refZ, directions, shape), keys )
+
+# --------------- #
+
+
+
+def extremePointRecords(packed, z_list, refX, refY, refZ, directions=None, shape=False, keys=None):
+    """
+    As findExtremePointsForSlices, but as SliceRecords (of keys, if given);
+    the z of every slice wrt refZ is included as 'z'
+    """
+    arrays = extremePointArrays(packed, z_list, refX, refY, refZ, directions, shape)
+    arrays['z'] = np.asarray(z_list, dtype=np.float64) - refZ
+    if keys is None:
+        keys = ['z'] + list(EXTREME_KEYS)
+        if directions is not None:
+            keys += directionLabels(directions)
+        if shape:
+            keys += SHAPE_KEYS
+    return SliceRecords.fromArrays(arrays, keys)
+
+# --------------- #
+
+
+
+def findExtremePoints(contour_list, refX, refY, refZ):
+    """
+    Extreme points of a list of contours all lying on the same slice
+    """
+    packed = packContourList(contour_list)
+    ext_index = groupExtremeIndices(packed.points, np.zeros(1, dtype=np.intp))
+
+    return arraysToDicts( _relativeExtremes(packed.points, ext_index, refX, refY, refZ) )[0]
@@ -0,0 +1,200 @@
+"""
+Batch runner for the motionByPoints scripts
+
+Runs the motion analysis of one of the scripts (motionByPoints by default) for
+a list of patients, loading each from the patient database in turn, rather
+than only for the patient that is open.
+
+Progress is kept in a JSON job file: the status ('pending', 'running', 'done'
+or 'failed'), run time and error of every patient/case. The file is rewritten
+after each patient, so a batch that was stopped carries on where it left off
+when run again: patients already done are skipped, and a patient that was
+interrupted part way is resumed (the ROI/exam pairs it wrote are kept).
+A patient that cannot be analysed (not in the database, unknown case, an
+error in the analysis) is marked failed, its traceback is appended to the log
+file (<job file>.log) and the batch moves on to the next patient. Failed
+patients are only tried again with retry_failed=True.
+
+The script writes one export per patient ID, so list only one case of each patient.
+
+The patient list file has one patient per line: the patient ID, optionally
+followed by a comma and the case name (needed if the patient has several
+cases); blank lines and lines starting with # are ignored.
+
+to run type:
+    from rmhTools.roiTools import motionBatch
+    motionBatch.main()                                        # patients in PATIENT_LIST_FILE
+or:
+    motionBatch.runBatch( [ '1234567', ('7654321', 'CASE 2') ] )
+    motionBatch.runBatch( patients, script=motionByPoints_multiPlan, retry_failed=True )
+"""
+
+import os
+import json
+import time
+import traceback
+
+try:
+    import connect as rsl
+except ImportError:
+    rsl = None    # outside RayStation: give runBatch a patient_db
+
+# --------------- #
+
+
+# Directory holding the patient list and the job file
+dataPath = os.path.join(r'\\rtp-bridge2-rt.ad.rmh.nhs.uk\IntoSecure\ICR',os.environ.get('USERNAME',''),'RayStationExport')
+
+PATIENT_LIST_FILE = 'motionBatch_patients.txt'
+JOB_FILE = 'motionBatch_jobs.json'
+LOG_SUFFIX = '.log'
+
+# Save each patient after its analysis (needed to keep marker POIs, see motionEngine.SHOW_EXTREME_MARKERS)
+SAVE_PATIENTS = False
+
+
+# --------------- #
+
+def readPatientList(filename):
+    """
+    Read a patient list file; returns [(patient_id, case_name or None)]
+    """
+    patients = []
+    with open(filename, 'r') as fp:
+        for line in fp:
+            line = line.strip()
+            if len(line) == 0 or line.startswith('#'):
+                continue
+            fields = [ field.strip() for field in line.split(',', 1) ]
+            patients.append( (fields[0], fields[1] if len(fields) > 1 and fields[1] else None) )
+    return patients
+
+
+def loadPatientCase(patient_db, patient_id, case_name=None):
+    """
+    Load a patient from the database and return (patient, case); raises
+    LookupError if the patient or case is not found
+    """
+    infos = patient_db.QueryPatientInfo(Filter={'PatientID': patient_id})
+    if len(infos) == 0:
+        raise LookupError("Patient {} not found in the database".format(patient_id))
+    if len(infos) > 1:
+        print("---> WARNING: {} patients found with ID {}; using the first".format(len(infos), patient_id) )
+    patient = patient_db.LoadPatient(PatientInfo=infos[0], AllowPatientUpgrade=True)
+
+    cases = [ case for case in patient.Cases ]
+    if case_name is None:
+        if len(cases) != 1:
+            raise LookupError("Patient {} has {} cases; give the case name".format(patient_id, len(cases)))
+        case = cases[0]
+    else:
+        matches = [ case for case in cases if case.CaseName == case_name ]
+        if len(matches) == 0:
+            raise LookupError("Patient {} has no case {}".format(patient_id, case_name))
+        case = matches[0]
+    case.SetCurrent()
+    return (patient, case)
+
+# --------------- #
+
+
+
+class JobFile(object):
+    """
+    Status of every patient/case of a batch, kept in a JSON file
+    """
+
+    def __init__(self, filename, patients):
+        self.filename = filename
+        self.jobs = []
+
+        if os.path.exists(filename):
+            with open(filename, 'r') as fp:
+                self.jobs = json.load(fp)['jobs']
+        known = set( [ (job['patient_id'], job['case']) for job in self.jobs ] )
+        for (patient_id, case_name) in patients:
+            if (patient_id, case_name) not in known:
+                self.jobs.append( {'patient_id': patient_id, 'case': case_name, 'status': 'pending',
+                                   'seconds': None, 'error': None, 'finished': None} )
+                known.add( (patient_id, case_name) )
+
+    def toRun(self, retry_failed=False):
+        """Jobs still to do, in list order"""
+        statuses = ['pending', 'running'] + (['failed'] if retry_failed else [])
+        return [ job for job in self.jobs if job['status'] in statuses ]
+
+    def update(self, job, status, seconds=None, error=None):
+        job['status'] = status
+        job['seconds'] = seconds
+        job['error'] = error
+        job['finished'] = None if status == 'running' else time.strftime('%Y-%m-%d %H:%M:%S')
+        self.save()
+
+    def summary(self):
+        counts = {}
+        for job in self.jobs:
+            counts[job['status']] = counts.get(job['status'], 0) + 1
+        return counts
+
+    def save(self):
+        # written to a temporary file first, so an interruption never leaves half a job file
+        with open(self.filename + '.tmp', 'w') as fp:
+            json.dump( {'jobs': self.jobs}, fp, indent=1 )
+        os.replace(self.filename + '.tmp', self.filename)
+
+# --------------- #
+
+
+
+def runBatch(patients, script=None, job_filename=None, incremental=False, retry_failed=False,
+             save_patients=SAVE_PATIENTS, patient_db=None):
+    """
+    Run script.analyseCase on every patient (patient IDs, or (patient_id, case_name)
+    tuples) not yet done in the job file; returns the JobFile
+    """
+    if script is None:
+        from . import motionByPoints as script
+    if job_filename is None:
+        job_filename = os.path.join(dataPath, JOB_FILE)
+    if patient_db is None:
+        patient_db = rsl.get_current('PatientDB')
+
+    patients = [ (p, None) if isinstance(p, str) else tuple(p) for p in patients ]
+    jobs = JobFile(job_filename, patients)
+    to_run = jobs.toRun(retry_failed)
+    print("Patients to analyse: {} (of {})".format(len(to_run), len(jobs.jobs)) )
+
+    for (n, job) in enumerate(to_run):
+        print("=== {} {} ({}/{})".format(job['patient_id'], job['case'] or '', n+1, len(to_run)) )
+        # a job left 'running' was interrupted: keep the ROI/exam pairs it wrote
+        resume = job['status'] == 'running'
+        jobs.update(job, 'running')
+
+        start = time.time()
+        try:
+            (patient, case) = loadPatientCase(patient_db, job['patient_id'], job['case'])
+            script.analyseCase(patient, case, resume=resume, incremental=incremental)
+            if save_patients:
+                patient.Save()
+        except Exception as err:
+            print("---> WARNING: {} failed: {}".format(job['patient_id'], err) )
+            with open(job_filename + LOG_SUFFIX, 'a') as fp:
+                fp.write( "{} {} {}\n".format(time.strftime('%Y-%m-%d %H:%M:%S'), job['patient_id'], job['case'] or '') )
+                fp.write( traceback.format_exc() + '\n' )
+            jobs.update(job, 'failed', time.time() - start, str(err))
+            continue
+        jobs.update(job, 'done', time.time() - start)
+
+    print("Batch finished: {}".format(jobs.summary()) )
+    return jobs
+
+# --------------- #
+
+
+
+def main(script=None, incremental=False, retry_failed=False):
+    """
+    Run the batch over the patients in PATIENT_LIST_FILE
+    """
+    patients = readPatientList( os.path.join(dataPath, PATIENT_LIST_FILE) )
+    return runBatch(patients, script, incremental=incremental, retry_failed=retry_failed)
@@ -0,0 +1,314 @@
+"""
+Motion time series with drift detection, per patient
+
+The motion csv of a patient (see motionEngine) has one block of rows per ROI
+and exam. Here every exam is reduced to one value per ROI and direction (the
+mean displacement over its slices: a fraction mean), the exams are ordered
+by acquisition date, and each series is checked for
+    step     a shift of the fraction means away from those before it:
+             two-sided tabular CUSUM of the fraction means standardised by
+             the mean and SD of the earlier fractions (self-starting: the
+             first BASELINE_FRACTIONS fractions, then every fraction up to
+             the first step flag), which flags once the cumulative excess
+             beyond CUSUM_ALLOWANCE exceeds CUSUM_THRESHOLD (both in SDs)
+    trend    a systematic drift with time: least squares slope of the fraction
+             means against days since the first fraction, flagged when its
+             t-statistic exceeds TREND_T (from MIN_TREND_FRACTIONS fractions)
+             and the fitted change over the series exceeds TREND_MIN_CHANGE SDs
+The SD is floored at MIN_SIGMA, so a series of (nearly) identical fractions
+does not flag shifts too small to matter. With these settings about 1 in 20
+series of 35 fractions of pure noise raises a step flag.
+Both tests are online: they keep running sums only, updated with one new
+fraction at a time. The detector state is saved next to the csv
+(<filename>.drift.json), so when a new CBCT is analysed only that fraction is
+added. If earlier fractions have changed (re-contoured, a new exam dated
+before the last one, changed settings) the series are rebuilt.
+
+A series is kept per ROI and base exam, so exams compared to a new planning
+scan (motionByPoints_multiPlan) start a new series.
+
+All fractions are written to <filename>_DRIFT.csv (one row per ROI, exam and
+direction) with the test statistics and a flag ('step', 'trend' or both);
+new flags are printed as warnings: candidates for a replan.
+
+to use (done by motionEngine.MotionAnalysis.run with drift=True):
+    from rmhTools.roiTools import motionDrift
+    motionDrift.updateDrift(filename, header, [(exam_name, date, base_name), ...])
+"""
+
+import os
+import json
+import math
+import datetime
+
+from . import motionOutput
+
+# --------------- #
+
+
+DRIFT_SUFFIX = '_DRIFT.csv'
+STATE_SUFFIX = '.drift.json'
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'   # as motionEngine.getExamDate
+
+# Fractions whose mean and SD are the first reference of the step test (at least 2)
+BASELINE_FRACTIONS = 5
+MIN_SIGMA = 0.05         # cm; floor of the SD the fraction means are standardised by
+CUSUM_ALLOWANCE = 0.5    # SDs; shifts smaller than this are not accumulated
+CUSUM_THRESHOLD = 5.0    # SDs
+
+MIN_TREND_FRACTIONS = 8
+TREND_T = 4.0
+TREND_MIN_CHANGE = 1.0   # SDs
+
+
+# --------------- #
+
+def settings():
+    """Detector settings; a change of these rebuilds every series"""
+    return {'baseline': BASELINE_FRACTIONS, 'min_sigma': MIN_SIGMA, 'allowance': CUSUM_ALLOWANCE,
+            'threshold': CUSUM_THRESHOLD, 'min_trend': MIN_TREND_FRACTIONS, 'trend_t': TREND_T,
+            'trend_change': TREND_MIN_CHANGE}
+
+
+def fractionMeans(lines, header):
+    """
+    Mean of every displacement column over the csv rows of one ROI/exam:
+    {column: mean}
+    """
+    names = header.strip().split(',')
+    columns = [ (i, col) for (i, col) in enumerate(names) if i >= 2 and col not in motionOutput.POSITION_COLUMNS ]
+    sums = dict( (col, 0.0) for (i, col) in columns )
+    for line in lines:
+        fields = line.strip().split(',')
+        for (i, col) in columns:
+            sums[col] += float(fields[i])
+    return dict( (col, sums[col] / len(lines)) for col in sums )
+
+
+def normalScore(t, dof):
+    """
+    Standard normal score with the same tail probability as t of a Student t
+    distribution with dof degrees of freedom (Wallace's approximation)
+    """
+    return math.copysign( (8.0 * dof + 1) / (8.0 * dof + 3) * math.sqrt(dof * math.log(1.0 + t * t / dof)), t )
+
+# --------------- #
+
+
+
+class DriftDetector(object):
+    """
+    Online step (self-starting CUSUM) and trend (least squares slope) test of
+    one series of fraction means; update with each new fraction in date order
+    """
+
+    def __init__(self, n=0, baseline_n=0, baseline_sum=0.0, baseline_sumsq=0.0, in_control=True,
+                 cusum_pos=0.0, cusum_neg=0.0, sum_t=0.0, sum_x=0.0, sum_tt=0.0, sum_tx=0.0, sum_xx=0.0, flag=''):
+        self.n = n
+        self.baseline_n = baseline_n          # fractions the step test is referenced to
+        self.baseline_sum = baseline_sum
+        self.baseline_sumsq = baseline_sumsq
+        self.in_control = in_control          # False from the first step flag: the reference is kept
+        self.cusum_pos = cusum_pos
+        self.cusum_neg = cusum_neg
+        self.sum_t = sum_t
+        self.sum_x = sum_x
+        self.sum_tt = sum_tt
+        self.sum_tx = sum_tx
+        self.sum_xx = sum_xx
+        self.flag = flag    # flag after the last fraction
+
+    def update(self, t, x):
+        """
+        Add the fraction mean x at time t (days); returns the test statistics
+        {'sigma', 'cusum_pos', 'cusum_neg', 'slope', 'trend_t', 'flag'} after this
+        fraction (sigma: the SD of the reference fractions, None until there are
+        BASELINE_FRACTIONS of them)
+        """
+        self.n += 1
+        self.sum_t += t
+        self.sum_x += x
+        self.sum_tt += t * t
+        self.sum_tx += t * x
+        self.sum_xx += x * x
+
+        # Step: CUSUM of the shift from the mean of the reference fractions, in SDs
+        #   (the t-statistic of a new value, converted to a normal score)
+        sigma = self.sigma()
+        if sigma is not None:
+            mean = self.baseline_sum / self.baseline_n
+            z = normalScore( (x - mean) / (sigma * math.sqrt(1.0 + 1.0 / self.baseline_n)), self.baseline_n - 1 )
+            self.cusum_pos = max(0.0, self.cusum_pos + z - CUSUM_ALLOWANCE)
+            self.cusum_neg = max(0.0, self.cusum_neg - z - CUSUM_ALLOWANCE)
+        step = max(self.cusum_pos, self.cusum_neg) > CUSUM_THRESHOLD
+        self.in_control = self.in_control and not step
+        if self.in_control:
+            self.baseline_n += 1
+            self.baseline_sum += x
+            self.baseline_sumsq += x * x
+
+        # Trend: slope and its t-statistic from the running sums
+        (slope, trend_t) = (0.0, 0.0)
+        s_tt = self.sum_tt - self.sum_t * self.sum_t / self.n
+        if self.n > 2 and s_tt > 0:
+            s_tx = self.sum_tx - self.sum_t * self.sum_x / self.n
+            s_xx = self.sum_xx - self.sum_x * self.sum_x / self.n
+            slope = s_tx / s_tt
+            residual_var = max(0.0, s_xx - slope * s_tx) / (self.n - 2)
+            trend_t = slope / max(math.sqrt(residual_var / s_tt), 1E-12)
+
+        flags = []
+        if step:
+            flags.append('step')
+        if ( sigma is not None and self.n >= MIN_TREND_FRACTIONS and abs(trend_t) > TREND_T and
+             abs(slope) * math.sqrt(s_tt * 12.0 / self.n) > TREND_MIN_CHANGE * sigma ):
+            # sqrt(12 s_tt / n) is the span of n equally spaced times
+            flags.append('trend')
+
+        self.flag = '+'.join(flags)
+        return {'sigma': sigma, 'cusum_pos': self.cusum_pos, 'cusum_neg': self.cusum_neg,
+                'slope': slope, 'trend_t': trend_t, 'flag': self.flag}
+
+    def sigma(self):
+        """SD of the reference fractions (at least MIN_SIGMA); None until there are BASELINE_FRACTIONS"""
+        if self.baseline_n < BASELINE_FRACTIONS:
+            return None
+        variance = (self.baseline_sumsq - self.baseline_sum**2 / self.baseline_n) / (self.baseline_n - 1)
+        return max( math.sqrt(max(0.0, variance)), MIN_SIGMA )
+
+    def toDict(self):
+        return dict(self.__dict__)
+
+# --------------- #
+
+
+
+class DriftMonitor(object):
+    """
+    Drift detectors of every series (ROI and base exam) of one patient, one per
+    column, kept in a JSON state file between runs
+    """
+
+    def __init__(self, state_filename):
+        self.state_filename = state_filename
+        self.series = {}       # roi|base -> {'fractions': [...], 'rows': [...]} in the order added
+        self.detectors = {}    # roi|base|column -> DriftDetector
+
+        if os.path.exists(state_filename):
+            try:
+                with open(state_filename, 'r') as fp:
+                    state = json.load(fp)
+            except ValueError:
+                print("---> WARNING: Could not read {}; rebuilding the drift series".format(state_filename) )
+                return
+            if state.get('settings') == settings():
+                self.series = state['series']
+                for entry in state['detectors']:
+                    self.detectors[ entry['key'] ] = DriftDetector(**entry['detector'])
+
+    def update(self, fractions):
+        """
+        Bring the series up to date with fractions ([roi, base, exam, date, day, means],
+        in date order within each series); only fractions after those already added
+        to a series are fed to its detectors, unless its earlier ones have changed.
+        Returns the flags raised or changed as (roi, exam, column, flag)
+        """
+        fractions = json.loads( json.dumps(fractions) )   # as read back from the state file
+        by_series = {}
+        for fraction in fractions:
+            by_series.setdefault( fraction[0] + '|' + fraction[1], [] ).append( fraction )
+
+        new_flags = []
+        for key in by_series:
+            series = self.series.get(key)
+            if series is None or series['fractions'] != by_series[key][:len(series['fractions'])]:
+                if series is not None:
+                    print("... earlier fractions of {} have changed; rebuilding its drift series".format(key) )
+                series = self.series[key] = {'fractions': [], 'rows': []}
+                for col in list(self.detectors):
+                    if col.startswith(key + '|'):
+                        del self.detectors[col]
+
+            for fraction in by_series[key][len(series['fractions']):]:
+                (roi, base, exam, date, day, means) = fraction
+                for col in sorted(means):
+                    detector = self.detectors.setdefault( key + '|' + col, DriftDetector() )
+                    previous_flag = detector.flag
+                    result = detector.update(day, means[col])
+                    series['rows'].append( [roi, base, exam, date, day, col, means[col], result['sigma'], result['cusum_pos'],
+                                            result['cusum_neg'], result['slope'], result['trend_t'], result['flag']] )
+                    if result['flag'] and result['flag'] != previous_flag:
+                        new_flags.append( (roi, exam, col, result['flag']) )
+                series['fractions'].append( fraction )
+
+        # series no longer in the output (e.g. ROI removed)
+        for key in [ key for key in self.series if key not in by_series ]:
+            del self.series[key]
+            for col in list(self.detectors):
+                if col.startswith(key + '|'):
+                    del self.detectors[col]
+        return new_flags
+
+    def save(self):
+        state = {'settings': settings(), 'series': self.series,
+                 'detectors': [ {'key': key, 'detector': self.detectors[key].toDict()}
+                                for key in sorted(self.detectors) ]}
+        with open(self.state_filename, 'w') as fp:
+            json.dump(state, fp)
+
+    def writeTable(self, filename):
+        with open(filename, 'w') as fp:
+            fp.write('roi,base,exam,date,day,direction,mean,sigma,cusum_pos,cusum_neg,slope,trend_t,flag\n')
+            for key in self.series:
+                for row in self.series[key]['rows']:
+                    fp.write( ','.join([ '' if value is None else str(value) for value in row ]) + '\n' )
+
+# --------------- #
+
+
+
+def _days(first_date, date):
+    """Days from first_date to date"""
+    return ( datetime.datetime.strptime(date, DATE_FORMAT) -
+             datetime.datetime.strptime(first_date, DATE_FORMAT) ).total_seconds() / 86400.0
+
+
+def updateDrift(filename, header, exams):
+    """
+    Update the drift series of a patient from its motion csv (filename, with
+    header) and write <filename>_DRIFT.csv.
+    exams: (exam_name, date, base_name) of every exam compared to a base exam,
+    date as DATE_FORMAT; if any date is unknown (None) the exams are taken in
+    the given order, one day apart. Returns the new flags as (roi, exam, column, flag).
+    """
+    use_dates = all([ date is not None for (name, date, base) in exams ])
+    if use_dates:
+        # sort is stable: exams acquired at the same time keep their order
+        exams = sorted( exams, key=lambda exam: exam[1] )
+
+    pairs = motionOutput.readPairLines(filename, header)
+    rois = []
+    for (roi, exam_name) in pairs:
+        if roi not in rois:
+            rois.append( roi )
+
+    fractions = []
+    for roi in rois:
+        first = {}    # base -> (date, number) of the first fraction of the series
+        for (exam_name, date, base_name) in exams:
+            lines = pairs.get( (roi, exam_name) )
+            if not lines:
+                continue
+            (first_date, number) = first.setdefault( base_name, (date, 0) )
+            day = _days(first_date, date) if use_dates else float(number)
+            first[base_name] = (first_date, number + 1)
+            fractions.append( [roi, base_name, exam_name, date, day, fractionMeans(lines, header)] )
+
+    monitor = DriftMonitor(filename + STATE_SUFFIX)
+    new_flags = monitor.update(fractions)
+    monitor.save()
+    monitor.writeTable( os.path.splitext(filename)[0] + DRIFT_SUFFIX )
+
+    for (roi, exam_name, col, flag) in new_flags:
+        print("---> WARNING: {} drift of {} {} at {}".format(flag, roi, col, exam_name) )
+    return new_flags
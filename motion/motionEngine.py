@@ -0,0 +1,1402 @@
+"""
+Motion analysis engine behind the motionByPoints scripts
+Target motion based on bony landmarks
+
+For every ROI and exam the R/L/A/P extreme points of each sampled slice are
+found (wrt the SP/RFH reference points of that exam) and compared to the
+closest slice of a base exam. The scripts only differ in how the base exam of
+each exam is chosen, which is done by a base-exam strategy:
+    PlanningNameBase       the exam called "Planning CT"            (motionByPoints)
+    FrameOfReferenceBase   the planning scan sharing the exam's
+                           FrameOfReference                         (motionByPoints_multiPlan)
+    NamedExamBase          a user chosen BASE_EXAMINATION           (motionByPoints_MRI)
+The options of the scripts are defined (with their defaults) here, and
+analyseCase runs the analysis of a case with the settings of a script.
+
+Contours and reference data are read through an ExtractionCache, so each
+ROI geometry is read from RayStation once per run and each base-exam
+reference is built once, however many exams are compared to it. Output rows
+are streamed to disk per ROI/exam (motionOutput), so an interrupted run can
+be resumed, and can also be written in a typed columnar form for cohort analysis.
+With registration=True each exam is moved onto its base exam by its rigid
+registration instead of being referenced to the SP/RFH points, which then
+need not be placed at all.
+With incremental=True only ROI/exam pairs that are new or whose contours or
+reference points have changed since the last incremental run are analysed again.
+Extreme points can be shown as marker POIs for visual QA (PoiWriter); they
+are collected during the run and created in one composite action at the end.
+With workers > 1 the ROI/exam pairs are computed in a pool of worker processes
+(computePairLines) while the contours of the next pairs are read from
+RayStation; the output is the same as that of a serial run.
+With preview steps a quick, coarse pass over every nth slice (and both ends
+of each ROI) is written to <filename>_PREVIEW.csv first; the full output
+then follows as usual and replaces it.
+With drift=True the exams are ordered by acquisition date and the fraction
+means of every ROI and direction are checked for drift (motionDrift).
+
+Assume ROI is made of axial contours, or is a triangle mesh (e.g. from MBS),
+which is cut into axial polygons every slice interval (contourEngine.sliceMesh)
+
+to use (see motionByPoints.analyseCase):
+    from rmhTools.roiTools import motionEngine
+    motionEngine.analyseCase(settings_module, patient, case, motionEngine.PlanningNameBase())
+or:
+    analysis = motionEngine.MotionAnalysis(case, DESIRED_ROIS, motionEngine.PlanningNameBase(), SLICE_INTERVAL)
+    analysis.run(filename)
+"""
+
+import os
+import sys
+import collections
+import multiprocessing
+
+import numpy as np
+
+from . import contourEngine
+from . import motionDrift
+from . import motionOutput
+
+# --------------- #
+
+
+REF_POINT_SP = "Ref Point SP"      # reference for z
+REF_POINT_RFH = "Ref Point RFH"    # reference for x and y
+
+# Exam names (lower case) taken as "the" planning CT by PlanningNameBase
+PLANNING_CT_NAMES = [ "planning ct", "planningct" ]
+
+# slice_interval = AUTO_INTERVAL chooses the interval of each base/comparison pair
+# from the spacing of their contoured slices (the larger of the two)
+AUTO_INTERVAL = 'auto'
+# Interval used if there is no contour spacing to go by (a single slice, or a mesh)
+DEFAULT_SLICE_INTERVAL = 0.25  # cm
+
+# Coarse preview passes are written to <filename>PREVIEW_SUFFIX.csv
+PREVIEW_SUFFIX = '_PREVIEW'
+
+# Python interpreter for the worker processes of a parallel run (MotionAnalysis workers);
+# None for sys.executable if that is python. Within RayStation sys.executable is RayStation
+# itself: set this to a python.exe (of the same version) to use workers there, otherwise
+# the pairs are computed serially
+WORKER_PYTHON = None
+
+# Extreme points shown as marker POIs by PoiWriter, and their colours
+MARKER_POINTS = [ ('L', 'Red'), ('R', 'Blue') ]
+
+# Columns written for each slice (differences to the base exam)
+ALL_COLUMNS = [ 'R.x', 'R.y', 'L.x', 'L.y', 'P.x', 'P.y', 'A.x', 'A.y' ]
+LR_AP_COLUMNS = [ 'R.x', 'L.x', 'P.y', 'A.y' ]
+
+
+# --------------- #
+# Options of the motionByPoints scripts (see analyseCase). These are the defaults
+# of all three; a script sets any of them itself to change it for that script only.
+
+# Slices beyond the extent of the base exam are compared to its extreme slice;
+# set False to leave them out of the output instead
+CLAMP_TO_BASE_EXTREMES = True
+
+# Also save the results in typed columnar form for cohort analysis (see motionOutput.loadCohort):
+# 'npz', 'parquet' (needs pyarrow) or None for csv only
+COLUMNAR_FORMAT = None
+
+# Also save the (z slice x exam) displacement image of every ROI and direction for review
+# tools, as memory-mapped float32 arrays with a JSON index (see motionOutput.writeHeatmaps)
+HEATMAP_EXPORT = False
+
+# Also report the extremes along this many equally spaced in-plane directions
+# (e.g. 8 or 16, giving oblique columns D0, D45, ...); None for R/L/A/P only
+NUM_DIRECTIONS = None
+
+# Also report the area, perimeter, centroid and bounding box of every slice
+SHAPE_DESCRIPTORS = False
+
+# Interpolate every exam linearly onto one z grid (every SLICE_INTERVAL from the SP point)
+# instead of comparing nearest slices; better when exams have different slice thicknesses
+INTERPOLATE_SLICES = False
+
+# Write each contoured slice only once when SLICE_INTERVAL is finer than the slice spacing
+COLLAPSE_DUPLICATE_SLICES = False
+
+# Align every exam to its base exam by their rigid registration rather than by the
+# SP/RFH reference points (which then need not be placed); z is then that of the base exam
+ALIGN_BY_REGISTRATION = False
+
+# Also write the 3D distance from every base exam contour point to the nearest point of
+# the same ROI in each exam (mean, percentiles, signed x/y/z) to a separate _SURFACE.csv
+SURFACE_DISPLACEMENT = False
+
+# Quick look: first write coarse previews of every nth slice (plus the ROI ends) to a
+# _PREVIEW.csv, for each n in this list (e.g. [8], or [16, 4] for two passes), then the
+# full output as usual, which replaces the preview; None for no preview
+PREVIEW_STEPS = None
+
+# Compute the ROI/exam pairs in this many processes while the contours are read
+# (e.g. the number of cores; see WORKER_PYTHON); None for one
+PARALLEL_WORKERS = None
+
+# Order the exams by acquisition date and flag drift or step changes of the mean displacement
+# of every ROI and direction (see motionDrift), written to a separate _DRIFT.csv
+DRIFT_DETECTION = False
+
+# Visual QA: show the L/R extreme points of some slices of every ROI/exam as marker POIs
+# (at most MAX_MARKERS slices per ROI/exam, from every MARKER_EVERY_NTH_SLICE'th slice)
+SHOW_EXTREME_MARKERS = False
+MAX_MARKERS = 10
+MARKER_EVERY_NTH_SLICE = 1
+
+# Output: <dataPath>/<EXPORT_FILE_PREFIX><PatientID><EXPORT_FILE_SUFFIX>.csv, with the
+# columns (and z column header) written for each slice, plus the sup/inf extent of every
+# ROI/exam in a separate _SUPINF.csv if EXPORT_SUPINF
+EXPORT_FILE_SUFFIX = ''
+COLUMNS = ALL_COLUMNS
+Z_LABEL = 'z'
+EXPORT_SUPINF = False
+
+
+# --------------- #
+
+def getRefPointCoordinates(sSet, pointName):
+    """Returns dictionary of x,y,z coords of a POI"""
+    pt = sSet.PoiGeometries[pointName].Point
+    return {'x':pt.x, 'y':pt.y, 'z':pt.z}
+
+# --------------- #
+
+
+
+def workerPython():
+    """
+    Python interpreter for worker processes: WORKER_PYTHON, else sys.executable
+    if that is python; None if neither is (e.g. running within RayStation)
+    """
+    if WORKER_PYTHON is not None:
+        return WORKER_PYTHON
+    if os.path.basename(sys.executable).lower().startswith('python'):
+        return sys.executable
+    return None
+
+
+def getExamUID(exam):
+    """
+    DICOM SeriesInstanceUID of an exam (None if it cannot be read)
+    """
+    try:
+        return exam.GetAcquisitionDataFromDicom()['SeriesModule']['SeriesInstanceUID']
+    except:
+        return None
+
+
+def getExamDate(exam):
+    """
+    DICOM acquisition date/time of an exam (series, else study) as
+    'YYYY-MM-DD HH:MM:SS' (None if it cannot be read)
+    """
+    try:
+        dicom = exam.GetAcquisitionDataFromDicom()
+    except:
+        return None
+    for (module, key) in [ ('SeriesModule', 'SeriesDateTime'), ('StudyModule', 'StudyDateTime') ]:
+        try:
+            value = dicom[module][key]
+            return '{:04d}-{:02d}-{:02d} {:02d}:{:02d}:{:02d}'.format(value.Year, value.Month, value.Day,
+                                                                      value.Hour, value.Minute, value.Second)
+        except:
+            continue
+    return None
+
+# --------------- #
+
+
+
+def markerSlices(num_slices, max_markers=None, every=1):
+    """
+    Indices of the slices given markers: every nth slice, then at most
+    max_markers of those spread evenly over the ROI (None for no cap)
+    """
+    indices = list(range(0, num_slices, every))
+    if max_markers is not None and len(indices) > max_markers:
+        if max_markers <= 1:
+            return indices[:max_markers]
+        picks = np.round(np.linspace(0, len(indices) - 1, max_markers)).astype(int)
+        indices = [ indices[i] for i in picks ]
+    return indices
+
+
+class PoiWriter(object):
+    """
+    Creates or moves many marker POIs at once. Markers are queued with
+    add/addSlices and written by flush: the POI names are read once, and all
+    the points are created or set inside one composite_action (e.g.
+    connect.CompositeAction) so they can be undone together.
+    Markers are named <roi>_<point><n>, e.g. "GTV_L1"; the same POI is moved
+    to the matching slice in each exam.
+    """
+
+    def __init__(self, case, composite_action=None, max_markers=10, every=1,
+                 points=MARKER_POINTS, action_name='Add extreme point markers'):
+        self.case = case
+        self.composite_action = composite_action
+        self.max_markers = max_markers
+        self.every = every
+        self.points = points
+        self.action_name = action_name
+        self.names = None    # POI names, read at the first flush
+        self.pending = []    # (exam, name, coords, color)
+
+    def add(self, exam, name, coords, color='Red'):
+        """Queue a marker at coords (dictionary of x,y,z) in exam"""
+        self.pending.append( (exam, name, coords, color) )
+
+    def addSlices(self, roi_name, exam, ext_list, refX, refY, refZ):
+        """
+        Queue markers at the extreme points of the slices chosen by markerSlices
+        (ext_list as from extremePointRecords, relative to refX/refY/refZ)
+        """
+        for (n, i) in enumerate(markerSlices(len(ext_list), self.max_markers, self.every)):
+            ext_coords = ext_list[i]
+            for (point, color) in self.points:
+                coords = {'x': ext_coords[point+'.x'] + refX,
+                          'y': ext_coords[point+'.y'] + refY,
+                          'z': ext_coords[point+'.z'] + refZ}
+                self.add(exam, '{}_{}{}'.format(roi_name, point, n+1), coords, color)
+
+    def flush(self):
+        """Create or move all queued markers; returns the number written"""
+        if len(self.pending) == 0:
+            return 0
+        if self.composite_action is None:
+            self._write()
+        else:
+            with self.composite_action(self.action_name):
+                self._write()
+        num_written = len(self.pending)
+        self.pending = []
+        return num_written
+
+    def _write(self):
+        if self.names is None:
+            self.names = set( [ pt.Name for pt in self.case.PatientModel.PointsOfInterest ] )
+        for (exam, name, coords, color) in self.pending:
+            if name not in self.names:
+                self.case.PatientModel.CreatePoi(Examination=exam, Point=coords,
+                                Volume=0.0, Name=name, Color=color,
+                                Type='Marker')
+                self.names.add( name )
+            else:
+                self.case.PatientModel.StructureSets[exam.Name].PoiGeometries[name].Point = coords
+
+# --------------- #
+
+
+
+def getDesiredROIs(case, desired_rois):
+    """
+    Return list of desired ROIs (only ROIS that exist in patient)
+    """
+    desired_lower = [ name.lower() for name in desired_rois ]
+    return [ roi.Name for roi in case.PatientModel.RegionsOfInterest if roi.Name.lower() in desired_lower ]
+
+# --------------- #
+
+
+
+def hasContours(roi_geom):
+    """
+    True if the ROI geometry has both a PrimaryShape and Contours
+    """
+    return hasattr(roi_geom, "PrimaryShape") and hasattr(roi_geom.PrimaryShape, "Contours")
+
+
+def hasGeometry(roi_geom):
+    """
+    True if the ROI geometry has contours or a triangle mesh we can analyse
+    """
+    return hasContours(roi_geom) or ( hasattr(roi_geom, "PrimaryShape") and contourEngine.isMesh(roi_geom) )
+
+# --------------- #
+
+
+
+def checkAllContoursPresent(case, exam_list, roi_list):
+    """
+    Check that all ROIS have an actual PrimaryShape and Contour in each exam; print warning if not
+    """
+    for roi in roi_list:
+        for exam in exam_list:
+
+            roi_geom = case.PatientModel.StructureSets[exam.Name].RoiGeometries[roi]
+
+            if not hasattr(roi_geom, "PrimaryShape"):
+                print("---> WARNING: No ROI for {} in {}".format(roi, exam.Name) )
+
+            if not hasContours(roi_geom):
+                if hasGeometry(roi_geom):
+                    print("... {} in {} is a mesh; it will be cut into axial slices".format(roi, exam.Name) )
+                else:
+                    print("---> WARNING: No contour for {} in {}".format(roi, exam.Name) )
+
+# --------------- #
+
+
+
+def checkRefPoints(ref_SP, ref_RFH, examName):
+    """
+    Print warnings if the SP and RFH points look misplaced
+    """
+    if abs(ref_SP['x']-ref_RFH['x']) < 2.0:
+        print("---> WARNING(1): Check that SP and RFH are positioned correctly in {}".format(examName) )
+    if abs(ref_SP['z']-ref_RFH['z']) < 2.0:
+        print("---> WARNING(2): Check that SP and RFH are positioned correctly in {}".format(examName) )
+    if abs(ref_SP['z']) > 100:
+        print("---> WARNING(3): Check that SP point has been positioned in {}".format(examName) )
+    if abs(ref_RFH['z']) > 100:
+        print("---> WARNING(4): Check that RFH point has been positioned in {}".format(examName) )
+
+# --------------- #
+
+
+
+class MissingDataError(Exception):
+    """
+    An exam that cannot be analysed for a known reason: there is no base exam
+    (planning scan) for it, or no registration to its base exam. Only these
+    are reported and skipped; any other error stops the run.
+    """
+
+# --------------- #
+
+
+
+
+########################## Base exam strategies ##########################
+
+class PlanningNameBase(object):
+    """
+    All exams are compared to the exam named "Planning CT" (or "PlanningCT"),
+    which is put first in the list of exams
+    """
+
+    def selectExams(self, case):
+        all_exams_unordered = [ exam for exam in case.Examinations ]
+
+        plans = [ ex for ex in all_exams_unordered if ex.Name.lower() in PLANNING_CT_NAMES ]
+        self.base = plans[0] if len(plans) > 0 else None
+        if self.base is None:
+            print("---> WARNING: No exam called 'Planning CT' found")
+
+        no_plans = len([ ex for ex in all_exams_unordered if 'planning' in ex.Name.lower() ])
+        if no_plans > 1:
+            print("xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx")
+            print("---> WARNING: There are multiple planning scans associated with patient")
+            print("     Script will not produce correct results")
+            print("     Run motionByPoints_multiPlan script instead.")
+            print("xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx")
+
+        return plans[:1] + [ ex for ex in all_exams_unordered if self.base is None or ex.Name != self.base.Name ]
+
+    def baseExamFor(self, exam):
+        if self.base is None:
+            raise MissingDataError( "No Planning CT to compare {} with".format(exam.Name) )
+        return self.base
+
+# --------------- #
+
+
+
+class PlanningIndex(object):
+    """
+    FrameOfReference -> planning scan lookup for a case, built once.
+    Each exam's FrameOfReference is read only once, however often it is looked up.
+    """
+
+    def __init__(self, exam_list):
+        self.plans_by_frame = {}    # FrameOfReference -> [planning exams]
+        self.frame_of_exam = {}     # exam name -> FrameOfReference
+
+        for ex in exam_list:
+            frameOfRef = ex.EquipmentInfo.FrameOfReference
+            self.frame_of_exam[ex.Name] = frameOfRef
+            if 'planning' in ex.Name.lower():
+                self.plans_by_frame.setdefault(frameOfRef, []).append(ex)
+
+    def lookup(self, exam):
+        """
+        Planning scan sharing the FrameOfReference of exam.
+        Raises MissingDataError if there is no such planning scan, or more than one
+        """
+        if exam.Name in self.frame_of_exam:
+            frameOfRef = self.frame_of_exam[exam.Name]
+        else:
+            frameOfRef = exam.EquipmentInfo.FrameOfReference
+            self.frame_of_exam[exam.Name] = frameOfRef
+
+        plans = self.plans_by_frame.get(frameOfRef, [])
+        if len(plans) == 0:
+            raise MissingDataError( "No registered planning CT found for %s" % exam.Name )
+        if len(plans) > 1:
+            raise MissingDataError( "%s shares its FrameOfReference with more than one planning CT (%s)"
+                               % (exam.Name, ", ".join([ex.Name for ex in plans])) )
+        return plans[0]
+
+# --------------- #
+
+
+
+class FrameOfReferenceBase(object):
+    """
+    Each exam is compared to the planning scan it is registered to, i.e. the
+    one sharing its FrameOfReference (allows for replanning scans)
+    """
+
+    def selectExams(self, case):
+        all_exams = [ exam for exam in case.Examinations ]
+
+        no_plans = len([ ex for ex in all_exams if 'planning' in ex.Name.lower() ])
+        if no_plans > 1:
+            print("xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx")
+            print("---> There are multiple planning scans associated with patient")
+            print("---> All CBCTs will be registered to their appropriate Plan.")
+            print("xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx")
+
+        self.planning_index = PlanningIndex( all_exams )
+        for exam in all_exams:
+            try:
+                print("matched: {} with {}".format(exam.Name, self.planning_index.lookup(exam).Name) )
+            except MissingDataError as err:
+                print("ERROR(7) - {}".format(err) )
+
+        return all_exams
+
+    def baseExamFor(self, exam):
+        return self.planning_index.lookup(exam)
+
+# --------------- #
+
+
+
+class NamedExamBase(object):
+    """
+    A list of exams is compared to one user chosen base exam
+    (names are case sensitive and must match exactly)
+    """
+
+    def __init__(self, base_name, exam_names):
+        self.base_name = base_name
+        self.exam_names = exam_names
+
+    def selectExams(self, case):
+        all_exams_unordered = []
+        try:
+            for ex in self.exam_names:
+                all_exams_unordered.append( case.Examinations[ ex ] )
+        except:
+            print("ERROR -- Examination specified in EXAMINATION_LIST not found")
+
+        print("Base image = {}".format(self.base_name) )
+        print("Images for comparison = {}".format([exam.Name for exam in all_exams_unordered]) )
+
+        # Have to put base exam at front of list
+        self.base = case.Examinations[self.base_name]
+        return [ self.base ] + all_exams_unordered
+
+    def baseExamFor(self, exam):
+        return self.base
+
+# --------------- #
+
+
+
+
+########################## Shared extraction layer ##########################
+
+class BaseReference(object):
+    """
+    Reference data of one ROI in a base exam:
+        slices    : ReferenceSlices of per-slice extreme point records (z wrt SP)
+        supinf    : dictionary of sup ('S.z') and inf ('I.z') extent wrt SP
+    """
+
+    def __init__(self, slices, supinf):
+        self.slices = slices
+        self.supinf = supinf
+
+# --------------- #
+
+
+
+class ExtractionCache(object):
+    """
+    Contours and base-exam reference data, filled once per run.
+    Packed contours are kept per (exam, ROI) and base references per
+    (base exam, ROI, slice grid, SP/RFH coordinates). Each entry stores a cheap
+    fingerprint of the contours and is rebuilt if the contours or reference
+    points have changed. Base references hold the extremes along directions
+    (see contourEngine.directionVectors) as well, if given.
+    With registration=True contours of an exam are moved into the frame of its
+    base exam by their registration, and the reference coordinates are the
+    origin of that frame (the SP/RFH points are not used).
+    """
+
+    def __init__(self, case, slice_interval, ref_point_sp=REF_POINT_SP, ref_point_rfh=REF_POINT_RFH,
+                 directions=None, registration=False):
+        self.case = case
+        self.registration = registration
+        self.slice_interval = slice_interval
+        self.ref_point_sp = ref_point_sp
+        self.ref_point_rfh = ref_point_rfh
+        self.directions = directions
+        self.direction_columns = [] if directions is None else contourEngine.directionLabels(directions)
+        self.packed = {}      # (exam, roi) -> (fingerprint, PackedContours)
+        self.indices = {}     # (exam, roi) -> (fingerprint, SliceIndex) of contours not packed
+        self.reference = {}   # key -> (fingerprint, BaseReference)
+        self.profiles = {}    # key -> (fingerprint, SliceProfile)
+        self.aligned = {}     # (exam, roi, base) -> (fingerprint, transform, PackedContours)
+        self.transforms = {}  # (exam, base) -> 4x4 matrix
+        self.surfaces = {}    # (exam, roi, base) -> (fingerprint, points, KD-tree)
+        self.hashes = {}      # (exam, roi) -> (PackedContours, packedFingerprint)
+        self.uids = {}        # exam -> SeriesInstanceUID
+
+    def getRoiGeometry(self, exam_name, roi_name):
+        return self.case.PatientModel.StructureSets[exam_name].RoiGeometries[roi_name]
+
+    def getRefPoints(self, exam_name):
+        """
+        Return (ref_SP, ref_RFH) coordinate dictionaries of an exam
+        (both the origin with registration=True)
+        """
+        if self.registration:
+            origin = {'x':0.0, 'y':0.0, 'z':0.0}
+            return ( origin, origin )
+        sSet = self.case.PatientModel.StructureSets[exam_name]
+        return ( getRefPointCoordinates(sSet, self.ref_point_sp),
+                 getRefPointCoordinates(sSet, self.ref_point_rfh) )
+
+    def getPackedContours(self, exam_name, roi_name, fingerprint=None):
+        """
+        Packed contours of an ROI, only re-read if its contours have changed
+        (a mesh ROI is cut into polygons every slice_interval)
+        """
+        roi_geom = self.getRoiGeometry(exam_name, roi_name)
+        if fingerprint is None:
+            fingerprint = contourEngine.contourFingerprint(roi_geom)
+
+        entry = self.packed.get( (exam_name, roi_name) )
+        if entry is None or entry[0] != fingerprint:
+            entry = ( fingerprint, contourEngine.packGeometry(roi_geom, self.meshInterval()) )
+            self.packed[ (exam_name, roi_name) ] = entry
+        return entry[1]
+
+    def getSliceIndex(self, exam_name, roi_name):
+        """
+        SliceIndex of the contours of an ROI: that of its packed contours if
+        they have been read (or it is a mesh), else one built from the first
+        point of every contour (without reading all points)
+        """
+        roi_geom = self.getRoiGeometry(exam_name, roi_name)
+        if contourEngine.isMesh(roi_geom):
+            return self.getPackedContours(exam_name, roi_name).sliceIndex
+
+        fingerprint = contourEngine.contourFingerprint(roi_geom)
+        entry = self.packed.get( (exam_name, roi_name) )
+        if entry is not None and entry[0] == fingerprint:
+            return entry[1].sliceIndex
+        entry = self.indices.get( (exam_name, roi_name) )
+        if entry is None or entry[0] != fingerprint:
+            entry = ( fingerprint, contourEngine.SliceIndex.fromGeometry(roi_geom) )
+            self.indices[ (exam_name, roi_name) ] = entry
+        return entry[1]
+
+    def getPackedFingerprint(self, exam_name, roi_name):
+        """
+        packedFingerprint of the contours of an ROI, only worked out again if they were re-read
+        """
+        packed = self.getPackedContours(exam_name, roi_name)
+        entry = self.hashes.get( (exam_name, roi_name) )
+        if entry is None or entry[0] is not packed:
+            entry = ( packed, contourEngine.packedFingerprint(packed) )
+            self.hashes[ (exam_name, roi_name) ] = entry
+        return entry[1]
+
+    def getExamUID(self, exam):
+        """SeriesInstanceUID of an exam, read from its DICOM data once per run"""
+        if exam.Name not in self.uids:
+            self.uids[exam.Name] = getExamUID(exam)
+        return self.uids[exam.Name]
+
+    def meshInterval(self):
+        """Distance between the planes mesh ROIs are cut with"""
+        if self.slice_interval == AUTO_INTERVAL:
+            return DEFAULT_SLICE_INTERVAL
+        return self.slice_interval
+
+    def sliceInterval(self, exam_name, roi_name, base_name=None):
+        """
+        Slice interval for an ROI in an exam (compared to base_name): the fixed
+        slice_interval, or with AUTO_INTERVAL the larger contour slice spacing
+        of the two exams
+        """
+        if self.slice_interval != AUTO_INTERVAL:
+            return self.slice_interval
+        spacings = []
+        for name in [ exam_name, base_name ]:
+            if name is not None and hasGeometry(self.getRoiGeometry(name, roi_name)):
+                spacings.append( contourEngine.sliceSpacing(self.getSliceIndex(name, roi_name)) )
+        spacings = [ spacing for spacing in spacings if spacing is not None ]
+        return max(spacings) if len(spacings) > 0 else DEFAULT_SLICE_INTERVAL
+
+    def getTransform(self, exam_name, base_name):
+        """
+        4x4 rigid registration matrix taking exam coordinates to base exam coordinates
+        Raises MissingDataError if the exams are not registered
+        """
+        key = (exam_name, base_name)
+        if key not in self.transforms:
+            if exam_name == base_name:
+                self.transforms[key] = np.identity(4)
+            else:
+                try:
+                    transform = self.case.GetTransformForExaminations(FromExamination=exam_name, ToExamination=base_name)
+                except:
+                    transform = None
+                if transform is None:
+                    raise MissingDataError( "No registration of {} to {}".format(exam_name, base_name) )
+                self.transforms[key] = contourEngine.transformMatrix(transform)
+        return self.transforms[key]
+
+    def getAlignedContours(self, exam_name, roi_name, base_name):
+        """
+        Packed contours of an ROI moved into the frame of base_name by the
+        registration (the packed contours themselves if registration is off)
+        Raises MissingDataError if the exams are not registered
+        """
+        if not self.registration or exam_name == base_name:
+            return self.getPackedContours(exam_name, roi_name)
+
+        transform = self.getTransform(exam_name, base_name)
+        fingerprint = contourEngine.contourFingerprint( self.getRoiGeometry(exam_name, roi_name) )
+        key = (exam_name, roi_name, base_name)
+        entry = self.aligned.get(key)
+        if entry is None or entry[0] != fingerprint or not np.array_equal(entry[1], transform):
+            packed = self.getPackedContours(exam_name, roi_name, fingerprint)
+            entry = ( fingerprint, transform, contourEngine.transformPacked(packed, transform) )
+            self.aligned[key] = entry
+        return entry[2]
+
+    def getReference(self, base_name, roi_name):
+        """
+        BaseReference for this roi in the base exam, sampled on the base exam's
+        own slice grid; None if the ROI has no contours in the base exam
+        """
+        roi_geom = self.getRoiGeometry(base_name, roi_name)
+        if not hasGeometry(roi_geom):
+            return None
+
+        fingerprint = contourEngine.contourFingerprint(roi_geom)
+        packed = self.getPackedContours(base_name, roi_name, fingerprint)
+        if packed.numContours() == 0:
+            return None
+
+        (z_min, z_max) = packed.sliceIndex.limits()
+        slice_selection = contourEngine.sliceSelection(z_min, z_max, self.sliceInterval(base_name, roi_name))
+
+        (ref_SP, ref_RFH) = self.getRefPoints(base_name)
+        key = ( base_name, roi_name, tuple(slice_selection),
+                (ref_SP['x'], ref_SP['y'], ref_SP['z']), (ref_RFH['x'], ref_RFH['y'], ref_RFH['z']) )
+
+        entry = self.reference.get(key)
+        if entry is None or entry[0] != fingerprint:
+            refX = ref_RFH['x'];  refY = ref_RFH['y'];  refZ = ref_SP['z']
+            base_slices = contourEngine.extremePointRecords(packed, slice_selection, refX, refY, refZ, self.directions,
+                                                            keys=['z'] + ALL_COLUMNS + self.direction_columns)
+
+            supinf = {'roi':roi_name, 'exam':base_name, 'S.z':z_max-refZ, 'I.z':z_min-refZ}
+            entry = ( fingerprint, BaseReference(contourEngine.ReferenceSlices(base_slices), supinf) )
+            self.reference[key] = entry
+        return entry[1]
+
+    def getSurfacePoints(self, exam_name, roi_name, base_name=None, tree=False):
+        """
+        (points, tree) of all contour points of an ROI, wrt the reference points
+        (moved into the frame of base_name with registration=True); tree is a
+        KD-tree of the points if asked for (built once per exam and ROI), else None.
+        (None, None) if the ROI has no contours.
+        """
+        roi_geom = self.getRoiGeometry(exam_name, roi_name)
+        if not hasGeometry(roi_geom):
+            return (None, None)
+
+        fingerprint = contourEngine.contourFingerprint(roi_geom)
+        if self.registration and base_name is not None:
+            fingerprint = ( fingerprint, self.getTransform(exam_name, base_name).tolist() )
+        (ref_SP, ref_RFH) = self.getRefPoints(exam_name)
+        fingerprint = ( fingerprint, ref_SP['z'], ref_RFH['x'], ref_RFH['y'] )
+
+        key = ( exam_name, roi_name, base_name if self.registration else None )
+        entry = self.surfaces.get(key)
+        if entry is None or entry[0] != fingerprint or (tree and entry[2] is None):
+            packed = self.getAlignedContours(exam_name, roi_name, base_name if base_name else exam_name)
+            points = packed.points - np.array( [ref_RFH['x'], ref_RFH['y'], ref_SP['z']] )
+            kd_tree = None
+            if tree:
+                if contourEngine.cKDTree is None:
+                    raise ImportError("scipy is needed for the surface displacement")
+                kd_tree = contourEngine.cKDTree(points)
+            entry = ( fingerprint, points, kd_tree )
+            self.surfaces[key] = entry
+        return (entry[1], entry[2])
+
+    def getProfile(self, exam_name, roi_name, shape=False, base_name=None):
+        """
+        contourEngine.SliceProfile of every contoured slice of this roi in an exam
+        (z wrt its SP point, x,y wrt its RFH point); None if it has no contours
+        With registration=True the contours are first moved into the frame of base_name
+        """
+        roi_geom = self.getRoiGeometry(exam_name, roi_name)
+        if not hasGeometry(roi_geom):
+            return None
+
+        fingerprint = contourEngine.contourFingerprint(roi_geom)
+        if self.registration and base_name is not None:
+            packed = self.getAlignedContours(exam_name, roi_name, base_name)
+            fingerprint = ( fingerprint, self.getTransform(exam_name, base_name).tolist() )
+        else:
+            packed = self.getPackedContours(exam_name, roi_name, fingerprint)
+        if packed.numContours() == 0:
+            return None
+
+        (ref_SP, ref_RFH) = self.getRefPoints(exam_name)
+        key = ( exam_name, roi_name, shape, base_name if self.registration else None,
+                (ref_SP['x'], ref_SP['y'], ref_SP['z']), (ref_RFH['x'], ref_RFH['y'], ref_RFH['z']) )
+
+        entry = self.profiles.get(key)
+        if entry is None or entry[0] != fingerprint:
+            profile = contourEngine.sliceProfile(packed, ref_RFH['x'], ref_RFH['y'], ref_SP['z'], self.directions, shape)
+            entry = ( fingerprint, profile )
+            self.profiles[key] = entry
+        return entry[1]
+
+# --------------- #
+
+
+
+
+########################## Analysis ##########################
+
+class PairTask(object):
+    """
+    Data of one ROI in one exam needed by computePairLines, once read from
+    RayStation (plain arrays, so it can be sent to a worker process)
+        ref    : (refX, refY, refZ) the extreme points are given wrt
+        base   : BaseReference of the ROI in the base exam
+        limits : (min, max) contour z of the ROI (that of packed, unless only
+                 some of its contours were packed, see packSelected)
+    """
+
+    def __init__(self, roi_name, exam_name, packed, slice_selection, ref, base,
+                 directions, columns, shape_columns, clamp, limits=None):
+        self.roi_name = roi_name
+        self.exam_name = exam_name
+        self.packed = packed
+        self.limits = packed.sliceIndex.limits() if limits is None else limits
+        self.slice_selection = slice_selection
+        self.ref = ref
+        self.base = base
+        self.directions = directions
+        self.columns = columns
+        self.shape_columns = shape_columns
+        self.clamp = clamp
+
+
+def computePairLines(task):
+    """
+    (lines, supinf_line, extreme point records) of csv output for a PairTask:
+    the slice matching and extreme point maths, without RayStation
+    """
+    (refX, refY, refZ) = task.ref
+    (roi_name, exam_name, base) = (task.roi_name, task.exam_name, task.base)
+    slice_selection = task.slice_selection
+    (z_min, z_max) = task.limits
+
+    # Sup/inf extent wrt the base exam
+    supinf_line = ( roi_name + ',' + exam_name + ',' +
+                    str( (z_max-refZ) - base.supinf['S.z'] ) + ',' +
+                    str( (z_min-refZ) - base.supinf['I.z'] ) + '\n' )
+
+    # Get R/L/A/P extreme points of every slice together
+    #   (MULTIPLE CONTOUR OBJECTS SOMETIMES PRESENT ON A SLICE -- handled by contourEngine)
+    all_ext_coords = contourEngine.extremePointRecords(task.packed, slice_selection, refX, refY, refZ,
+                                                       task.directions, len(task.shape_columns) > 0)
+
+    ## We want to give all values WRT to the base exam.
+    ## The closest base slice to every slice of this exam is found in one sorted pass.
+    ## If we find z-values outside range of the base exam, we use its extreme values,
+    ## rather than not using the data (unless clamp is switched off)
+    closest_indices = np.asarray( base.slices.match( [z - refZ for z in slice_selection], clamp=task.clamp ),
+                                  dtype=np.intp )
+    kept = np.flatnonzero(closest_indices != -1)    # others are outside range of base exam
+
+    # Differences to the base slices of all kept slices in one go (python floats, so str() is unchanged)
+    ext_coords = all_ext_coords.take(kept)
+    columns = ext_coords.difference(base.slices.records, closest_indices[kept], task.columns).tolist()
+    columns += [ ext_coords.column(col).tolist() for col in task.shape_columns ]
+
+    lines = []
+    for (i, row) in zip(kept.tolist(), zip(*columns)):
+        line = roi_name + ',' + exam_name + ',' + str( slice_selection[i] - refZ )
+        for value in row:
+            line = line + ',' + str( value )
+        lines.append( line + '\n' )
+
+    return (lines, supinf_line, all_ext_coords)
+
+# --------------- #
+
+
+class MotionAnalysis(object):
+    """
+    Motion of a set of ROIs over the exams of a case, relative to the base
+    exam chosen for each exam by base_strategy.
+        slice_interval : distance between sampled slices (cm), or AUTO_INTERVAL to use the
+                         contour slice spacing of each exam and its base exam (the larger)
+        columns        : extreme point coordinates written for each slice
+        z_label        : header of the z column
+        clamp          : compare slices beyond the base exam's extent to its extreme slice
+                         (False: leave them out)
+        export_supinf  : also write the sup/inf extent of every ROI/exam
+        num_directions : also write the extreme distance along this many equally spaced
+                         in-plane directions (columns D0, D45, ...; see contourEngine.directionVectors)
+        shape          : also write the area, perimeter, centroid (wrt the reference points)
+                         and bounding box width/height of every slice (contourEngine.SHAPE_KEYS).
+                         Unlike the other columns these are values of the exam itself,
+                         not differences from the base exam.
+        registration   : move the contours of each exam into the frame of its base exam by
+                         their rigid registration (case.GetTransformForExaminations), instead
+                         of referencing both to their SP/RFH points; z is then the base exam's z
+        surface        : also write the 3D displacement from every base exam contour point to
+                         the nearest point of the ROI in each exam (contourEngine.SURFACE_KEYS),
+                         to <filename>_SURFACE.csv
+        collapse_duplicates : write each contoured slice only once, even if several sampled z
+                         positions are closest to it (interval finer than the slice spacing)
+        interpolate    : interpolate the profiles of each exam and its base exam linearly onto
+                         one z grid (every slice_interval from the SP point) rather than using
+                         the nearest contoured slice of each
+        columnar_format: also write each csv in typed columnar form ('npz' or 'parquet',
+                         see motionOutput.writeColumnar); None for csv only
+        preview        : before the full run, write coarse passes over every nth sampled slice
+                         of each ROI (plus its ends) to <filename>_PREVIEW.csv, for each n in
+                         this list (e.g. [8] or [16, 4]; coarsest first); None for no preview.
+                         The preview file is removed once the full output is complete.
+        heatmaps       : also write the (z slice x exam) displacement image of every ROI and
+                         column as memory-mappable float32 arrays (motionOutput.writeHeatmaps)
+        drift          : also order the exams by acquisition date and check the fraction means
+                         of every ROI and direction for drift or steps (motionDrift), written
+                         to <filename>_DRIFT.csv and updated as each new exam is added
+        workers        : number of worker processes computing the ROI/exam pairs (see
+                         analysePairs); None or 1 for a serial run in this process
+        markers        : PoiWriter showing the extreme points of each analysed ROI/exam as
+                         marker POIs, written at the end of run (None for no markers; not
+                         with interpolate or registration, or for pairs copied by incremental)
+    """
+
+    def __init__(self, case, desired_rois, base_strategy, slice_interval,
+                 clamp=True, columns=ALL_COLUMNS, z_label='z',
+                 ref_point_sp=REF_POINT_SP, ref_point_rfh=REF_POINT_RFH,
+                 export_supinf=False, columnar_format=None, num_directions=None,
+                 shape=False, interpolate=False, registration=False, surface=False,
+                 collapse_duplicates=False, markers=None, drift=False, workers=None, heatmaps=False,
+                 preview=None):
+        self.case = case
+        self.desired_rois = desired_rois
+        self.base_strategy = base_strategy
+        self.slice_interval = slice_interval
+        self.clamp = clamp
+        self.interpolate = interpolate
+        self.collapse_duplicates = collapse_duplicates
+        directions = contourEngine.directionVectors(num_directions) if num_directions else None
+        self.columns = list(columns) + ([] if directions is None else contourEngine.directionLabels(directions))
+        self.shape_columns = contourEngine.SHAPE_KEYS if shape else []
+        self.z_label = z_label
+        self.export_supinf = export_supinf
+        self.columnar_format = columnar_format
+        self.registration = registration
+        self.surface = surface
+        self.markers = markers
+        self.drift = drift
+        self.workers = workers
+        self.heatmaps = heatmaps
+        self.preview = preview
+        self.cache = ExtractionCache(case, slice_interval, ref_point_sp, ref_point_rfh, directions, registration)
+
+
+    def header(self):
+        return 'roi,exam,' + self.z_label + ',' + ','.join(self.columns + self.shape_columns) + '\n'
+
+
+    def supinfHeader(self):
+        # I am assuming that the largest z value is always the "sup", and min is "inf"
+        return 'roi,exam,S.z,I.z\n'
+
+
+    def surfaceHeader(self):
+        return 'roi,exam,' + ','.join(contourEngine.SURFACE_KEYS) + '\n'
+
+
+    def settings(self):
+        """
+        Settings that change every row of the output, or which outputs are
+        written (see motionOutput.IncrementalState)
+        """
+        return { 'slice_interval': self.slice_interval, 'clamp': self.clamp, 'interpolate': self.interpolate,
+                 'collapse_duplicates': self.collapse_duplicates,
+                 'registration': self.registration,
+                 'columns': self.columns + self.shape_columns, 'z_label': self.z_label,
+                 'ref_points': [self.cache.ref_point_sp, self.cache.ref_point_rfh],
+                 'export_supinf': self.export_supinf, 'surface': self.surface }
+
+
+    def examSignature(self, roi_name, exam):
+        """
+        What the analysis of an ROI reads from one exam: its UID, a fingerprint
+        of every contour point and the SP/RFH coordinates
+        """
+        roi_geom = self.cache.getRoiGeometry(exam.Name, roi_name)
+        fingerprint = self.cache.getPackedFingerprint(exam.Name, roi_name) if hasGeometry(roi_geom) else None
+        try:
+            (ref_SP, ref_RFH) = self.cache.getRefPoints(exam.Name)
+            ref = [ [ref_SP['x'], ref_SP['y'], ref_SP['z']], [ref_RFH['x'], ref_RFH['y'], ref_RFH['z']] ]
+        except:
+            ref = None
+        return {'exam': exam.Name, 'uid': self.cache.getExamUID(exam), 'fingerprint': fingerprint, 'ref': ref}
+
+
+    def pairSignature(self, roi_name, exam):
+        """
+        Signature of everything the rows of one ROI/exam depend on: the exam
+        itself and the base exam it is compared to
+        """
+        try:
+            base_exam = self.base_strategy.baseExamFor(exam)
+        except MissingDataError:
+            base_exam = None
+        signature = { 'exam': self.examSignature(roi_name, exam),
+                      'base': None if base_exam is None else self.examSignature(roi_name, base_exam) }
+        if self.registration and base_exam is not None:
+            try:
+                signature['transform'] = self.cache.getTransform(exam.Name, base_exam.Name).tolist()
+            except MissingDataError:
+                signature['transform'] = None
+        return signature
+
+
+    def analyseExam(self, roi_name, exam, every=1):
+        """
+        Return (lines, supinf_line) of csv output for one ROI in one exam
+        (([], None) if it cannot be analysed); every > 1 for a coarse preview
+        of every nth sampled slice (see contourEngine.previewIndices)
+        """
+        task = self.prepareExam(roi_name, exam, every)
+        if not isinstance(task, PairTask):
+            return task
+        return self.finishExam( task, computePairLines(task), exam, markers=(every == 1) )
+
+
+    def prepareExam(self, roi_name, exam, every=1):
+        """
+        Everything read from RayStation for one ROI in one exam, as a PairTask
+        for computePairLines; or the finished (lines, supinf_line) if there is
+        nothing to compute (([], None) if it cannot be analysed)
+        """
+        try:
+            base_exam = self.base_strategy.baseExamFor(exam)
+        except MissingDataError as err:
+            print("ERROR(7) - {}".format(err) )
+            return ([], None)
+
+        ## Check that both PrimaryShape and Contour exists:
+        roi_geom = self.cache.getRoiGeometry(exam.Name, roi_name)
+        if not hasattr(roi_geom, "PrimaryShape"):
+            print("---> WARNING: No ROI for {} in {}".format(roi_name, exam.Name) )
+            return ([], None)
+        if not hasGeometry(roi_geom) or len(self.cache.getSliceIndex(exam.Name, roi_name)) == 0:
+            print("---> WARNING: No contour for {} in {}".format(roi_name, exam.Name) )
+            return ([], None)
+
+        # Reference coordinates for z (SP) and x,y (RFH)
+        (ref_SP, ref_RFH) = self.cache.getRefPoints(exam.Name)
+        refX = ref_RFH['x']  # NOTE that these vary slightly between exams
+        refY = ref_RFH['y']
+        refZ = ref_SP['z']   # this is sometimes one slice off between exams
+        if not self.registration:
+            checkRefPoints(ref_SP, ref_RFH, exam.Name)
+
+        print("... {} in {}".format(roi_name, exam.Name) )
+
+        try:
+            if self.interpolate:
+                return self.analyseInterpolated(roi_name, exam, base_exam, every)
+
+            # Read contours once (this also builds their sorted slice index)
+            #   (in the base exam's frame if aligning by registration)
+            #   A preview only reads the contours of the slices it samples, once these are known
+            packed = None
+            if every == 1 or self.registration or contourEngine.isMesh(roi_geom):
+                packed = self.cache.getAlignedContours(exam.Name, roi_name, base_exam.Name)
+        except MissingDataError as err:
+            print("ERROR(8) - {}".format(err) )
+            return ([], None)
+        index = self.cache.getSliceIndex(exam.Name, roi_name) if packed is None else packed.sliceIndex
+
+        # Get relevant z-coordinate limits of ROI and the z-coordinates of desired slices
+        #     (collapse_duplicates drops positions sharing their closest slice;
+        #      interpolate=True uses every contoured slice once)
+        (z_min, z_max) = index.limits()
+        slice_interval = self.cache.sliceInterval(exam.Name, roi_name, base_exam.Name)
+        slice_selection = contourEngine.sliceSelection(z_min, z_max, slice_interval)
+        if self.collapse_duplicates:
+            slice_selection = contourEngine.collapseDuplicateSlices(index, slice_selection)
+        if every > 1:
+            slice_selection = [ slice_selection[i] for i in contourEngine.previewIndices(len(slice_selection), every) ]
+        if packed is None:
+            packed = contourEngine.packSelected(roi_geom.PrimaryShape.Contours, index, slice_selection)
+
+        base = self.cache.getReference(base_exam.Name, roi_name)
+        if base is None or len(base.slices) == 0:
+            print("---> WARNING: No {} reference for {} - skipping {}".format(base_exam.Name, roi_name, exam.Name) )
+            return ([], None)
+
+        return PairTask(roi_name, exam.Name, packed, slice_selection, (refX, refY, refZ), base,
+                        self.cache.directions, self.columns, self.shape_columns, self.clamp, (z_min, z_max))
+
+
+    def finishExam(self, task, result, exam, markers=True):
+        """
+        (lines, supinf_line) from the result of computePairLines, after queueing
+        the extreme point markers of the exam (if markers)
+        """
+        (lines, supinf_line, all_ext_coords) = result
+        if markers and self.markers is not None and not self.registration:
+            (refX, refY, refZ) = task.ref
+            self.markers.addSlices(task.roi_name, exam, all_ext_coords, refX, refY, refZ)
+        return (lines, supinf_line)
+
+
+    def analysePairs(self, pairs, every=1):
+        """
+        (lines, supinf_line) of every (roi_name, exam) in pairs, in order
+        (every nth sampled slice only if every > 1, see analyseExam).
+        With workers > 1 each pair is read from RayStation in turn (which can
+        only be done in this process) and computed in a pool of worker
+        processes, up to 2 pairs per worker ahead of the one being returned
+        (results in the same order, and identical to those of a serial run);
+        otherwise each pair is analysed in turn as it is asked for.
+        Without a python interpreter for the workers (workerPython) the pairs
+        are analysed serially.
+        """
+        parallel = self.workers is not None and self.workers > 1 and len(pairs) > 1
+        if parallel and workerPython() is None:
+            print("---> WARNING: No python interpreter for worker processes (set motionEngine.WORKER_PYTHON); "
+                  "analysing serially")
+            parallel = False
+        if not parallel:
+            for (roi_name, exam) in pairs:
+                yield self.analyseExam(roi_name, exam, every)
+            return
+
+        print("Computing {} ROI/exam pairs in {} processes".format(len(pairs), self.workers) )
+        multiprocessing.set_executable( workerPython() )
+        pool = multiprocessing.Pool( min(self.workers, len(pairs)) )
+        try:
+            pending = collections.deque()    # (exam, task, result of the worker or None), in order
+            for (roi_name, exam) in pairs:
+                task = self.prepareExam(roi_name, exam, every)
+                result = pool.apply_async(computePairLines, (task,)) if isinstance(task, PairTask) else None
+                pending.append( (exam, task, result) )
+                while len(pending) > 2 * self.workers:
+                    yield self.finishPending( pending.popleft(), every )
+            while len(pending) > 0:
+                yield self.finishPending( pending.popleft(), every )
+        finally:
+            pool.terminate()
+            pool.join()
+
+
+    def finishPending(self, entry, every):
+        """(lines, supinf_line) of an (exam, task, result) of analysePairs, once its worker has finished"""
+        (exam, task, result) = entry
+        if result is None:
+            return task
+        return self.finishExam( task, result.get(), exam, markers=(every == 1) )
+
+
+    def analyseInterpolated(self, roi_name, exam, base_exam, every=1):
+        """
+        As analyseExam, but both profiles are interpolated onto the same z grid
+        (wrt the SP point), so exams with different slice thicknesses are
+        compared at the same z and every contoured slice is only used once
+        """
+        shape = len(self.shape_columns) > 0
+        profile = self.cache.getProfile(exam.Name, roi_name, shape, base_exam.Name)
+        base = self.cache.getProfile(base_exam.Name, roi_name, shape)
+        if base is None or len(base) == 0:
+            print("---> WARNING: No {} reference for {} - skipping {}".format(base_exam.Name, roi_name, exam.Name) )
+            return ([], None)
+
+        # Sup/inf extent wrt the base exam
+        (z_low, z_high) = profile.limits()
+        (base_low, base_high) = base.limits()
+        supinf_line = ( roi_name + ',' + exam.Name + ',' +
+                        str( float(z_high - base_high) ) + ',' +
+                        str( float(z_low - base_low) ) + '\n' )
+
+        # Grid over this exam; beyond the base exam's extent its end slices are used (unless clamp is off)
+        slice_interval = self.cache.sliceInterval(exam.Name, roi_name, base_exam.Name)
+        z_grid = contourEngine.profileGrid(z_low, z_high, slice_interval)
+        if not self.clamp:
+            tolerance = contourEngine.SAME_SLICE_TOLERANCE
+            z_grid = z_grid[ (z_grid >= base_low - tolerance) & (z_grid <= base_high + tolerance) ]
+        if every > 1:
+            z_grid = z_grid[ contourEngine.previewIndices(len(z_grid), every) ]
+
+        values = profile.interpolate(z_grid, self.columns + self.shape_columns)
+        base_values = base.interpolate(z_grid, self.columns)
+        columns = [ (values[col] - base_values[col]).tolist() for col in self.columns ]
+        columns += [ values[col].tolist() for col in self.shape_columns ]
+
+        lines = []
+        for (z, row) in zip(z_grid.tolist(), zip(*columns)):
+            line = roi_name + ',' + exam.Name + ',' + str( z )
+            for value in row:
+                line = line + ',' + str( value )
+            lines.append( line + '\n' )
+
+        return (lines, supinf_line)
+
+
+    def analyseSurface(self, roi_name, exam):
+        """
+        Line of surface displacement output for one ROI in one exam (None if it
+        cannot be analysed): distances from every base exam contour point to the
+        nearest contour point in this exam, found with a KD-tree of the exam's points
+        """
+        try:
+            base_exam = self.base_strategy.baseExamFor(exam)
+            (exam_points, tree) = self.cache.getSurfacePoints(exam.Name, roi_name, base_exam.Name, tree=True)
+            base_points = self.cache.getSurfacePoints(base_exam.Name, roi_name, base_exam.Name)[0]
+        except MissingDataError:
+            return None    # already reported by analyseExam
+        if exam_points is None or base_points is None or len(exam_points) == 0 or len(base_points) == 0:
+            return None
+
+        displacement = contourEngine.surfaceDisplacement(base_points, exam_points, tree)
+        line = roi_name + ',' + exam.Name
+        for key in contourEngine.SURFACE_KEYS:
+            line = line + ',' + str( displacement[key] )
+        return line + '\n'
+
+
+    def updateDrift(self, filename, all_exams):
+        """
+        Update the drift series of every exam compared to a base exam, by acquisition date
+        """
+        exams = []
+        for exam in all_exams:
+            try:
+                base_exam = self.base_strategy.baseExamFor(exam)
+            except MissingDataError:
+                continue
+            if base_exam.Name != exam.Name:
+                exams.append( (exam.Name, getExamDate(exam), base_exam.Name) )
+        if any([ date is None for (name, date, base_name) in exams ]):
+            print("---> WARNING: Acquisition dates not found for all exams; drift series in exam order")
+        motionDrift.updateDrift(filename, self.header(), exams)
+
+
+    def runPreview(self, filename, pairs):
+        """
+        Coarse passes over every nth sampled slice (for each n in self.preview,
+        coarsest first) of the (roi_name, exam) pairs, each rewriting
+        <filename>_PREVIEW.csv as it goes. Only the contours of the sampled
+        slices are read from each exam (all of them for a mesh, or with
+        interpolate or registration); the base references are cached, so the
+        full run that follows does not build them again. Returns the name of
+        the preview file.
+        """
+        preview_filename = os.path.splitext(filename)[0] + PREVIEW_SUFFIX + '.csv'
+        for every in sorted(set(self.preview), reverse=True):
+            if every <= 1:
+                continue
+            print("Preview of every {} slice(s): {}".format(every, preview_filename) )
+            writer = motionOutput.StreamingCsvWriter( [ (preview_filename, self.header()) ] )
+            results = self.analysePairs(pairs, every)
+            try:
+                for ((roi_name, exam), (lines, supinf_line)) in zip(pairs, results):
+                    writer.writePair(roi_name, exam.Name, [ lines ])
+            finally:
+                results.close()
+            writer.finish()
+        return preview_filename
+
+
+    def run(self, filename, filename_supinf=None, resume=False, incremental=False):
+        """
+        Analyse all desired ROIs in all exams and write the csv output.
+        Rows are written (and flushed) as each ROI/exam is finished; with
+        resume=True the pairs completed by an interrupted run are kept and
+        only the remaining ones are analysed.
+        With incremental=True the rows of pairs that have not changed since the
+        last complete incremental run are copied from its output instead of
+        recomputed. Only incremental runs work out what each pair was computed
+        from (which reads every contour point and exam UID) and keep it in the
+        state file, so the first run of a patient should be incremental too.
+        With surface=True the surface displacement is written to <filename>_SURFACE.csv
+        With preview steps, coarse previews of the pairs to analyse (not those
+        kept by resume or copied by incremental) are written to <filename>_PREVIEW.csv
+        first (see runPreview), which is removed once the full output is written
+        """
+        # Get relevant ROIs
+        all_roi_names = getDesiredROIs(self.case, self.desired_rois)
+        if len( all_roi_names ) == 0:
+            print("---> WARNING: None of the desired ROIs are present!")
+        print("ROI names found: {}".format(all_roi_names) )
+
+        # Get all exams, ordered as required by the base exam strategy
+        all_exams = self.base_strategy.selectExams(self.case)
+        print("Exams: {}".format([exam.Name for exam in all_exams]) )
+
+        # Check that all ROIs that exist
+        checkAllContoursPresent(self.case, all_exams, all_roi_names)
+
+        # Make the .csv file header(s)
+        outputs = [ (filename, self.header()) ]
+        if self.export_supinf:
+            outputs.append( (filename_supinf, self.supinfHeader()) )
+        if self.surface:
+            outputs.append( (os.path.splitext(filename)[0] + '_SURFACE.csv', self.surfaceHeader()) )
+
+        # What each pair was computed from last time (read before the output is rewritten)
+        state = None
+        previous = []
+        if incremental:
+            state = motionOutput.IncrementalState(filename, self.settings())
+            previous = [ motionOutput.readPairLines(f, header) for (f, header) in outputs ]
+        motionOutput.discardState(filename)
+
+        writer = motionOutput.StreamingCsvWriter(outputs, resume=resume)
+
+        # Pairs to write, in output order: rows copied from the previous output, or None to analyse
+        num_reused = 0
+        to_write = []
+        for roi_name in all_roi_names:
+            for exam in all_exams:
+                if incremental:
+                    signature = self.pairSignature(roi_name, exam)
+                    state.record(roi_name, exam.Name, signature)
+                if writer.isComplete(roi_name, exam.Name):
+                    continue
+
+                if incremental and state.isUnchanged(roi_name, exam.Name, signature):
+                    num_reused += 1
+                    to_write.append( (roi_name, exam, [ pairs.get((roi_name, exam.Name), []) for pairs in previous ]) )
+                else:
+                    to_write.append( (roi_name, exam, None) )
+
+        preview_filename = None
+        if self.preview:
+            preview_filename = self.runPreview( filename, [ (roi_name, exam) for (roi_name, exam, reused) in to_write
+                                                            if reused is None ] )
+
+        results = self.analysePairs( [ (roi_name, exam) for (roi_name, exam, reused) in to_write if reused is None ] )
+        try:
+            for (roi_name, exam, reused) in to_write:
+                if reused is not None:
+                    writer.writePair(roi_name, exam.Name, reused)
+                    continue
+
+                (lines, supinf_line) = next(results)
+                lines_per_file = [ lines ]
+                if self.export_supinf:
+                    lines_per_file.append( [] if supinf_line is None else [ supinf_line ] )
+                if self.surface:
+                    surface_line = self.analyseSurface(roi_name, exam)
+                    lines_per_file.append( [] if surface_line is None else [ surface_line ] )
+                writer.writePair(roi_name, exam.Name, lines_per_file)
+        finally:
+            results.close()    # stops the worker processes
+
+        writer.finish()
+        if incremental:
+            state.save()
+        if self.markers is not None:
+            print("Marker POIs added/moved: {}".format(self.markers.flush()) )
+        if self.drift:
+            self.updateDrift(filename, all_exams)
+        if incremental:
+            print("Unchanged ROI/exam pairs copied from the previous output: {}".format(num_reused) )
+
+        if self.columnar_format:
+            for (output_filename, header) in outputs:
+                print("Writing {}".format(motionOutput.writeColumnar(output_filename, self.columnar_format)) )
+        if self.heatmaps:
+            z_interval = None if self.slice_interval == AUTO_INTERVAL else self.slice_interval
+            print("Writing {}".format(motionOutput.writeHeatmaps(filename, z_interval)) )
+
+        # The full output replaces the preview
+        if preview_filename is not None and os.path.exists(preview_filename):
+            os.remove(preview_filename)
+
+
+
+# --------------- #
+
+
+
+def scriptOption(settings, name):
+    """Option of a script: its own setting if it has one, else the default here"""
+    return getattr(settings, name, globals()[name])
+
+
+def analyseCase(settings, patient, case, base_strategy, resume=False, incremental=False, composite_action=None):
+    """
+    Analyse one case of a patient with the settings of a motionByPoints script
+    (settings: the script module, or any object holding its settings):
+    DESIRED_ROIS, SLICE_INTERVAL, dataPath and EXPORT_FILE_PREFIX, plus any of
+    the script options above it sets itself (e.g. SURFACE_DISPLACEMENT = True);
+    options it does not set take their defaults here (scriptOption).
+    base_strategy chooses the base exams; composite_action (e.g.
+    connect.CompositeAction) groups the marker POIs.
+    Every script's main() passes on:
+        resume      : resume an interrupted run, keeping the ROI/exam pairs already written
+        incremental : only analyse exams that are new or changed since the last
+                      incremental run (e.g. a new CBCT)
+    Returns the name of the csv written.
+    """
+    option = lambda name: scriptOption(settings, name)
+    try:
+        os.makedirs(settings.dataPath)
+    except:
+        pass
+
+    filename = os.path.join(settings.dataPath, '%s%s%s.csv' % (settings.EXPORT_FILE_PREFIX, patient.PatientID,
+                                                               option('EXPORT_FILE_SUFFIX')))
+    filename_supinf = None
+    if option('EXPORT_SUPINF'):
+        # separate file for sup-inf motion
+        filename_supinf = os.path.splitext(filename)[0] + '_SUPINF.csv'
+
+    markers = None
+    if option('SHOW_EXTREME_MARKERS'):
+        markers = PoiWriter(case, composite_action, option('MAX_MARKERS'), option('MARKER_EVERY_NTH_SLICE'))
+
+    analysis = MotionAnalysis( case, settings.DESIRED_ROIS, base_strategy, settings.SLICE_INTERVAL,
+                               clamp=option('CLAMP_TO_BASE_EXTREMES'), columns=option('COLUMNS'), z_label=option('Z_LABEL'),
+                               ref_point_sp=option('REF_POINT_SP'), ref_point_rfh=option('REF_POINT_RFH'),
+                               export_supinf=option('EXPORT_SUPINF'),
+                               columnar_format=option('COLUMNAR_FORMAT'), num_directions=option('NUM_DIRECTIONS'),
+                               shape=option('SHAPE_DESCRIPTORS'), interpolate=option('INTERPOLATE_SLICES'),
+                               registration=option('ALIGN_BY_REGISTRATION'), surface=option('SURFACE_DISPLACEMENT'),
+                               collapse_duplicates=option('COLLAPSE_DUPLICATE_SLICES'), markers=markers,
+                               drift=option('DRIFT_DETECTION'), workers=option('PARALLEL_WORKERS'),
+                               heatmaps=option('HEATMAP_EXPORT'), preview=option('PREVIEW_STEPS') )
+    analysis.run( filename, filename_supinf, resume=resume, incremental=incremental )
+    return filename
@@ -0,0 +1,272 @@
+"""
+Population margins from the motionByPoints exports
+
+Streams the per-patient motion csv files (<EXPORT_FILE_PREFIX><PatientID>.csv)
+and accumulates, per ROI and per direction (csv column), the statistics of the
+margin recipe:
+    M      population mean error           mean of the patient means
+    Sigma  population systematic error     SD of the patient means
+    sigma  population random error         RMS of the patient SDs
+    margin van Herk margin                 2.5*Sigma + 0.7*sigma
+Within a patient, each exam (fraction) contributes the mean of its slices.
+
+Only one patient file is read at a time and the population statistics are
+updated with online (Welford) estimators, so memory does not grow with the
+cohort. The running statistics are saved in a JSON state file: a new patient
+can be added without reading the cohort again. A patient is only added once;
+delete the state file to rebuild from scratch (e.g. after re-running patients).
+
+Base exams have zero motion and are left out (see isBaseExam): by default the
+exams whose name contains BASE_EXAM_TEXT, those listed in BASE_EXAMINATIONS and
+the base named in a motionByPoints_MRI file name ("..._base=<exam>_vs_...").
+Pass another exclude_exam to main() for other naming schemes.
+
+Only the displacement columns are used: the z positions and the absolute
+slice shape columns (contourEngine.SHAPE_KEYS) of a shape export are skipped.
+
+to run type:
+    from rmhTools.roiTools import motionMargins
+    motionMargins.main()
+"""
+
+import os
+import glob
+import json
+import math
+
+from . import contourEngine
+from . import motionOutput
+
+# --------------- #
+
+
+# Directory holding the per-patient exports and the file name prefix of those to include
+dataPath = os.path.join(r'\\rtp-bridge2-rt.ad.rmh.nhs.uk\IntoSecure\ICR',os.environ.get('USERNAME',''),'RayStationExport')
+# (e.g. 'motionPoints_multiPlan_'); the patient ID follows the prefix
+EXPORT_FILE_PREFIX = 'motionPoints_'
+# Prefixes of the exports of every script: a file matching a longer prefix than
+# EXPORT_FILE_PREFIX belongs to another script (motionPoints_multiPlan_<ID>.csv
+# also starts with motionPoints_) and is left out
+SCRIPT_FILE_PREFIXES = [ 'motionPoints_', 'motionPoints_multiPlan_' ]
+# Separate outputs that are not per-slice motion (or only a preview of it)
+SKIP_FILE_SUFFIXES = ( '_SUPINF.csv', '_SURFACE.csv', '_DRIFT.csv', '_PREVIEW.csv' )
+
+# Base exams left out (see isBaseExam): names containing BASE_EXAM_TEXT (any case),
+# and the exact names in BASE_EXAMINATIONS (e.g. [ 'Plan CT' ])
+BASE_EXAM_TEXT = 'planning'
+BASE_EXAMINATIONS = [ ]
+# motionByPoints_MRI names its exports <prefix><ID>_base=<exam>_vs_<exams>.csv
+BASE_FILE_TAG = '_base='
+BASE_FILE_END = '_vs_'
+
+STATE_FILE = 'motionMargins_state.json'
+TABLE_FILE = 'motionMargins.csv'
+
+# van Herk margin recipe: SYSTEMATIC_FACTOR*Sigma + RANDOM_FACTOR*sigma
+SYSTEMATIC_FACTOR = 2.5
+RANDOM_FACTOR = 0.7
+
+
+# --------------- #
+
+def isBaseExam(exam_name):
+    """Default test for the base (planning) exams that are left out"""
+    return BASE_EXAM_TEXT in exam_name.lower() or exam_name in BASE_EXAMINATIONS
+
+
+def exportBaseExam(filename):
+    """
+    Base exam named in the file name of an export (motionByPoints_MRI), or None
+    """
+    name = os.path.basename(filename)
+    start = name.find(BASE_FILE_TAG)
+    if start < 0:
+        return None
+    start += len(BASE_FILE_TAG)
+    end = name.find(BASE_FILE_END, start)
+    return name[start:end] if end >= 0 else None
+
+
+def exportFiles(path, prefix=EXPORT_FILE_PREFIX):
+    """
+    Motion exports in path written with the file name prefix; returns
+    [(patient_id, filename)] sorted by file name
+    """
+    others = [ other for other in SCRIPT_FILE_PREFIXES if len(other) > len(prefix) and other.startswith(prefix) ]
+    exports = []
+    for filename in sorted( glob.glob(os.path.join(path, glob.escape(prefix) + '*.csv')) ):
+        name = os.path.basename(filename)
+        if filename.endswith(SKIP_FILE_SUFFIXES) or any([ name.startswith(other) for other in others ]):
+            continue
+        exports.append( (name[len(prefix):-len('.csv')], filename) )
+    return exports
+
+# --------------- #
+
+
+
+class RunningStats(object):
+    """
+    Welford accumulator of the patient means (-> M, Sigma) plus the running
+    sum of the patient variances (-> sigma)
+    """
+
+    def __init__(self, n=0, mean=0.0, m2=0.0, var_sum=0.0, var_n=0):
+        self.n = n
+        self.mean = mean
+        self.m2 = m2
+        self.var_sum = var_sum
+        self.var_n = var_n
+
+    def addPatient(self, patient_mean, patient_var=None):
+        self.n += 1
+        delta = patient_mean - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (patient_mean - self.mean)
+        if patient_var is not None:
+            self.var_sum += patient_var
+            self.var_n += 1
+
+    def systematic(self):
+        """Sigma: SD of the patient means"""
+        return math.sqrt(self.m2 / (self.n - 1)) if self.n > 1 else float('nan')
+
+    def random(self):
+        """sigma: root mean square of the patient SDs"""
+        return math.sqrt(self.var_sum / self.var_n) if self.var_n > 0 else float('nan')
+
+    def toDict(self):
+        return {'n': self.n, 'mean': self.mean, 'm2': self.m2, 'var_sum': self.var_sum, 'var_n': self.var_n}
+
+# --------------- #
+
+
+
+def patientFractionMeans(filename, exclude_exam=isBaseExam):
+    """
+    Stream one patient's csv: mean of every displacement column over the slices
+    of each exam, leaving out the base exams (exclude_exam, or named in the file name)
+    Returns {(roi, column): [mean of each exam]}
+    """
+    sums = {}     # (roi, exam, column) -> [sum, count]
+    exams = {}    # roi -> exams in file order
+    skipped = motionOutput.POSITION_COLUMNS + contourEngine.SHAPE_KEYS
+    file_base = exportBaseExam(filename)
+
+    with open(filename, 'r') as fp:
+        header = fp.readline().strip().split(',')
+        columns = [ (i, col) for (i, col) in enumerate(header) if i >= 2 and col not in skipped ]
+        for line in fp:
+            fields = line.strip().split(',')
+            if len(fields) < len(header):
+                continue
+            (roi, exam) = (fields[0], fields[1])
+            if exam == file_base or exclude_exam(exam):
+                continue
+            if exam not in exams.setdefault(roi, []):
+                exams[roi].append( exam )
+            for (i, col) in columns:
+                entry = sums.setdefault( (roi, exam, col), [0.0, 0] )
+                entry[0] += float(fields[i])
+                entry[1] += 1
+
+    fraction_means = {}
+    for roi in exams:
+        for (i, col) in columns:
+            fraction_means[ (roi, col) ] = [ sums[(roi, exam, col)][0] / sums[(roi, exam, col)][1]
+                                             for exam in exams[roi] ]
+    return fraction_means
+
+# --------------- #
+
+
+
+class MarginCalculator(object):
+    """
+    Population statistics per ROI and direction, updated one patient at a time
+    and kept in state_filename (if given) between runs
+    """
+
+    def __init__(self, state_filename=None, exclude_exam=isBaseExam):
+        self.state_filename = state_filename
+        self.exclude_exam = exclude_exam
+        self.patients = []
+        self.stats = {}    # (roi, column) -> RunningStats
+
+        if state_filename is not None and os.path.exists(state_filename):
+            with open(state_filename, 'r') as fp:
+                state = json.load(fp)
+            self.patients = state['patients']
+            for entry in state['stats']:
+                self.stats[ (entry['roi'], entry['column']) ] = RunningStats(**entry['stats'])
+
+    def addPatient(self, filename, patient_id=None):
+        """
+        Add the motion csv of one patient (identified by the file name if no
+        patient_id is given); returns False if the patient was already added
+        """
+        if patient_id is None:
+            patient_id = os.path.splitext(os.path.basename(filename))[0]
+        if patient_id in self.patients:
+            return False
+
+        for (key, means) in patientFractionMeans(filename, self.exclude_exam).items():
+            if len(means) == 0:
+                continue
+            patient_mean = sum(means) / len(means)
+            patient_var = None
+            if len(means) > 1:
+                patient_var = sum([ (m - patient_mean)**2 for m in means ]) / (len(means) - 1)
+            self.stats.setdefault(key, RunningStats()).addPatient(patient_mean, patient_var)
+
+        self.patients.append( patient_id )
+        return True
+
+    def save(self):
+        state = {'patients': self.patients,
+                 'stats': [ {'roi': roi, 'column': col, 'stats': self.stats[(roi, col)].toDict()}
+                            for (roi, col) in sorted(self.stats) ]}
+        with open(self.state_filename, 'w') as fp:
+            json.dump(state, fp)
+
+    def marginTable(self):
+        """
+        Rows (roi, column, patients, M, Sigma, sigma, margin), sorted by ROI and column
+        """
+        rows = []
+        for (roi, col) in sorted(self.stats):
+            st = self.stats[(roi, col)]
+            (Sigma, sigma) = (st.systematic(), st.random())
+            margin = SYSTEMATIC_FACTOR * Sigma + RANDOM_FACTOR * sigma
+            rows.append( (roi, col, st.n, st.mean, Sigma, sigma, margin) )
+        return rows
+
+    def writeTable(self, filename):
+        with open(filename, 'w') as fp:
+            fp.write('roi,direction,patients,M,Sigma,sigma,margin\n')
+            for row in self.marginTable():
+                fp.write( ','.join([ str(value) for value in row ]) + '\n' )
+
+# --------------- #
+
+
+
+def main(path=None, prefix=EXPORT_FILE_PREFIX, exclude_exam=isBaseExam):
+    """
+    Add every export in path not yet in the state file and write the margin table
+        prefix       : file name prefix of the exports (EXPORT_FILE_PREFIX)
+        exclude_exam : exam name -> True for the base exams to leave out (isBaseExam)
+    """
+    if path is None:
+        path = dataPath
+
+    calculator = MarginCalculator( os.path.join(path, STATE_FILE), exclude_exam )
+    num_added = 0
+    for (patient_id, filename) in exportFiles(path, prefix):
+        if calculator.addPatient(filename, patient_id):
+            num_added += 1
+            print("... added {}".format(os.path.basename(filename)) )
+    print("Patients added: {} (cohort: {})".format(num_added, len(calculator.patients)) )
+
+    calculator.save()
+    calculator.writeTable( os.path.join(path, TABLE_FILE) )
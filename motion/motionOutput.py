@@ -0,0 +1,508 @@
+"""
+Output writers for the motion analysis (motionEngine)
+
+StreamingCsvWriter writes the csv rows of each ROI/exam pair as soon as they
+have been computed and flushes them to disk, instead of holding every row
+in memory until the end of the run. A small progress file next to the csv
+records which pairs are complete (and the file sizes after each), so a run
+that is interrupted can be resumed: partially written rows are cut off and
+only the missing ROI/exam pairs are analysed again.
+
+IncrementalState keeps what every ROI/exam pair of the last complete output
+was computed from (see motionEngine.MotionAnalysis.pairSignature), so a later
+run only needs to analyse the pairs that are new or have changed and can
+copy the rows of all others from the previous output (readPairLines).
+
+writeColumnar converts a finished csv into a typed columnar file (numpy .npz
+or, if pyarrow is available, Parquet): float columns plus the roi and exam
+columns stored as integer codes into a dictionary of names. loadCohort reads
+many of these back as one set of arrays, which is much faster than parsing
+the csv files of a whole cohort.
+
+writeHeatmaps turns a finished csv into one displacement image per ROI and
+column: a float32 (z slice x exam) matrix, stored as a memory-mappable .npy
+per ROI with a small JSON index of the axes. The slices of all exams are put
+on one z grid (multiples of the slice interval), so they line up even though
+every exam is sampled from its own contours and reference point. A review tool can read the
+indices of a whole cohort and map only the ROI being viewed (openHeatmap).
+
+to use:
+    writer = motionOutput.StreamingCsvWriter( [(filename, header)], resume=True )
+    if not writer.isComplete(roi_name, exam_name):
+        writer.writePair(roi_name, exam_name, [lines])
+    writer.finish()
+    motionOutput.writeColumnar(filename, 'npz')
+
+    data = motionOutput.loadCohort( glob.glob('motionPoints_*.npz') )
+    data['R.x'][ data['roi'] == list(data['roi_names']).index('CTV') ]
+
+    index = motionOutput.writeHeatmaps(filename)
+    (image, z, exams) = motionOutput.openHeatmap(index, 'CTV', 'R.x')
+"""
+
+import os
+import json
+
+import numpy as np
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# --------------- #
+
+
+PROGRESS_SUFFIX = '.progress'
+STATE_SUFFIX = '.state.json'
+
+# Text columns stored as codes into a dictionary of names
+CATEGORICAL_COLUMNS = [ 'roi', 'exam' ]
+# Columns that are positions rather than displacements
+POSITION_COLUMNS = [ 'z', 'z-RefZ' ]
+
+# Heatmaps of <filename> are written to <filename>HEATMAP_SUFFIX/, with index HEATMAP_INDEX
+HEATMAP_SUFFIX = '_HEATMAP'
+HEATMAP_INDEX = 'index.json'
+# z of the heatmap rows are rounded to this many decimals
+HEATMAP_Z_DECIMALS = 4
+
+
+# --------------- #
+
+class StreamingCsvWriter(object):
+    """
+    Streaming output to one or more csv files (e.g. the main and SUPINF output)
+    outputs is a list of (filename, header); all files share one progress file
+    (named after the first) so they always resume from the same point.
+    """
+
+    def __init__(self, outputs, resume=False):
+        self.filenames = [ filename for (filename, header) in outputs ]
+        self.headers = [ header for (filename, header) in outputs ]
+        self.progress_filename = self.filenames[0] + PROGRESS_SUFFIX
+        self.completed = set()
+
+        if resume and self._readProgress():
+            print("Resuming output: {} ROI/exam pairs already complete".format(len(self.completed)) )
+        else:
+            self._startNew()
+
+        self.fps = [ open(filename, 'a') for filename in self.filenames ]
+        self.progress_fp = open(self.progress_filename, 'a')
+
+
+    def _startNew(self):
+        self.completed = set()
+        for (filename, header) in zip(self.filenames, self.headers):
+            with open(filename, 'w') as fp:
+                fp.write( header )
+        sizes = [ os.path.getsize(filename) for filename in self.filenames ]
+        with open(self.progress_filename, 'w') as fp:
+            fp.write( json.dumps({'headers': self.headers, 'sizes': sizes}) + '\n' )
+
+
+    def _readProgress(self):
+        """
+        Read progress of a previous run and cut the csv files back to the end of
+        the last complete pair. Returns False if there is nothing to resume.
+        """
+        if not os.path.exists(self.progress_filename):
+            return False
+        for filename in self.filenames:
+            if not os.path.exists(filename):
+                return False
+
+        with open(self.progress_filename, 'r') as fp:
+            records = []
+            for line in fp:
+                try:
+                    records.append( json.loads(line) )
+                except ValueError:
+                    break   # last record only partly written
+
+        if len(records) == 0 or records[0].get('headers') != self.headers:
+            print("---> WARNING: Previous output has different columns; starting again")
+            return False
+
+        sizes = records[0]['sizes']
+        for record in records[1:]:
+            self.completed.add( (record['roi'], record['exam']) )
+            sizes = record['sizes']
+
+        # Remove anything written after the last complete pair
+        for (filename, size) in zip(self.filenames, sizes):
+            if os.path.getsize(filename) < size:
+                print("---> WARNING: {} is shorter than expected; starting again".format(filename) )
+                return False
+        for (filename, size) in zip(self.filenames, sizes):
+            with open(filename, 'r+') as fp:
+                fp.truncate(size)
+
+        # Rewrite the progress file without any partial record
+        with open(self.progress_filename, 'w') as fp:
+            for record in records:
+                fp.write( json.dumps(record) + '\n' )
+        return True
+
+
+    def isComplete(self, roi_name, exam_name):
+        """True if the rows of this pair were written by an earlier (interrupted) run"""
+        return (roi_name, exam_name) in self.completed
+
+
+    def writePair(self, roi_name, exam_name, lines_per_file):
+        """
+        Write (and flush) the rows of one ROI/exam pair; lines_per_file holds a
+        list of lines for each output file
+        """
+        sizes = []
+        for (fp, lines) in zip(self.fps, lines_per_file):
+            for line in lines:
+                fp.write( line )
+            fp.flush()
+            os.fsync( fp.fileno() )
+            sizes.append( os.fstat(fp.fileno()).st_size )
+
+        self.progress_fp.write( json.dumps({'roi': roi_name, 'exam': exam_name, 'sizes': sizes}) + '\n' )
+        self.progress_fp.flush()
+        self.completed.add( (roi_name, exam_name) )
+
+
+    def finish(self):
+        """
+        Close the output; the progress file is removed as the run is complete
+        """
+        for fp in self.fps:
+            fp.close()
+        self.progress_fp.close()
+        os.remove(self.progress_filename)
+
+
+# --------------- #
+
+def readPairLines(filename, header):
+    """
+    Rows of an existing csv grouped by ROI/exam: {(roi, exam): [lines]}
+    Empty if the file does not exist or has a different header.
+    """
+    pairs = {}
+    if not os.path.exists(filename):
+        return pairs
+    with open(filename, 'r') as fp:
+        if fp.readline() != header:
+            return pairs
+        for line in fp:
+            fields = line.split(',', 2)
+            pairs.setdefault( (fields[0], fields[1]), [] ).append( line )
+    return pairs
+
+# --------------- #
+
+
+
+class IncrementalState(object):
+    """
+    Per-patient state kept next to a complete csv output (<filename>.state.json):
+    the analysis settings and, for every ROI/exam pair, the signature of the
+    data its rows were computed from. Pairs whose signature is unchanged need
+    not be analysed again. A change of settings invalidates every pair.
+    """
+
+    def __init__(self, filename, settings):
+        self.filename = filename + STATE_SUFFIX
+        self.settings = _normalise(settings)
+        self.previous = {}    # (roi, exam) -> signature of the last complete output
+        self.pairs = []       # pairs of the current run, in output order
+
+        if os.path.exists(self.filename):
+            try:
+                with open(self.filename, 'r') as fp:
+                    state = json.load(fp)
+            except ValueError:
+                print("---> WARNING: Could not read {}; analysing all exams".format(self.filename) )
+                state = {}
+            if state.get('settings') == self.settings:
+                for pair in state.get('pairs', []):
+                    self.previous[ (pair['roi'], pair['exam']) ] = pair['signature']
+            elif state:
+                print("---> WARNING: Analysis settings have changed since the last run; analysing all exams")
+
+    def isUnchanged(self, roi_name, exam_name, signature):
+        return self.previous.get( (roi_name, exam_name) ) == _normalise(signature)
+
+    def record(self, roi_name, exam_name, signature):
+        self.pairs.append( {'roi': roi_name, 'exam': exam_name, 'signature': _normalise(signature)} )
+
+    def save(self):
+        with open(self.filename, 'w') as fp:
+            json.dump( {'settings': self.settings, 'pairs': self.pairs}, fp )
+
+
+def discardState(filename):
+    """
+    Remove the IncrementalState of a csv output while it is rewritten, so an
+    interrupted (or non-incremental) run never leaves a state that does not
+    match its output
+    """
+    if os.path.exists(filename + STATE_SUFFIX):
+        os.remove(filename + STATE_SUFFIX)
+
+
+def _normalise(value):
+    """JSON round trip, so tuples compare equal to the lists read back from file"""
+    return json.loads( json.dumps(value) )
+
+# --------------- #
+
+def _encodeCategorical(values):
+    """
+    Return (codes, names) of a list of strings; names are in order of first appearance
+    """
+    names = []
+    lookup = {}
+    codes = np.empty(len(values), dtype=np.int32)
+    for (i, value) in enumerate(values):
+        code = lookup.get(value)
+        if code is None:
+            code = lookup[value] = len(names)
+            names.append(value)
+        codes[i] = code
+    return (codes, names)
+
+
+def readCsvColumns(filename, dtype=np.float64):
+    """
+    Read a motion csv (roi,exam followed by numeric columns) into a dict of arrays:
+        'roi', 'exam'              : int32 codes
+        'roi_names', 'exam_names'  : the names the codes refer to
+        'columns'                  : names of the numeric columns, in file order
+        one array of dtype per numeric column
+    """
+    with open(filename, 'r') as fp:
+        header = fp.readline().strip().split(',')
+        rows = [ line.rstrip('\n').split(',') for line in fp if line.strip() ]
+
+    num_cat = len(CATEGORICAL_COLUMNS)
+    if header[:num_cat] != CATEGORICAL_COLUMNS:
+        raise ValueError("{} does not start with columns {}".format(filename, CATEGORICAL_COLUMNS))
+
+    data = {'columns': header[num_cat:]}
+    for (i, name) in enumerate(CATEGORICAL_COLUMNS):
+        (data[name], data[name + '_names']) = _encodeCategorical([ row[i] for row in rows ])
+
+    values = np.array([ row[num_cat:] for row in rows ], dtype=np.float64).reshape(len(rows), len(header) - num_cat)
+    for (j, name) in enumerate(data['columns']):
+        data[name] = values[:, j].astype(dtype)
+    return data
+
+
+def columnarFilename(csv_filename, fmt):
+    return os.path.splitext(csv_filename)[0] + '.' + fmt
+
+
+def writeColumnar(csv_filename, fmt='npz', dtype=np.float64):
+    """
+    Write the typed columnar form of a finished csv next to it; fmt is 'npz'
+    or 'parquet' (which falls back to npz if pyarrow is not installed).
+    Returns the name of the file written.
+    """
+    if fmt == 'parquet' and pyarrow is None:
+        print("---> WARNING: pyarrow is not available; writing npz instead of parquet")
+        fmt = 'npz'
+    if fmt not in ('npz', 'parquet'):
+        raise ValueError("Unknown columnar format: {}".format(fmt))
+
+    data = readCsvColumns(csv_filename, dtype)
+    filename = columnarFilename(csv_filename, fmt)
+
+    if fmt == 'npz':
+        arrays = dict( (name, data[name]) for name in data['columns'] )
+        arrays['columns'] = np.array(data['columns'], dtype=np.str_)
+        for name in CATEGORICAL_COLUMNS:
+            arrays[name] = data[name]
+            arrays[name + '_names'] = np.array(data[name + '_names'], dtype=np.str_)
+        with open(filename, 'wb') as fp:
+            np.savez(fp, **arrays)
+    else:
+        names = list(CATEGORICAL_COLUMNS) + data['columns']
+        arrays = [ pyarrow.DictionaryArray.from_arrays(data[name], data[name + '_names'])
+                   for name in CATEGORICAL_COLUMNS ]
+        arrays += [ pyarrow.array(data[name]) for name in data['columns'] ]
+        pyarrow.parquet.write_table( pyarrow.Table.from_arrays(arrays, names=names), filename )
+
+    return filename
+
+
+def _readColumnar(filename):
+    """
+    Read one columnar file into the same dict of arrays as readCsvColumns
+    """
+    if filename.endswith('.parquet'):
+        if pyarrow is None:
+            raise ImportError("pyarrow is needed to read {}".format(filename))
+        table = pyarrow.parquet.read_table(filename)
+        data = {'columns': [ name for name in table.column_names if name not in CATEGORICAL_COLUMNS ]}
+        for name in CATEGORICAL_COLUMNS:
+            column = table.column(name).combine_chunks()
+            if not isinstance(column, pyarrow.DictionaryArray):
+                column = column.dictionary_encode()
+            data[name] = column.indices.to_numpy(zero_copy_only=False).astype(np.int32)
+            data[name + '_names'] = column.dictionary.to_pylist()
+        for name in data['columns']:
+            data[name] = table.column(name).to_numpy()
+        return data
+
+    with np.load(filename) as npz:
+        data = {'columns': [ str(name) for name in npz['columns'] ]}
+        for name in CATEGORICAL_COLUMNS:
+            data[name] = npz[name]
+            data[name + '_names'] = [ str(n) for n in npz[name + '_names'] ]
+        for name in data['columns']:
+            data[name] = npz[name]
+    return data
+
+
+def loadCohort(filenames):
+    """
+    Load the columnar output of many patients (.npz or .parquet) as one dict of arrays.
+    As readCsvColumns, plus 'file' : index into filenames of every row.
+    roi/exam codes are remapped onto names shared by the whole cohort.
+    All files must have the same numeric columns.
+    """
+    columns = None
+    names = dict( (name, []) for name in CATEGORICAL_COLUMNS )
+    lookups = dict( (name, {}) for name in CATEGORICAL_COLUMNS )
+    parts = []
+
+    for (file_index, filename) in enumerate(filenames):
+        data = _readColumnar(filename)
+        if columns is None:
+            columns = data['columns']
+        elif data['columns'] != columns:
+            raise ValueError("{} has columns {}, expected {}".format(filename, data['columns'], columns))
+
+        num_rows = len(data[CATEGORICAL_COLUMNS[0]])
+        part = {'file': np.full(num_rows, file_index, dtype=np.int32)}
+        for name in CATEGORICAL_COLUMNS:
+            # Map this file's codes onto the cohort dictionary
+            remap = np.empty(len(data[name + '_names']), dtype=np.int32)
+            for (code, value) in enumerate(data[name + '_names']):
+                if value not in lookups[name]:
+                    lookups[name][value] = len(names[name])
+                    names[name].append(value)
+                remap[code] = lookups[name][value]
+            part[name] = remap[data[name]] if num_rows else np.empty(0, dtype=np.int32)
+        for name in columns:
+            part[name] = data[name]
+        parts.append(part)
+
+    cohort = {'columns': columns or [], 'files': list(filenames)}
+    for name in CATEGORICAL_COLUMNS:
+        cohort[name + '_names'] = names[name]
+    for name in ['file'] + CATEGORICAL_COLUMNS + (columns or []):
+        cohort[name] = np.concatenate([ part[name] for part in parts ]) if parts else np.empty(0)
+    return cohort
+
+# --------------- #
+
+
+
+def heatmapDirectory(csv_filename):
+    return os.path.splitext(csv_filename)[0] + HEATMAP_SUFFIX
+
+
+def heatmapInterval(z, pair_codes):
+    """
+    Smallest median z step between the slices of any ROI/exam pair (pair_codes:
+    a code per row); None if no pair has two slices
+    """
+    steps = []
+    for code in np.unique(pair_codes):
+        z_pair = np.unique(z[pair_codes == code])
+        if len(z_pair) > 1:
+            steps.append( np.median(np.diff(z_pair)) )
+    return min(steps) if steps else None
+
+
+def writeHeatmaps(csv_filename, z_interval=None):
+    """
+    Write the displacement of every ROI as a float32 (column, z, exam) array
+    (NaN where an exam has no slice at that z), one memory-mappable .npy per ROI
+    in <filename>_HEATMAP, and index.json with the axes of each:
+        {'source', 'rois': {roi: {'file', 'shape', 'columns', 'z', 'exams'}}}
+    The z axis runs every z_interval (the slice interval of the analysis; if
+    None, the z step of the csv, see heatmapInterval) over the z (first numeric
+    column of the csv) of the ROI in any exam, and each slice is put in the row
+    nearest its z; the exams are in file order. Returns the name of the index file.
+    """
+    data = readCsvColumns(csv_filename)
+    (z_label, columns) = (data['columns'][0], data['columns'][1:])
+    if z_interval is None:
+        z_interval = heatmapInterval( data[z_label], data['roi'].astype(np.int64) * len(data['exam_names']) + data['exam'] )
+    if z_interval is None:
+        z_interval = 10.0**-HEATMAP_Z_DECIMALS    # a single slice per exam: match z as written
+    z_step = np.floor(data[z_label] / z_interval + 0.5).astype(np.int64)    # row of each slice on the common grid
+
+    directory = heatmapDirectory(csv_filename)
+    try:
+        os.makedirs(directory)
+    except OSError:
+        pass
+
+    index = {'source': os.path.basename(csv_filename), 'rois': {}}
+    for (roi_code, roi_name) in enumerate(data['roi_names']):
+        rows = np.flatnonzero(data['roi'] == roi_code)
+        exam_codes = data['exam'][rows]
+        exams = exam_codes[ np.sort(np.unique(exam_codes, return_index=True)[1]) ]    # in file order
+        exam_position = np.zeros(len(data['exam_names']), dtype=np.intp)
+        exam_position[exams] = np.arange(len(exams))
+        (step_min, step_max) = (z_step[rows].min(), z_step[rows].max())
+        z_axis = np.round(np.arange(step_min, step_max + 1) * z_interval, HEATMAP_Z_DECIMALS)
+
+        filename = 'roi{}.npy'.format(roi_code)
+        shape = (len(columns), len(z_axis), len(exams))
+        image = np.lib.format.open_memmap( os.path.join(directory, filename), mode='w+', dtype=np.float32, shape=shape )
+        image[...] = np.nan
+        (z_of_row, exam_of_row) = ( z_step[rows] - step_min, exam_position[exam_codes] )
+        for (c, col) in enumerate(columns):
+            image[c, z_of_row, exam_of_row] = data[col][rows]
+        image.flush()
+        del image
+
+        index['rois'][roi_name] = {'file': filename, 'shape': list(shape), 'columns': columns,
+                                   'z': z_axis.tolist(), 'exams': [ data['exam_names'][code] for code in exams ]}
+
+    index_filename = os.path.join(directory, HEATMAP_INDEX)
+    with open(index_filename, 'w') as fp:
+        json.dump(index, fp)
+    return index_filename
+
+
+def loadHeatmapIndex(index_filenames):
+    """
+    Read the heatmap indices of a cohort (no image data): {index_filename: index}
+    """
+    indices = {}
+    for index_filename in index_filenames:
+        with open(index_filename, 'r') as fp:
+            indices[index_filename] = json.load(fp)
+    return indices
+
+
+def openHeatmap(index_filename, roi_name, column=None, index=None):
+    """
+    Memory-map the heatmap of one ROI, read only (only the parts used are read
+    from disk). Returns (image, z, exams): image is the (z, exam) matrix of
+    column, or the (column, z, exam) array of all columns if column is None.
+    index: the index of index_filename, if already loaded (loadHeatmapIndex)
+    """
+    if index is None:
+        index = loadHeatmapIndex([index_filename])[index_filename]
+    entry = index['rois'][roi_name]
+    image = np.load( os.path.join(os.path.dirname(index_filename), entry['file']), mmap_mode='r' )
+    if column is not None:
+        image = image[ entry['columns'].index(column) ]
+    return (image, entry['z'], entry['exams'])
+
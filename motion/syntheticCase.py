@@ -0,0 +1,188 @@
+"""
+Synthetic RayStation case for running the motion analysis offline
+
+Builds objects with the same shape as the parts of the RayStation scripting
+API used by motionEngine, so the analysis and benchmarks can be run without
+a live RayStation:
+    case.Examinations                                   (iterable, and indexable by name)
+    exam.Name, exam.EquipmentInfo.FrameOfReference
+    exam.GetAcquisitionDataFromDicom()                  (SeriesInstanceUID, SeriesDateTime: a day apart)
+    case.PatientModel.RegionsOfInterest / PointsOfInterest   (objects with .Name)
+    case.PatientModel.StructureSets[exam].RoiGeometries[roi].PrimaryShape.Contours
+    case.PatientModel.StructureSets[exam].PoiGeometries[poi].Point
+    case.PatientModel.CreatePoi(Examination, Point, Name, ...)
+    case.GetTransformForExaminations(FromExamination, ToExamination)
+
+Each ROI is an elliptical cylinder whose radii vary smoothly along z; every
+exam after the first (the "Planning CT") is shifted and deformed a little.
+Contours per slice > 1 places several islands on each slice; drift moves the
+ROIs (not the reference points) a little further in x in each exam.
+An exam_transform (see rigidTransform) puts every exam after the first in
+another frame: its contours and reference points are moved by the transform,
+and GetTransformForExaminations returns its inverse (exam -> Planning CT),
+as a rigid registration would.
+
+to use:
+    from rmhTools.roiTools import syntheticCase
+    case = syntheticCase.makeCase(num_exams=10, num_slices=80, points_per_contour=200)
+"""
+
+import datetime
+import math
+import random
+from collections import namedtuple
+
+# --------------- #
+
+
+Point = namedtuple('Point', ['x', 'y', 'z'])
+
+
+class Node(object):
+    """Plain attribute holder standing in for a RayStation object"""
+
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+
+class NamedList(list):
+    """List of named objects that can also be indexed by name (as case.Examinations)"""
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            for item in self:
+                if item.Name == key:
+                    return item
+            raise KeyError(key)
+        return list.__getitem__(self, key)
+
+# --------------- #
+
+
+
+def rigidTransform(rotation=0.0, dx=0.0, dy=0.0, dz=0.0):
+    """
+    4x4 rigid transform (16 values in row order): a rotation about z (degrees,
+    from +x towards +y) followed by the translation (dx, dy, dz)
+    """
+    (c, s) = (math.cos(math.radians(rotation)), math.sin(math.radians(rotation)))
+    return [ c, -s, 0.0, dx,  s, c, 0.0, dy,  0.0, 0.0, 1.0, dz,  0.0, 0.0, 0.0, 1.0 ]
+
+
+def invertRigid(transform):
+    """
+    Inverse of a 4x4 rigid transform (16 values in row order)
+    """
+    rotation = [ transform[4*row:4*row+3] for row in range(3) ]
+    shift = [ transform[4*row+3] for row in range(3) ]
+    inverse = []
+    for row in range(3):
+        column = [ rotation[k][row] for k in range(3) ]   # transpose of the rotation
+        inverse += column + [ -sum([ column[k] * shift[k] for k in range(3) ]) ]
+    return inverse + [ 0.0, 0.0, 0.0, 1.0 ]
+
+
+def applyTransform(transform, x, y, z):
+    """
+    (x, y, z) moved by a 4x4 transform (16 values in row order)
+    """
+    return tuple( transform[4*row] * x + transform[4*row+1] * y + transform[4*row+2] * z + transform[4*row+3]
+                  for row in range(3) )
+
+# --------------- #
+
+
+
+def makeContours(rnd, z_start, num_slices, slice_thickness, points_per_contour, contours_per_slice,
+                 centre_x, centre_y, shift_x=0.0, shift_y=0.0, shift_z=0.0, deform=0.0):
+    """
+    Contours (lists of Points) of one elliptical-cylinder ROI
+    """
+    contours = []
+    for s in range(num_slices):
+        z = round(z_start + s * slice_thickness + shift_z, 4)
+        radius_x = 3.0 + math.sin(0.15 * s) + deform * rnd.uniform(-0.2, 0.2)
+        radius_y = 2.0 + 0.5 * math.cos(0.1 * s) + deform * rnd.uniform(-0.2, 0.2)
+        for c in range(contours_per_slice):
+            cx = centre_x + shift_x + c * 2.5 * radius_x
+            cy = centre_y + shift_y
+            contour = []
+            for p in range(points_per_contour):
+                angle = 2.0 * math.pi * p / points_per_contour
+                contour.append( Point(cx + radius_x * math.cos(angle), cy + radius_y * math.sin(angle), z) )
+            contours.append( contour )
+    return contours
+
+# --------------- #
+
+
+
+def makeCase(num_exams=4, rois=('ROI_A', 'ROI_B'), num_slices=60, points_per_contour=100,
+             contours_per_slice=1, slice_thickness=0.25, cbct_slice_thickness=None,
+             ref_point_sp="Ref Point SP", ref_point_rfh="Ref Point RFH", drift=0.0, seed=0,
+             exam_transform=None):
+    """
+    Synthetic case with a "Planning CT" and num_exams-1 CBCTs ("CBCT1", ...),
+    each with every ROI in rois and both reference points.
+    cbct_slice_thickness defaults to slice_thickness; drift is the x shift (cm) of the ROIs added per exam.
+    exam_transform (16 values, see rigidTransform) takes Planning CT coordinates to those of the CBCTs;
+    registered back to the Planning CT their contours are those of the case without it.
+    """
+    rnd = random.Random(seed)
+    if cbct_slice_thickness is None:
+        cbct_slice_thickness = slice_thickness
+
+    examinations = NamedList()
+    structure_sets = {}
+    for e in range(num_exams):
+        name = "Planning CT" if e == 0 else "CBCT{}".format(e)
+        day = datetime.date(2020, 1, 1) + datetime.timedelta(days=e)
+        dicom = {'SeriesModule': {'SeriesInstanceUID': '1.2.826.0.1.{}'.format(e),
+                                  'SeriesDateTime': Node(Year=day.year, Month=day.month, Day=day.day,
+                                                         Hour=9, Minute=0, Second=0)}}
+        examinations.append( Node(Name=name, EquipmentInfo=Node(FrameOfReference="FOR1"),
+                                  GetAcquisitionDataFromDicom=lambda dicom=dicom: dicom) )
+
+        (shift_x, shift_y, shift_z) = (0.0, 0.0, 0.0) if e == 0 else \
+            (rnd.uniform(-0.5, 0.5), rnd.uniform(-0.5, 0.5), rnd.uniform(-0.3, 0.3))
+        thickness = slice_thickness if e == 0 else cbct_slice_thickness
+
+        geometries = {}
+        for (r, roi) in enumerate(rois):
+            contours = makeContours(rnd, -10.0 + 2.0 * r, int(num_slices * slice_thickness / thickness), thickness,
+                                    points_per_contour, contours_per_slice, 1.0 + r, -2.0,
+                                    shift_x + drift * e, shift_y, shift_z, deform=0.0 if e == 0 else 1.0)
+            if exam_transform is not None and e > 0:
+                contours = [ [ Point(*applyTransform(exam_transform, pt.x, pt.y, pt.z)) for pt in contour ]
+                             for contour in contours ]
+            geometries[roi] = Node(PrimaryShape=Node(Contours=contours))
+
+        ref_points = [ (ref_point_sp, (rnd.uniform(-0.2, 0.2), rnd.uniform(-0.2, 0.2), -15.0 + shift_z)),
+                       (ref_point_rfh, (8.0 + shift_x, rnd.uniform(-0.2, 0.2), -5.0 + shift_z)) ]
+        points = {}
+        for (poi, (x, y, z)) in ref_points:
+            if exam_transform is not None and e > 0:
+                (x, y, z) = applyTransform(exam_transform, x, y, z)
+            points[poi] = Node(Point=Node(x=x, y=y, z=z))
+        structure_sets[name] = Node(RoiGeometries=geometries, PoiGeometries=points)
+
+    def getTransform(FromExamination, ToExamination):
+        # the CBCTs all share one frame, exam_transform away from the Planning CT
+        if exam_transform is None or (FromExamination == "Planning CT") == (ToExamination == "Planning CT"):
+            return rigidTransform()
+        if FromExamination == "Planning CT":
+            return list(exam_transform)
+        return invertRigid(exam_transform)
+
+    points_of_interest = [ Node(Name=ref_point_sp), Node(Name=ref_point_rfh) ]
+
+    def createPoi(Examination, Point, Name, **kwargs):
+        # the point is placed in Examination; its geometry in the other exams is undefined
+        points_of_interest.append( Node(Name=Name) )
+        for (name, sSet) in structure_sets.items():
+            sSet.PoiGeometries[Name] = Node(Point=Point if name == Examination.Name else None)
+
+    patient_model = Node( StructureSets=structure_sets,
+                          RegionsOfInterest=[ Node(Name=roi) for roi in rois ],
+                          PointsOfInterest=points_of_interest, CreatePoi=createPoi )
+    return Node( Examinations=examinations, PatientModel=patient_model, GetTransformForExaminations=getTransform )
@@ -0,0 +1,382 @@
+"""
+Unit tests of the module contourEngine
+
+To run tests type:
+    from rmhTools.roiTools import test_contourEngine
+    test_contourEngine.run_tests()
+"""
+
+# -------------- #
+
+import random
+from collections import namedtuple
+
+from . import contourEngine
+
+# -------------- #
+
+Point = namedtuple('Point', ['x', 'y', 'z'])
+
+
+def makeContour(z, coords):
+    """Contour on slice z from list of (x,y)"""
+    return [ Point(x, y, z) for (x, y) in coords ]
+
+
+def loopExtremePoints(contour_list, refX, refY, refZ):
+    """
+    Extreme points found point by point, as findExtremePoints_2 in motionByPoints
+    """
+    minX=9E99; minY=9E99; maxX=-9E99; maxY=-9E99
+    for contour in contour_list:
+        for pt in contour:
+            if pt.x < minX:
+                minX = pt.x;  ptR = pt
+            if pt.y < minY:
+                minY = pt.y;  ptA = pt
+            if pt.x > maxX:
+                maxX = pt.x;  ptL = pt
+            if pt.y > maxY:
+                maxY = pt.y;  ptP = pt
+    extremes = {}
+    for (name, pt) in [('R', ptR), ('L', ptL), ('A', ptA), ('P', ptP)]:
+        extremes[name+'.x'] = pt.x-refX
+        extremes[name+'.y'] = pt.y-refY
+        extremes[name+'.z'] = pt.z-refZ
+    return extremes
+
+# -------------- #
+
+def test_singleContourExtremes():
+    """
+    Do we find the R/L/A/P points of a single contour?
+    """
+    contours = [ makeContour(1.0, [(0,0), (2,1), (1,3), (-1,2)]) ]
+    packed = contourEngine.packContourList(contours)
+
+    result = contourEngine.findExtremePointsForSlices(packed, [1.0], 0.5, 0.5, 1.0)[0]
+
+    assert(result['R.x'] == -1.5 and result['R.y'] == 1.5)
+    assert(result['L.x'] == 1.5 and result['L.y'] == 0.5)
+    assert(result['A.x'] == -0.5 and result['A.y'] == -0.5)
+    assert(result['P.x'] == 0.5 and result['P.y'] == 2.5)
+    assert(result['R.z'] == 0.0)
+
+# -------------- #
+
+def test_multipleContoursOnSlice():
+    """
+    Are all contours within tolerance of the closest slice used?
+    """
+    contours = [ makeContour(0.0, [(0,0), (1,0), (1,1)]),
+                 makeContour(0.3, [(0,0), (1,0), (1,1)]),
+                 makeContour(0.3004, [(5,0), (6,-2), (6,1)]),
+                 makeContour(0.6, [(9,9), (10,9), (10,10)]) ]
+    packed = contourEngine.packContourList(contours)
+
+    result = contourEngine.findExtremePointsForSlices(packed, [0.35], 0.0, 0.0, 0.0)[0]
+
+    assert(result['R.x'] == 0 and result['L.x'] == 6)
+    assert(result['A.y'] == -2 and result['P.y'] == 1)
+
+# -------------- #
+
+def test_tiesTakeFirstPoint():
+    """
+    When several points are equally extreme is the first one chosen?
+    """
+    contours = [ makeContour(0.0, [(0,1), (0,2), (3,2), (3,1)]),
+                 makeContour(0.0, [(0,5), (3,-4), (3,0)]) ]
+
+    result = contourEngine.findExtremePoints(contours, 0.0, 0.0, 0.0)
+
+    assert(result['R.y'] == 1)
+    assert(result['L.y'] == 2)
+    assert(result['A.x'] == 3)
+
+# -------------- #
+
+def test_matchesPointLoop():
+    """
+    Do vectorised results match the point by point loop on random contours?
+    """
+    rnd = random.Random(1)
+    contours = []
+    for sl in range(40):
+        z = sl*0.3
+        for c in range(rnd.randint(1,3)):
+            coords = [ (rnd.uniform(-10,10), rnd.uniform(-10,10)) for p in range(rnd.randint(3,50)) ]
+            contours.append( makeContour(z, coords) )
+    rnd.shuffle(contours)
+    packed = contourEngine.packContourList(contours)
+
+    z_list = [ -1.0 + 0.25*i for i in range(55) ]
+    result = contourEngine.findExtremePointsForSlices(packed, z_list, 1.1, -2.3, 0.7)
+
+    for (z, ext) in zip(z_list, result):
+        nearest = min( [con[0].z for con in contours], key=lambda cz: abs(cz-z) )
+        same_slice = [ con for con in contours if abs(con[0].z - nearest) < 0.001 ]
+        assert( ext == loopExtremePoints(same_slice, 1.1, -2.3, 0.7) )
+
+# -------------- #
+
+def test_tiesInEveryGroup():
+    """
+    With ties on many slices at once, is the first extreme point of each slice chosen?
+    """
+    rnd = random.Random(2)
+    contours = []
+    for sl in range(30):
+        for c in range(rnd.randint(1,3)):
+            coords = [ (rnd.randint(-3,3), rnd.randint(-3,3)) for p in range(rnd.randint(3,20)) ]
+            contours.append( makeContour(sl*0.25, coords) )
+    packed = contourEngine.packContourList(contours)
+
+    z_list = [ 0.25*i for i in range(30) ]
+    result = contourEngine.findExtremePointsForSlices(packed, z_list, 0.0, 0.0, 0.0)
+
+    for (z, ext) in zip(z_list, result):
+        same_slice = [ con for con in contours if abs(con[0].z - z) < 0.001 ]
+        assert( ext == loopExtremePoints(same_slice, 0.0, 0.0, 0.0) )
+
+# -------------- #
+
+def test_sliceIndexNearest():
+    """
+    Does the sorted slice index pick the same contour as a linear scan?
+    """
+    rnd = random.Random(2)
+    contour_z = [ rnd.choice([0.0, 0.2, 0.4, 0.6, 1.0, 1.0, 1.2]) for c in range(30) ]
+    index = contourEngine.SliceIndex(contour_z)
+
+    z_list = [ -0.5 + 0.05*i for i in range(40) ] + [0.1, 0.3, 0.8, 5.0]
+    vector_result = index.nearestContours(z_list)
+
+    for (z, vec) in zip(z_list, vector_result):
+        minZDiff = 9E99
+        for (cc, cZ) in enumerate(contour_z):
+            if abs(cZ-z) < minZDiff:
+                minZDiff = abs(cZ-z);  minInd = cc
+        assert( index.nearestContour(z) == minInd )
+        assert( vec == minInd )
+
+    assert( index.limits() == (0.0, 1.2) )
+
+# -------------- #
+
+def test_sameSliceContours():
+    """
+    Are contours within tolerance grouped, in contour order?
+    """
+    index = contourEngine.SliceIndex([0.3, 0.0, 0.3004, 0.302, 0.2996])
+
+    assert( index.sameSliceContours(0) == [0, 2, 4] )
+    assert( index.sameSliceContours(3) == [3] )
+
+# -------------- #
+
+def test_referenceSliceMatching():
+    """
+    Are exam slices matched to the closest reference slice, with and without clamping?
+    """
+    planning = [ {'z': -1.0 + 0.25*i} for i in range(9) ]
+    reference = contourEngine.ReferenceSlices(planning)
+
+    z_values = [ -2.0, -1.0, -0.875, 0.1, 0.95, 3.0 ]
+    result = reference.match(z_values)
+
+    for (z, closest_indx) in zip(z_values, result):
+        min_diff = 9E99
+        for (ind, dct) in enumerate(planning):
+            if abs(z - dct['z']) < min_diff:
+                min_diff = abs(z - dct['z']);  expected = ind
+        assert( closest_indx == expected )
+
+    assert( reference.match(z_values, clamp=False) == [-1, 0, 0, 4, 8, -1] )
+
+# -------------- #
+
+def test_directionalExtremes():
+    """
+    Do the extremes along 4 directions agree with the L/P/R/A points, and are
+    8 oblique directions the largest projection of the points of each slice?
+    """
+    random.seed(4)
+    contours = []
+    for z in [0.0, 0.0, 0.3, 0.6]:
+        contours.append( makeContour(z, [ (random.uniform(-3,3), random.uniform(-3,3)) for i in range(20) ]) )
+    packed = contourEngine.packContourList(contours)
+    z_list = [ 0.0, 0.25, 0.6 ]
+
+    directions = contourEngine.directionVectors(4)
+    assert( contourEngine.directionLabels(directions) == ['D0', 'D90', 'D180', 'D270'] )
+    for ext in contourEngine.findExtremePointsForSlices(packed, z_list, 0.5, -0.2, 0.0, directions):
+        assert( ext['D0'] == ext['L.x'] and ext['D90'] == ext['P.y'] )
+        assert( ext['D180'] == -ext['R.x'] and ext['D270'] == -ext['A.y'] )
+
+    directions = contourEngine.directionVectors(8)
+    result = contourEngine.findExtremePointsForSlices(packed, z_list, 0.5, -0.2, 0.0, directions)
+    for (ext, slice_contours) in zip(result, [contours[:2], contours[2:3], contours[3:]]):
+        for (label, (ux, uy)) in zip(contourEngine.directionLabels(directions), directions):
+            expected = max([ (pt.x-0.5)*ux + (pt.y+0.2)*uy for con in slice_contours for pt in con ])
+            assert( abs(ext[label] - expected) < 1E-9 )
+
+# -------------- #
+
+def test_sliceShapes():
+    """
+    Are area, perimeter, centroid and bounding box right for one and for two contours on a slice?
+    """
+    square = makeContour(0.0, [(0,0), (2,0), (2,2), (0,2)])
+    triangle = makeContour(1.0, [(4,0), (7,0), (4,3)])           # clockwise or not, area is positive
+    second = makeContour(1.0, [(0,0), (0,1), (1,1), (1,0)])
+    packed = contourEngine.packContourList([square, triangle, second])
+
+    result = contourEngine.findExtremePointsForSlices(packed, [0.0, 1.0], 1.0, 0.5, 0.0, shape=True)
+
+    assert( result[0]['area'] == 4.0 and result[0]['perimeter'] == 8.0 )
+    assert( result[0]['C.x'] == 0.0 and result[0]['C.y'] == 0.5 )
+    assert( result[0]['width'] == 2.0 and result[0]['height'] == 2.0 )
+
+    # triangle (area 4.5, centroid (5,1)) and unit square (area 1, centroid (0.5,0.5))
+    assert( result[1]['area'] == 5.5 )
+    assert( abs(result[1]['perimeter'] - (6 + 18**0.5 + 4)) < 1E-12 )
+    assert( abs(result[1]['C.x'] - ((4.5*5 + 0.5) / 5.5 - 1.0)) < 1E-12 )
+    assert( abs(result[1]['C.y'] - ((4.5*1 + 0.5) / 5.5 - 0.5)) < 1E-12 )
+    assert( result[1]['width'] == 7.0 and result[1]['height'] == 3.0 )
+
+# -------------- #
+
+def test_sliceProfileInterpolation():
+    """
+    Is every contoured slice used once, and are profiles interpolated linearly onto the grid?
+    """
+    contours = [ makeContour(0.0, [(0,0), (2,0), (2,2)]),
+                 makeContour(0.0005, [(5,0), (6,0), (6,1)]),    # same slice as the first
+                 makeContour(0.5, [(-1,0), (4,0), (4,2)]) ]
+    packed = contourEngine.packContourList(contours)
+
+    profile = contourEngine.sliceProfile(packed, 0.0, 0.0, 0.25)
+    assert( profile.z.tolist() == [-0.25, 0.25] )
+    assert( profile.arrays['L.x'].tolist() == [6.0, 4.0] and profile.arrays['R.x'].tolist() == [0.0, -1.0] )
+
+    z_grid = contourEngine.profileGrid(-0.25, 0.25, 0.2)
+    assert( len(z_grid) == 3 and abs(z_grid[0] + 0.2) < 1E-12 and abs(z_grid[2] - 0.2) < 1E-12 )
+
+    values = profile.interpolate([-1.0, 0.0, 0.125, 1.0], ['R.x', 'L.x'])
+    assert( values['R.x'].tolist() == [0.0, -0.5, -0.75, -1.0] )
+    assert( values['L.x'].tolist() == [6.0, 5.0, 4.5, 4.0] )
+
+# -------------- #
+
+def test_sliceMesh():
+    """
+    Does cutting a triangulated box give one square polygon on every plane inside it?
+    """
+    import numpy as np
+    vertices = np.array( [ (x, y, z) for z in (0.0, 1.0) for y in (0.0, 2.0) for x in (0.0, 2.0) ] )
+    triangles = np.array( [ (0,1,3), (0,3,2), (4,7,5), (4,6,7), (0,5,1), (0,4,5),
+                            (2,3,7), (2,7,6), (0,2,6), (0,6,4), (1,5,7), (1,7,3) ] )
+
+    packed = contourEngine.sliceMesh(vertices, triangles, [0.75, 0.25, 0.5, 1.5])
+    assert( packed.numContours() == 3 )
+    assert( packed.z.tolist() == [0.25, 0.5, 0.75] )
+
+    for ext in contourEngine.findExtremePointsForSlices(packed, [0.25, 0.5, 0.75], 0.0, 0.0, 0.0, shape=True):
+        assert( ext['R.x'] == 0.0 and ext['L.x'] == 2.0 and ext['A.y'] == 0.0 and ext['P.y'] == 2.0 )
+        assert( ext['area'] == 4.0 and ext['perimeter'] == 8.0 )
+        assert( ext['C.x'] == 1.0 and ext['C.y'] == 1.0 )
+
+# -------------- #
+
+def test_transformPacked():
+    """
+    Are all points moved by a 4x4 transform, with the contours of a slice kept together?
+    """
+    contours = [ makeContour(0.0, [(0,0), (1,0), (1,1)]), makeContour(0.0, [(5,0), (6,0), (6,1)]),
+                 makeContour(0.5, [(0,0), (2,0), (2,2)]) ]
+    packed = contourEngine.packContourList(contours)
+
+    shift = contourEngine.transformMatrix( [1,0,0,1.5, 0,1,0,-1.0, 0,0,1,0.25, 0,0,0,1] )
+    moved = contourEngine.transformPacked(packed, shift)
+    assert( (moved.points - packed.points).tolist() == [[1.5, -1.0, 0.25]] * len(packed.points) )
+    assert( moved.z.tolist() == [0.25, 0.25, 0.75] )
+
+    # a small tilt moves the points of a slice to different z, but not the slice itself
+    tilt = contourEngine.transformMatrix( {'M11':1, 'M12':0, 'M13':0, 'M14':0, 'M21':0, 'M22':1, 'M23':0, 'M24':0,
+                                           'M31':0.01, 'M32':0, 'M33':1, 'M34':0, 'M41':0, 'M42':0, 'M43':0, 'M44':1} )
+    tilted = contourEngine.transformPacked(packed, tilt)
+    assert( tilted.z[0] == tilted.z[1] and tilted.sliceIndex.sameSliceContours(0) == [0, 1] )
+
+# -------------- #
+
+def test_surfaceDisplacement():
+    """
+    Is the distance to the nearest exam point found for every base point?
+    """
+    import numpy as np
+    random.seed(5)
+    base = np.array( [ (random.uniform(-5,5), random.uniform(-5,5), random.uniform(-5,5)) for i in range(200) ] )
+    exam = base + [0.0, 0.0, 0.01]
+
+    result = contourEngine.surfaceDisplacement(base, exam)
+    assert( abs(result['mean'] - 0.01) < 1E-9 and abs(result['max'] - 0.01) < 1E-9 )
+    assert( abs(result['dz'] - 0.01) < 1E-9 and abs(result['dx']) < 1E-12 )
+
+    exam = np.array( [ (random.uniform(-5,5), random.uniform(-5,5), random.uniform(-5,5)) for i in range(300) ] )
+    result = contourEngine.surfaceDisplacement(base, exam)
+    brute = [ min( [ sum((q - p)**2)**0.5 for q in exam ] ) for p in base ]
+    assert( abs(result['mean'] - sum(brute) / len(brute)) < 1E-9 and abs(result['max'] - max(brute)) < 1E-12 )
+
+# -------------- #
+
+def test_sliceSpacingAndDuplicates():
+    """
+    Is the contour spacing found, and are sampled positions sharing their nearest slice dropped?
+    """
+    contours = [ [ Point(0,0,z), Point(1,0,z), Point(1,1,z) ] for z in [0.0, 0.5, 1.0, 1.5] ]
+    packed = contourEngine.packContourList(contours)
+    assert( contourEngine.sliceSpacing(packed.sliceIndex) == 0.5 )
+    assert( contourEngine.sliceSpacing(contourEngine.packContourList(contours[:1]).sliceIndex) is None )
+
+    # float noise of DICOM positions (up to 10 um) does not change the 0.25 cm spacing
+    rnd = random.Random(0)
+    jittered = [ [ Point(0,0,z), Point(1,0,z), Point(1,1,z) ]
+                 for z in [ -12.3 + 0.25*i + rnd.uniform(-0.001, 0.001) for i in range(40) ] ]
+    assert( contourEngine.sliceSpacing(contourEngine.packContourList(jittered).sliceIndex) == 0.25 )
+
+    # 0.0 and 0.1 are both nearest slice 0.0; 0.3 and 0.5 both nearest 0.5
+    z_list = [0.0, 0.1, 0.3, 0.5, 0.9, 1.6]
+    assert( contourEngine.collapseDuplicateSlices(packed.sliceIndex, z_list) == [0.0, 0.3, 0.9, 1.6] )
+
+# -------------- #
+
+def test_sliceRecordDifferences():
+    """
+    Do the bulk differences to the matched reference slices equal the per-slice dictionary ones?
+    """
+    random.seed(7)
+    contours = [ [ Point(random.uniform(-3,3), random.uniform(-3,3), 0.25*s) for i in range(30) ] for s in range(12) ]
+    packed = contourEngine.packContourList(contours)
+    z_list = [ 0.1*i for i in range(28) ]
+
+    records = contourEngine.extremePointRecords(packed, z_list, 0.5, -0.2, 0.3)
+    base = contourEngine.ReferenceSlices( contourEngine.extremePointRecords(packed, z_list[::3], 0.4, 0.1, 0.3) )
+    closest = base.match( [ z - 0.3 for z in z_list ] )
+    deltas = records.difference(base.records, closest, ['R.x', 'A.y'])
+
+    ext_list = contourEngine.findExtremePointsForSlices(packed, z_list, 0.5, -0.2, 0.3)
+    for (s, (ext, c)) in enumerate(zip(ext_list, closest)):
+        assert( records[s]['L.x'] == ext['L.x'] )
+        assert( deltas[0, s] == ext['R.x'] - base[c]['R.x'] and deltas[1, s] == ext['A.y'] - base[c]['A.y'] )
+
+# -------------- #
+
+
+
+def run_tests():
+    """
+    Run all the automated tests on this script
+    """
+    import nose
+    nose.run(argv=['', __file__, '-v'])
@@ -0,0 +1,98 @@
+"""
+Tests of the module motionBatch, with a stand-in patient database and script
+
+To run tests type:
+    from rmhTools.roiTools import test_motionBatch
+    test_motionBatch.run_tests()
+"""
+
+# -------------- #
+
+import os
+import json
+import shutil
+import tempfile
+
+from . import motionBatch
+from . import syntheticCase
+
+# -------------- #
+
+
+class PatientDB(object):
+    """Patient database holding one case per patient ID"""
+
+    def __init__(self, patient_ids):
+        self.patient_ids = patient_ids
+
+    def QueryPatientInfo(self, Filter):
+        return [ Filter['PatientID'] ] if Filter['PatientID'] in self.patient_ids else []
+
+    def LoadPatient(self, PatientInfo, AllowPatientUpgrade):
+        case = syntheticCase.Node( CaseName='CASE 1', SetCurrent=lambda: None )
+        return syntheticCase.Node( PatientID=PatientInfo, Cases=[case] )
+
+
+class Script(object):
+    """Stand-in for motionByPoints, recording its calls; stops the batch at interrupt_at"""
+
+    def __init__(self, interrupt_at=None):
+        self.interrupt_at = interrupt_at
+        self.calls = []
+
+    def analyseCase(self, patient, case, resume=False, incremental=False):
+        self.calls.append( (patient.PatientID, resume) )
+        if patient.PatientID == self.interrupt_at:
+            raise KeyboardInterrupt()
+
+# -------------- #
+
+def test_jobFileResume():
+    """
+    Does a batch that was stopped carry on where it left off: done patients
+    skipped, the interrupted one resumed and failed ones only retried if asked?
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        list_filename = os.path.join(directory, 'patients.txt')
+        with open(list_filename, 'w') as fp:
+            fp.write('# patients\nP1\n\nP2, CASE 1\nMISSING\nP3\n')
+        patients = motionBatch.readPatientList(list_filename)
+        assert( patients == [('P1', None), ('P2', 'CASE 1'), ('MISSING', None), ('P3', None)] )
+
+        job_filename = os.path.join(directory, 'jobs.json')
+        patient_db = PatientDB(['P1', 'P2', 'P3'])
+        script = Script(interrupt_at='P2')
+        try:
+            motionBatch.runBatch(patients, script, job_filename, patient_db=patient_db)
+            assert( False )
+        except KeyboardInterrupt:
+            pass
+        with open(job_filename, 'r') as fp:
+            assert( [ job['status'] for job in json.load(fp)['jobs'] ] == ['done', 'running', 'pending', 'pending'] )
+
+        script = Script()
+        jobs = motionBatch.runBatch(patients, script, job_filename, patient_db=patient_db)
+        assert( script.calls == [('P2', True), ('P3', False)] )
+        assert( jobs.summary() == {'done': 3, 'failed': 1} )
+        with open(job_filename + motionBatch.LOG_SUFFIX, 'r') as fp:
+            assert( 'MISSING' in fp.read() )
+
+        script = Script()
+        jobs = motionBatch.runBatch(patients + [('P4', None)], script, job_filename, patient_db=patient_db)
+        assert( script.calls == [] and jobs.summary() == {'done': 3, 'failed': 2} )
+        jobs = motionBatch.runBatch(patients, script, job_filename, retry_failed=True, patient_db=PatientDB(['MISSING']))
+        assert( script.calls == [('MISSING', False)] and jobs.summary() == {'done': 4, 'failed': 1} )
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+# -------------- #
+
+
+
+def run_tests():
+    """
+    Run all the automated tests on this script
+    """
+    import nose
+    nose.run(argv=['', __file__, '-v'])
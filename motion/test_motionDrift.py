@@ -0,0 +1,102 @@
+"""
+Tests of the module motionDrift, on simulated series of fraction means and
+on synthetic cases (syntheticCase)
+
+To run tests type:
+    from rmhTools.roiTools import test_motionDrift
+    test_motionDrift.run_tests()
+"""
+
+# -------------- #
+
+import os
+import random
+import shutil
+import tempfile
+
+from . import motionDrift
+from . import motionEngine
+from . import syntheticCase
+
+# -------------- #
+
+
+def seriesFlags(values):
+    """Flags raised over a series of daily fraction means, as {flag: first fraction}"""
+    detector = motionDrift.DriftDetector()
+    flags = {}
+    for (day, value) in enumerate(values):
+        for flag in detector.update(float(day), value)['flag'].split('+'):
+            if flag:
+                flags.setdefault(flag, day)
+    return flags
+
+# -------------- #
+
+def test_noiseFalseAlarms():
+    """
+    Do few series of pure noise raise a flag, whatever the size of the noise?
+    """
+    rnd = random.Random(1)
+    for sigma in [0.001, 0.1, 0.5]:
+        flagged = [ len(seriesFlags([ rnd.gauss(1.0, sigma) for day in range(35) ])) > 0 for seed in range(400) ]
+        assert( sum(flagged) < 0.1 * len(flagged) )
+    # constant fraction means (no noise at all)
+    assert( seriesFlags([0.2] * 35) == {} )
+
+# -------------- #
+
+def test_stepDetected():
+    """
+    Is a shift of 5 SDs from fraction 12 on flagged as a step within a few fractions?
+    """
+    rnd = random.Random(2)
+    for seed in range(50):
+        flags = seriesFlags([ rnd.gauss(0.0, 0.1) + (0.5 if day >= 12 else 0.0) for day in range(35) ])
+        assert( 12 <= flags.get('step', -1) <= 16 )
+
+# -------------- #
+
+def test_driftingCase():
+    """
+    Is a drift of the ROIs in x flagged (and not in y), and are the same flags
+    found when the exams are added one run at a time as in one run?
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, 'motion.csv')
+        table = os.path.join(directory, 'motion' + motionDrift.DRIFT_SUFFIX)
+
+        def analyse(case):
+            motionEngine.MotionAnalysis( case, ['ROI_A'], motionEngine.PlanningNameBase(), 0.25, drift=True ).run(filename)
+            with open(table, 'r') as fp:
+                rows = [ line.strip().split(',') for line in fp.readlines()[1:] ]
+            return set([ (row[5], flag) for row in rows for flag in row[-1].split('+') if flag ])
+
+        assert( analyse(syntheticCase.makeCase(num_exams=16, num_slices=10, drift=0.0)) == set() )
+
+        for num_exams in [8, 12, 16]:
+            case = syntheticCase.makeCase(num_exams=16, num_slices=10, drift=0.1)
+            del case.Examinations[num_exams:]
+            flags = analyse(case)
+        with open(table, 'r') as fp:
+            added = fp.read()
+        os.remove(filename + motionDrift.STATE_SUFFIX)
+        assert( analyse(syntheticCase.makeCase(num_exams=16, num_slices=10, drift=0.1)) == flags )
+        with open(table, 'r') as fp:
+            assert( fp.read() == added )
+
+        assert( set([ col for (col, flag) in flags ]) == set(['R.x', 'L.x', 'A.x', 'P.x']) )
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+# -------------- #
+
+
+
+def run_tests():
+    """
+    Run all the automated tests on this script
+    """
+    import nose
+    nose.run(argv=['', __file__, '-v'])
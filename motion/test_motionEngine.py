@@ -0,0 +1,332 @@
+"""
+Tests of the module motionEngine, run end to end on synthetic cases (syntheticCase)
+
+To run tests type:
+    from rmhTools.roiTools import test_motionEngine
+    test_motionEngine.run_tests()
+"""
+
+# -------------- #
+
+import os
+import sys
+import shutil
+import tempfile
+
+from . import motionEngine
+from . import motionOutput
+from . import syntheticCase
+
+# -------------- #
+
+
+class EquipmentInfo(object):
+    """EquipmentInfo that counts the reads of its FrameOfReference"""
+
+    def __init__(self, frame):
+        self.frame = frame
+        self.reads = 0
+
+    @property
+    def FrameOfReference(self):
+        self.reads += 1
+        return self.frame
+
+
+def readFile(filename):
+    with open(filename, 'r') as fp:
+        return fp.read()
+
+
+def runAnalysis(case, filename, rois=('ROI_A', 'ROI_B'), slice_interval=0.25, **options):
+    """Run a MotionAnalysis of case compared to its Planning CT; returns the csv written"""
+    analysis = motionEngine.MotionAnalysis( case, list(rois), motionEngine.PlanningNameBase(), slice_interval, **options )
+    analysis.run(filename)
+    return readFile(filename)
+
+# -------------- #
+
+def test_analyseCaseSettings():
+    """
+    Are the options set by a script used, and the defaults of motionEngine for all others?
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        case = syntheticCase.makeCase(num_exams=3, num_slices=20)
+        settings = syntheticCase.Node( DESIRED_ROIS=['ROI_A'], SLICE_INTERVAL=0.25, dataPath=directory,
+                                       EXPORT_FILE_PREFIX='motionPoints_', EXPORT_FILE_SUFFIX='_test',
+                                       COLUMNS=motionEngine.LR_AP_COLUMNS, EXPORT_SUPINF=True )
+        filename = motionEngine.analyseCase( settings, syntheticCase.Node(PatientID='P1'), case,
+                                             motionEngine.PlanningNameBase() )
+
+        assert( filename == os.path.join(directory, 'motionPoints_P1_test.csv') )
+        assert( readFile(filename).splitlines()[0] == 'roi,exam,z,R.x,L.x,P.y,A.y' )
+        assert( set([ line.split(',')[1] for line in readFile(filename).splitlines()[1:] ]) ==
+                set(['Planning CT', 'CBCT1', 'CBCT2']) )
+        assert( len(readFile( os.path.join(directory, 'motionPoints_P1_test_SUPINF.csv') ).splitlines()) == 4 )
+        # SURFACE_DISPLACEMENT, HEATMAP_EXPORT, ... are off by default
+        assert( sorted([ f for f in os.listdir(directory) if not f.endswith('.json') ]) ==
+                ['motionPoints_P1_test.csv', 'motionPoints_P1_test_SUPINF.csv'] )
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+# -------------- #
+
+def test_planningIndex():
+    """
+    Is each exam matched to the one planning scan sharing its FrameOfReference,
+    with a MissingDataError if there is none or more than one, reading each
+    FrameOfReference once?
+    """
+    frames = [ ('Planning CT', 'FOR1'), ('CBCT1', 'FOR1'), ('Planning CT 2', 'FOR2'), ('CBCT2', 'FOR2'),
+               ('CBCT3', 'FOR3'), ('planningCT A', 'FOR4'), ('PlanningCT B', 'FOR4'), ('CBCT4', 'FOR4') ]
+    exams = dict( (name, syntheticCase.Node(Name=name, EquipmentInfo=EquipmentInfo(frame))) for (name, frame) in frames )
+    index = motionEngine.PlanningIndex( [ exams[name] for (name, frame) in frames ] )
+
+    for i in range(2):
+        assert( index.lookup(exams['CBCT1']) is exams['Planning CT'] )
+        assert( index.lookup(exams['CBCT2']) is exams['Planning CT 2'] )
+        assert( index.lookup(exams['Planning CT 2']) is exams['Planning CT 2'] )
+        for name in ['CBCT3', 'CBCT4']:
+            try:
+                index.lookup(exams[name])
+                assert( False )
+            except motionEngine.MissingDataError:
+                pass
+    assert( all([ exam.EquipmentInfo.reads == 1 for exam in exams.values() ]) )
+
+    # an exam not in the index is looked up by its own FrameOfReference
+    assert( index.lookup( syntheticCase.Node(Name='CBCT5', EquipmentInfo=EquipmentInfo('FOR2')) ) is exams['Planning CT 2'] )
+
+    # exams without a planning scan are left out of the output
+    directory = tempfile.mkdtemp()
+    try:
+        case = syntheticCase.makeCase(num_exams=4, num_slices=10)
+        case.Examinations['CBCT2'].EquipmentInfo = syntheticCase.Node(FrameOfReference='FOR2')
+        analysis = motionEngine.MotionAnalysis( case, ['ROI_A'], motionEngine.FrameOfReferenceBase(), 0.25 )
+        analysis.run( os.path.join(directory, 'motion.csv') )
+        lines = readFile( os.path.join(directory, 'motion.csv') ).splitlines()[1:]
+        assert( set([ line.split(',')[1] for line in lines ]) == set(['Planning CT', 'CBCT1', 'CBCT3']) )
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+# -------------- #
+
+def test_poiWriter():
+    """
+    Are the markers of every exam created once, in one composite action, at
+    extreme points of the ROI, and moved (not created again) by a later run?
+    """
+    assert( motionEngine.markerSlices(10, 4) == [0, 3, 6, 9] )
+    assert( motionEngine.markerSlices(10, None, 3) == [0, 3, 6, 9] )
+    assert( motionEngine.markerSlices(5, 10) == [0, 1, 2, 3, 4] )
+
+    actions = []
+    class CompositeAction(object):
+        def __init__(self, name):
+            actions.append( name )
+        def __enter__(self):
+            return self
+        def __exit__(self, *args):
+            return False
+
+    case = syntheticCase.makeCase(num_exams=3, num_slices=10)
+    created = []
+    createPoi = case.PatientModel.CreatePoi
+    def countedCreatePoi(**kwargs):
+        created.append( kwargs['Name'] )
+        createPoi(**kwargs)
+    case.PatientModel.CreatePoi = countedCreatePoi
+
+    directory = tempfile.mkdtemp()
+    try:
+        for run in range(2):
+            markers = motionEngine.PoiWriter(case, CompositeAction, max_markers=3)
+            runAnalysis( case, os.path.join(directory, 'motion.csv'), rois=['ROI_A'], markers=markers )
+            assert( len(actions) == run + 1 and markers.pending == [] )
+        assert( sorted(created) == ['ROI_A_L1', 'ROI_A_L2', 'ROI_A_L3', 'ROI_A_R1', 'ROI_A_R2', 'ROI_A_R3'] )
+
+        for exam in case.Examinations:
+            sSet = case.PatientModel.StructureSets[exam.Name]
+            contours = sSet.RoiGeometries['ROI_A'].PrimaryShape.Contours
+            for name in created:
+                point = sSet.PoiGeometries[name].Point
+                x_slice = [ pt.x for con in contours for pt in con if abs(pt.z - point['z']) < 1E-6 ]
+                assert( abs(point['x'] - (max(x_slice) if '_L' in name else min(x_slice))) < 1E-9 )
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+# -------------- #
+
+def test_skippedExamsAndErrors():
+    """
+    Are exams without contours or base exam skipped, in both modes, while other errors stop the run?
+    """
+    class BrokenBase(motionEngine.PlanningNameBase):
+        def baseExamFor(self, exam):
+            raise IndexError("a bug")
+
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, 'motion.csv')
+        for interpolate in [False, True]:
+            case = syntheticCase.makeCase(num_exams=3, num_slices=10)
+            case.PatientModel.StructureSets['CBCT1'].RoiGeometries['ROI_A'].PrimaryShape.Contours = []
+            exams = set([ line.split(',')[1] for line in runAnalysis(case, filename, interpolate=interpolate).splitlines()[1:]
+                          if line.startswith('ROI_A') ])
+            assert( exams == set(['Planning CT', 'CBCT2']) )
+
+        case = syntheticCase.makeCase(num_exams=3, num_slices=10)
+        case.Examinations[0].Name = 'CT'     # no Planning CT
+        case.PatientModel.StructureSets['CT'] = case.PatientModel.StructureSets.pop('Planning CT')
+        assert( len(runAnalysis(case, filename).splitlines()) == 1 )
+
+        try:
+            motionEngine.MotionAnalysis( case, ['ROI_A'], BrokenBase(), 0.25 ).run(filename)
+            assert( False )
+        except IndexError:
+            pass
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+# -------------- #
+
+def test_incrementalChanges():
+    """
+    Does an incremental run analyse again only the pair whose contour was edited
+    (even if the number of points and the first point are unchanged), and all
+    pairs once a new output is enabled?
+    """
+    def reusedPairs(case, filename, **options):
+        analysis = motionEngine.MotionAnalysis( case, ['ROI_A', 'ROI_B'], motionEngine.PlanningNameBase(), 0.25, **options )
+        before = motionOutput.IncrementalState(filename, analysis.settings()).previous
+        analysis.run(filename, incremental=True)
+        after = motionOutput.IncrementalState(filename, analysis.settings()).previous
+        return len([ pair for pair in after if before.get(pair) == after[pair] ])
+
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, 'motion.csv')
+        case = syntheticCase.makeCase(num_exams=4, num_slices=10)
+        assert( reusedPairs(case, filename) == 0 )
+        first = readFile(filename)
+        assert( reusedPairs(case, filename) == 8 )
+        assert( readFile(filename) == first )
+
+        # move a point in the middle of one contour
+        contour = case.PatientModel.StructureSets['CBCT2'].RoiGeometries['ROI_A'].PrimaryShape.Contours[5]
+        contour[3] = syntheticCase.Node( x=contour[3].x + 1.0, y=contour[3].y, z=contour[3].z )
+        assert( reusedPairs(case, filename) == 7 )
+        changed = [ line for line in readFile(filename).splitlines() if line not in first.splitlines() ]
+        assert( len(changed) > 0 and all([ line.startswith('ROI_A,CBCT2,') for line in changed ]) )
+
+        assert( reusedPairs(case, filename, surface=True) == 0 )
+        assert( len(readFile( os.path.join(directory, 'motion_SURFACE.csv') ).splitlines()) == 9 )
+        # a run that is not incremental leaves no state behind
+        runAnalysis(case, filename)
+        assert( not os.path.exists(filename + motionOutput.STATE_SUFFIX) )
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+# -------------- #
+
+def test_workersMatchSerial():
+    """
+    Is the output of a run with worker processes the same as that of a serial
+    run, and is a run without a python interpreter for the workers serial?
+    """
+    directory = tempfile.mkdtemp()
+    (worker_python, executable) = (motionEngine.WORKER_PYTHON, sys.executable)
+    try:
+        filename = os.path.join(directory, 'motion.csv')
+        case = syntheticCase.makeCase(num_exams=4, num_slices=10)
+        options = {'num_directions': 4, 'shape': True}
+        serial = runAnalysis(case, filename, **options)
+        assert( runAnalysis(case, filename, workers=2, **options) == serial )
+        # more pairs than the workers are ahead of
+        assert( runAnalysis(case, filename, workers=2, **options) == runAnalysis(case, filename, workers=8, **options) )
+
+        motionEngine.WORKER_PYTHON = None
+        sys.executable = os.path.join(directory, 'RayStation.exe')
+        assert( motionEngine.workerPython() is None )
+        assert( runAnalysis(case, filename, workers=2, **options) == serial )
+    finally:
+        (motionEngine.WORKER_PYTHON, sys.executable) = (worker_python, executable)
+        shutil.rmtree(directory, ignore_errors=True)
+
+# -------------- #
+
+def test_previewPairs():
+    """
+    Are the preview rows some of those of the full run, read from only the
+    sampled contours of each exam, and only of the pairs an incremental run analyses?
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, 'motion.csv')
+        case = syntheticCase.makeCase(num_exams=4, num_slices=30, contours_per_slice=2)
+        analysis = motionEngine.MotionAnalysis( case, ['ROI_A', 'ROI_B'], motionEngine.PlanningNameBase(), 0.25,
+                                                preview=[8, 3] )
+        pairs = [ (roi_name, exam) for roi_name in ['ROI_A', 'ROI_B'] for exam in analysis.base_strategy.selectExams(case) ]
+        preview = readFile( analysis.runPreview(filename, pairs) ).splitlines()
+        # only the base exam (shared by all exams) is read in full
+        assert( sorted(analysis.cache.packed) == [('Planning CT', 'ROI_A'), ('Planning CT', 'ROI_B')] )
+
+        full = runAnalysis(case, filename).splitlines()
+        assert( preview[0] == full[0] and 0 < len(preview) < len(full) / 2 )
+        assert( set(preview[1:]) <= set(full[1:]) )
+
+        # an incremental run only previews the pairs that have changed
+        previewed = []
+        for edit in [False, True]:
+            if edit:
+                case.PatientModel.StructureSets['CBCT1'].RoiGeometries['ROI_B'].PrimaryShape.Contours.pop()
+            analysis = motionEngine.MotionAnalysis( case, ['ROI_A', 'ROI_B'], motionEngine.PlanningNameBase(), 0.25,
+                                                    preview=[4] )
+            runPreview = analysis.runPreview
+            analysis.runPreview = lambda filename, pairs: previewed.append(pairs) or runPreview(filename, pairs)
+            analysis.run(filename, incremental=True)
+        assert( len(previewed[0]) == 8 and [ (roi_name, exam.Name) for (roi_name, exam) in previewed[1] ] ==
+                [('ROI_B', 'CBCT1')] )
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+# -------------- #
+
+def test_registrationRemovesTransform():
+    """
+    With registration=True are CBCTs in a rotated and shifted frame moved back
+    onto the Planning CT, giving the rows of the case without the transform?
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, 'motion.csv')
+        transform = syntheticCase.rigidTransform(rotation=12.0, dx=1.5, dy=-2.0, dz=0.75)
+        plain = syntheticCase.makeCase(num_exams=3, num_slices=20, seed=4)
+        moved = syntheticCase.makeCase(num_exams=3, num_slices=20, seed=4, exam_transform=transform)
+
+        expected = runAnalysis(plain, filename, registration=True).splitlines()
+        registered = runAnalysis(moved, filename, registration=True).splitlines()
+        assert( registered[0] == expected[0] and len(registered) == len(expected) )
+        for (line, expected_line) in zip(registered[1:], expected[1:]):
+            (fields, expected_fields) = (line.split(','), expected_line.split(','))
+            assert( fields[:2] == expected_fields[:2] )
+            assert( all([ abs(float(value) - float(e)) < 1E-9 for (value, e) in zip(fields[2:], expected_fields[2:]) ]) )
+
+        # without the registration the transform shows up as motion of the CBCTs
+        unregistered = runAnalysis(moved, filename).splitlines()
+        rows = [ line.split(',') for line in unregistered[1:] if ',CBCT' in line ]
+        assert( max([ abs(float(value)) for row in rows for value in row[3:] ]) > 1.0 )
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+# -------------- #
+
+
+
+def run_tests():
+    """
+    Run all the automated tests on this script
+    """
+    import nose
+    nose.run(argv=['', __file__, '-v'])
@@ -0,0 +1,140 @@
+"""
+Tests of the module motionMargins, on small motion exports written by hand
+
+To run tests type:
+    from rmhTools.roiTools import test_motionMargins
+    test_motionMargins.run_tests()
+"""
+
+# -------------- #
+
+import os
+import shutil
+import tempfile
+
+from . import motionMargins
+
+# -------------- #
+
+
+def writeExport(filename, rows, header='roi,exam,z,R.x'):
+    """Write a motion csv of (roi, exam, z, R.x) rows (or those of header)"""
+    with open(filename, 'w') as fp:
+        fp.write(header + '\n')
+        for row in rows:
+            fp.write( ','.join([ str(value) for value in row ]) + '\n' )
+
+# -------------- #
+
+def test_marginsByHand():
+    """
+    Do M, Sigma, sigma and the margin match a hand calculation, leaving out the
+    planning CT, the z column and the exports of other scripts?
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        # fraction means: P1 2 and 4, P2 0 and 2, P3 5
+        writeExport( os.path.join(directory, 'motionPoints_P1.csv'),
+                     [ ('ROI_A', 'Planning CT', 1.0, 0.0), ('ROI_A', 'CBCT1', 1.0, 1.0), ('ROI_A', 'CBCT1', 1.5, 3.0),
+                       ('ROI_A', 'CBCT2', 1.0, 4.0) ] )
+        writeExport( os.path.join(directory, 'motionPoints_P2.csv'),
+                     [ ('ROI_A', 'CBCT1', 9.0, 0.0), ('ROI_A', 'CBCT2', 9.0, 2.0) ] )
+        writeExport( os.path.join(directory, 'motionPoints_P3.csv'), [ ('ROI_A', 'CBCT1', -4.0, 5.0) ] )
+        # not per-patient motion of motionByPoints
+        writeExport( os.path.join(directory, 'motionPoints_multiPlan_P1.csv'), [ ('ROI_A', 'CBCT1', 0.0, 50.0) ] )
+        writeExport( os.path.join(directory, 'motionPoints_P1_SUPINF.csv'), [ ('ROI_A', 'CBCT1', 0.0, 50.0) ] )
+
+        assert( [ patient for (patient, filename) in motionMargins.exportFiles(directory) ] == ['P1', 'P2', 'P3'] )
+        motionMargins.main(directory)
+
+        # patient means 3, 1, 5 and variances 2, 2 (P3 has one fraction)
+        (M, Sigma, sigma) = (3.0, 2.0, 2.0**0.5)
+        with open( os.path.join(directory, motionMargins.TABLE_FILE), 'r' ) as fp:
+            lines = fp.read().splitlines()
+        assert( len(lines) == 2 )
+        fields = lines[1].split(',')
+        assert( fields[:3] == ['ROI_A', 'R.x', '3'] )
+        expected = [ M, Sigma, sigma, 2.5*Sigma + 0.7*sigma ]
+        assert( all([ abs(float(value) - e) < 1E-9 for (value, e) in zip(fields[3:], expected) ]) )
+
+        # a second run adds no patient twice
+        calculator = motionMargins.MarginCalculator( os.path.join(directory, motionMargins.STATE_FILE) )
+        assert( calculator.patients == ['P1', 'P2', 'P3'] )
+        assert( not calculator.addPatient(os.path.join(directory, 'motionPoints_P2.csv'), 'P2') )
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+# -------------- #
+
+def readTable(directory):
+    """{(roi, direction): (patients, M, Sigma, sigma, margin)} of the margin table in directory"""
+    with open( os.path.join(directory, motionMargins.TABLE_FILE), 'r' ) as fp:
+        lines = fp.read().splitlines()
+    table = {}
+    for line in lines[1:]:
+        fields = line.split(',')
+        table[ (fields[0], fields[1]) ] = tuple( [int(fields[2])] + [ float(value) for value in fields[3:] ] )
+    return table
+
+# -------------- #
+
+def test_shapeColumnsSkipped():
+    """
+    Are the absolute shape columns of a shape export left out of the margins?
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        header = 'roi,exam,z,R.x,area,perimeter,C.x,C.y,width,height'
+        writeExport( os.path.join(directory, 'motionPoints_P1.csv'),
+                     [ ('ROI_A', 'CBCT1', 1.0, 1.0, 20.0, 16.0, 3.0, -2.0, 5.0, 4.0),
+                       ('ROI_A', 'CBCT2', 1.0, 3.0, 22.0, 17.0, 3.5, -2.5, 5.5, 4.0) ], header )
+        writeExport( os.path.join(directory, 'motionPoints_P2.csv'),
+                     [ ('ROI_A', 'CBCT1', 1.0, 0.0, 30.0, 19.0, 1.0, 1.0, 6.0, 5.0) ], header )
+        motionMargins.main(directory)
+
+        table = readTable(directory)
+        assert( list(table) == [ ('ROI_A', 'R.x') ] )
+        assert( table[('ROI_A', 'R.x')][:2] == (2, 1.0) )
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+# -------------- #
+
+def test_baseExamNames():
+    """
+    Are base exams not called "planning" left out: the base named in a
+    motionByPoints_MRI file name, and those of a given exclude_exam?
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        writeExport( os.path.join(directory, 'P1_x_base=Plan CT_vs_Wk0 MR3D,Wk2 MR3D.csv'),
+                     [ ('ROI_A', 'Plan CT', 1.0, 0.0), ('ROI_A', 'Wk0 MR3D', 1.0, 2.0),
+                       ('ROI_A', 'Wk2 MR3D', 1.0, 4.0) ] )
+        assert( motionMargins.exportBaseExam(os.path.join(directory, 'P1_x_base=Plan CT_vs_Wk0 MR3D.csv')) == 'Plan CT' )
+        assert( motionMargins.exportBaseExam('motionPoints_P1.csv') is None )
+
+        motionMargins.main(directory, prefix='')
+        # fraction means 2 and 4: M 3, sigma sqrt(2)
+        (n, M, Sigma, sigma, margin) = readTable(directory)[('ROI_A', 'R.x')]
+        assert( n == 1 and M == 3.0 and abs(sigma - 2.0**0.5) < 1E-9 )
+
+        # base exams of another naming scheme
+        os.remove( os.path.join(directory, motionMargins.STATE_FILE) )
+        writeExport( os.path.join(directory, 'motionPoints_P2.csv'),
+                     [ ('ROI_A', 'Sim CT', 1.0, 0.0), ('ROI_A', 'CBCT1', 1.0, 2.0), ('ROI_A', 'CBCT2', 1.0, 4.0) ] )
+        motionMargins.main(directory, exclude_exam=lambda name: name == 'Sim CT')
+        (n, M, Sigma, sigma, margin) = readTable(directory)[('ROI_A', 'R.x')]
+        assert( n == 1 and M == 3.0 )
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+# -------------- #
+
+
+
+def run_tests():
+    """
+    Run all the automated tests on this script
+    """
+    import nose
+    nose.run(argv=['', __file__, '-v'])
@@ -0,0 +1,122 @@
+"""
+Tests of the module motionOutput, on the output of synthetic cases (syntheticCase)
+
+To run tests type:
+    from rmhTools.roiTools import test_motionOutput
+    test_motionOutput.run_tests()
+"""
+
+# -------------- #
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from . import motionEngine
+from . import motionOutput
+from . import syntheticCase
+
+class InterruptedBase(motionEngine.PlanningNameBase):
+    """PlanningNameBase recording the exams analysed, and stopping the run at stop_at"""
+
+    def __init__(self, stop_at=None):
+        self.stop_at = stop_at
+        self.analysed = []
+
+    def baseExamFor(self, exam):
+        if exam.Name == self.stop_at:
+            raise KeyboardInterrupt()
+        self.analysed.append( exam.Name )
+        return motionEngine.PlanningNameBase.baseExamFor(self, exam)
+
+
+def readFile(filename):
+    with open(filename, 'r') as fp:
+        return fp.read()
+
+# -------------- #
+
+def test_resumeInterrupted():
+    """
+    Does a resumed run cut off the rows written after the last complete pair,
+    analyse only the pairs not complete, and give the output of an uninterrupted run?
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, 'motion.csv')
+        case = syntheticCase.makeCase(num_exams=4, num_slices=10)
+
+        def run(base_strategy, resume=False):
+            analysis = motionEngine.MotionAnalysis( case, ['ROI_A', 'ROI_B'], base_strategy, 0.25, export_supinf=True )
+            analysis.run(filename, os.path.join(directory, 'motion_SUPINF.csv'), resume=resume)
+            return readFile(filename) + readFile( os.path.join(directory, 'motion_SUPINF.csv') )
+        complete = run( InterruptedBase() )
+
+        try:
+            run( InterruptedBase(stop_at='CBCT2') )
+            assert( False )
+        except KeyboardInterrupt:
+            pass
+        # rows and a progress record only partly written when the run stopped
+        with open(filename, 'a') as fp:
+            fp.write('ROI_A,CBCT2,1.0,0.')
+        with open(filename + motionOutput.PROGRESS_SUFFIX, 'a') as fp:
+            fp.write('{"roi": "ROI_A", "exa')
+
+        base_strategy = InterruptedBase()
+        assert( run(base_strategy, resume=True) == complete )
+        assert( base_strategy.analysed == ['CBCT2', 'CBCT3', 'Planning CT', 'CBCT1', 'CBCT2', 'CBCT3'] )
+        assert( not os.path.exists(filename + motionOutput.PROGRESS_SUFFIX) )
+
+        # nothing to resume: a new run
+        base_strategy = InterruptedBase()
+        assert( run(base_strategy, resume=True) == complete and len(base_strategy.analysed) == 8 )
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+# -------------- #
+
+def test_heatmapAlignment():
+    """
+    Are the slices of exams whose SP point is not on the slice grid of the
+    others put in the same heatmap rows, one slice per row?
+    """
+    directory = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(directory, 'motion.csv')
+        case = syntheticCase.makeCase(num_exams=4, num_slices=20)
+        for exam_name in ['CBCT1', 'CBCT3']:
+            case.PatientModel.StructureSets[exam_name].PoiGeometries[motionEngine.REF_POINT_SP].Point.z += 0.1
+        motionEngine.MotionAnalysis( case, ['ROI_A'], motionEngine.PlanningNameBase(), 0.25 ).run(filename)
+
+        for z_interval in [0.25, None]:
+            (image, z, exams) = motionOutput.openHeatmap( motionOutput.writeHeatmaps(filename, z_interval), 'ROI_A', 'R.x' )
+            assert( exams == ['Planning CT', 'CBCT1', 'CBCT2', 'CBCT3'] )
+            assert( np.allclose(np.diff(z), 0.25) )
+
+            with open(filename, 'r') as fp:
+                rows = [ line.strip().split(',') for line in fp.readlines()[1:] ]
+            for (e, exam) in enumerate(exams):
+                exam_rows = [ row for row in rows if row[1] == exam ]
+                assert( np.count_nonzero(~np.isnan(image[:, e])) == len(exam_rows) )
+                for row in exam_rows:
+                    nearest = np.argmin( np.abs(np.array(z) - float(row[2])) )
+                    assert( abs(z[nearest] - float(row[2])) <= 0.125 + 1E-9 )
+                    assert( image[nearest, e] == np.float32(row[3]) )
+            # most rows have a slice of every exam
+            assert( np.count_nonzero(~np.isnan(image).any(axis=1)) >= len(z) - 4 )
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+# -------------- #
+
+
+
+def run_tests():
+    """
+    Run all the automated tests on this script
+    """
+    import nose
+    nose.run(argv=['', __file__, '-v'])